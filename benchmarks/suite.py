@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+'''
+Measures the throughput of the library's hot paths and writes the results
+as JSON, so runs on different commits can be compared:
+
+    python benchmarks/suite.py -o before.json
+    ... change things ...
+    python benchmarks/suite.py -o after.json --compare before.json
+
+--compare prints every metric next to the baseline and exits with status 1
+if any got worse by more than the tolerance. Metrics ending in _per_sec are
+better higher, the others (_ms, _kb) better lower. Everything runs without
+a gateway; the ZCL model is synthetic unless XML files are given.
+'''
+import os
+import sys
+import gc
+import json
+import time
+import random
+import timeit
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+import zcl
+import zigbee
+import embercli
+import simulator
+from codec import type_codecs, compile_payload, StringCodec, FixedBytesCodec
+
+def rate(function, number, repeat=3):
+    '''
+    Returns how many times per second function runs, from the best of
+    repeat runs of number calls.
+    '''
+    return number / min(timeit.repeat(function, number=number, repeat=repeat))
+
+def sample_value(codec, length=8):
+    if isinstance(codec, StringCodec):
+        return 'x' * length if codec.characters else [0x55] * length
+    if isinstance(codec, FixedBytesCodec):
+        return [0x55] * codec.size
+    if codec.name.startswith('FLOAT'):
+        return 1.5
+    if codec.name == 'BOOLEAN':
+        return 1
+    # signed struct formats are lower case
+    if (getattr(codec, 'signed', False) or
+            getattr(codec, 'format', 'B').islower()):
+        return -1
+    return 1
+
+def synthetic_xml(directory, clusters=100, attributes=20, commands=10):
+    '''
+    Writes an Ember style XML file with the given number of clusters, each
+    with the given number of attributes and commands, and returns its path.
+    '''
+    lines = ['<?xml version="1.0"?>', '<configurator>',
+            '<global><command source="client" code="0x00" name="ReadAttributes">'
+            '<arg name="attributeIds" type="ATTRIBUTE_ID"/></command></global>']
+    types = ['INT8U', 'INT16U', 'INT32S', 'BOOLEAN', 'CHAR_STRING', 'ENUM8']
+    for c in xrange(clusters):
+        lines.append('<cluster><name>Bench Cluster %d</name><domain>B</domain>'
+                '<code>0x%04X</code><define>BENCH_%d</define>' % (c, 0x100 + c, c))
+        for a in xrange(attributes):
+            lines.append('<attribute side="server" code="0x%04X" '
+                    'define="ATTR_%d" type="%s" writable="true">attribute %d'
+                    '</attribute>' % (a, a, types[a % len(types)], a))
+        for m in xrange(commands):
+            lines.append('<command source="client" code="0x%02X" '
+                    'name="Command%d"><arg name="a" type="INT8U"/>'
+                    '<arg name="b" type="INT16U"/><arg name="c" '
+                    'type="CHAR_STRING"/></command>' % (m, m))
+        lines.append('</cluster>')
+    lines.append('</configurator>')
+    path = os.path.join(directory, 'bench.xml')
+    with open(path, 'w') as xml_file:
+        xml_file.write('\n'.join(lines))
+    return path
+
+def bench_codec(options):
+    '''
+    Encodes and decodes a value of every type with the legacy list helpers,
+    and whole payloads of 1 to 32 fields with a compiled codec.
+    '''
+    results = {}
+    for name in sorted(type_codecs):
+        codec = type_codecs[name]
+        lengths = [1, 16, 200] if isinstance(codec, StringCodec) else [None]
+        for length in lengths:
+            label = name if length is None else '%s_%d' % (name, length)
+            value = sample_value(codec, length)
+            payload = zigbee._list_from_arg(name, value)
+            results['list_from_arg_%s_per_sec' % label] = rate(
+                    lambda: zigbee._list_from_arg(name, value), options.number)
+            results['pop_argument_%s_per_sec' % label] = rate(
+                    lambda: zigbee._pop_argument(name, list(payload)),
+                    options.number)
+    for fields in [1, 8, 32]:
+        types = [['INT8U', 'INT16U', 'INT32S', 'CHAR_STRING'][i % 4]
+                for i in xrange(fields)]
+        codec = compile_payload(types)
+        values = [sample_value(type_codecs[t]) for t in types]
+        data = codec.encode(values)
+        results['payload_encode_%d_fields_per_sec' % fields] = rate(
+                lambda: codec.encode(values), options.number)
+        results['payload_decode_%d_fields_per_sec' % fields] = rate(
+                lambda: codec.decode(data), options.number)
+    return results
+
+def bench_validate(options):
+    '''
+    Checks received payloads against expected ZCLCommandArgs.
+    '''
+    arglist = [zcl.ZCLCommandArg('a', 'INT8U', 10),
+            zcl.ZCLCommandArg('b', 'INT16U', zigbee.Between(0, 100)),
+            zcl.ZCLCommandArg('c', 'CHAR_STRING', 'abcd'),
+            zcl.ZCLCommandArg('d', 'INT32U', None)]
+    codec = compile_payload([arg.type for arg in arglist])
+    payload = bytearray(codec.encode([10, 50, 'abcd', 7]))
+    return {
+        'validate_payload_per_sec': rate(
+            lambda: zigbee._validate_payload(arglist, payload),
+            options.number),
+        'validate_payload_compiled_per_sec': rate(
+            lambda: zigbee._validate_payload(arglist, payload, codec),
+            options.number),
+    }
+
+def synthetic_log(count, seed=0):
+    '''
+    Returns count CLI lines, mostly received frames with some status lines
+    and noise, as seen from a busy gateway.
+    '''
+    generator = random.Random(seed)
+    lines = []
+    for _ in xrange(count):
+        choice = generator.random()
+        if choice < 0.7:
+            payload = ' '.join(['%02X' % generator.randint(0, 255)
+                for _ in xrange(generator.randint(1, 20))])
+            lines.append('T%08X:RX len %d, ep 01, clus 0x%04X (Some Cluster) '
+                    'FC 18 seq %02X cmd %02X payload[%s ]' % (
+                        generator.getrandbits(32), 3 + len(payload) / 3,
+                        generator.randint(0, 0x0B05),
+                        generator.randint(0, 255), generator.randint(0, 11),
+                        payload))
+        elif choice < 0.8:
+            lines.append('RX: ZDO, command 0x8021, status: 0x00')
+        elif choice < 0.85:
+            lines.append('Device Announce: 0x%04X' % generator.randint(1, 0xFFF7))
+        else:
+            lines.append('ha_gw>send 0x%04X 1 1' % generator.randint(1, 0xFFF7))
+    return lines
+
+def bench_parse(options):
+    '''
+    Parses a synthetic CLI log, and routes it through a dispatcher.
+    '''
+    lines = synthetic_log(10000)
+    number = max(1, options.number / 10000)
+    def parse():
+        for line in lines:
+            embercli.parse_line(line)
+    dispatcher = zigbee.FrameDispatcher()
+    def dispatch():
+        for line in lines:
+            dispatcher.dispatch_line(line)
+    return {
+        'parse_lines_per_sec': rate(parse, number) * len(lines),
+        'dispatch_lines_per_sec': rate(dispatch, number) * len(lines),
+    }
+
+def bench_transactions(options):
+    '''
+    Reads and writes attributes on devices of an in-process simulator,
+    one transaction at a time and 100 in flight at once.
+    '''
+    model = zcl.ZCL([options.xml_files[0]] if options.xml_files else
+            [synthetic_xml(options.temp_dir, clusters=2)])
+    attribute = [a for code in model.cluster_codes()
+            for a in model.cluster_by_code(code).attributes_by_code.values()
+            if a.type in ['INT8U', 'INT16U']][0]
+    cluster = model.cluster_by_code(attribute.cluster_code)
+    gateway = simulator.EmberSimulator(model, seed=0)
+    nodes = [device.node_id for device in gateway.add_devices(100,
+        [cluster.code], joined=True)]
+    controller = zigbee.AsyncZBController(
+            simulator.SimulatorTransport(gateway))
+    controller.open('simulator')
+    number = max(1, options.number / 100)
+    def read():
+        controller.read_attribute(nodes[0], attribute).result(5)
+    def write():
+        controller.write_attribute(nodes[0], attribute, 1).result(5)
+    def read_many():
+        zigbee.gather([controller.read_attribute(node, attribute)
+            for node in nodes], 5)
+    results = {
+        'read_attribute_per_sec': rate(read, number),
+        'write_attribute_per_sec': rate(write, number),
+        'read_attribute_pipelined_per_sec':
+            rate(read_many, max(1, number / 100)) * len(nodes),
+    }
+    controller.close()
+    return results
+
+def bench_zcl_load(options):
+    '''
+    Builds the ZCL model from XML in a fresh process, which reports the
+    time taken and the memory it grew by.
+    '''
+    xml_files = options.xml_files or [synthetic_xml(options.temp_dir)]
+    results = {}
+    for mode in ['eager', 'lazy']:
+        runs = [json.loads(subprocess.check_output([sys.executable, __file__,
+            '--child', mode] + xml_files)) for _ in xrange(3)]
+        results['zcl_%s_load_ms' % mode] = min([r['ms'] for r in runs])
+        results['zcl_%s_load_kb' % mode] = min([r['kb'] for r in runs])
+    return results
+
+def child(mode, xml_files):
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    model = zcl.ZCL(xml_files, lazy=(mode == 'lazy'))
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print json.dumps({'ms': 1000 * elapsed, 'kb': after - before})
+
+benchmarks = [
+    ('codec', bench_codec),
+    ('validate', bench_validate),
+    ('parse', bench_parse),
+    ('transactions', bench_transactions),
+    ('zcl_load', bench_zcl_load),
+]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints each metric against the baseline, and returns the names of the
+    ones that got worse by more than tolerance (a fraction).
+    '''
+    regressions = []
+    print '%-50s %14s %14s %8s' % ('metric', 'baseline', 'current', 'change')
+    for group in sorted(results):
+        for metric in sorted(results[group]):
+            name = '%s.%s' % (group, metric)
+            current = results[group][metric]
+            old = baseline.get(group, {}).get(metric)
+            if not old:
+                print '%-50s %14s %14.1f' % (name, '-', current)
+                continue
+            change = (current - old) / float(old)
+            worse = -change if metric.endswith('_per_sec') else change
+            flag = ''
+            if worse > tolerance:
+                flag = ' <-- worse'
+                regressions.append(name)
+            print '%-50s %14.1f %14.1f %+7.1f%%%s' % (name, old, current,
+                    100 * change, flag)
+    return regressions
+
+def main():
+    parser = OptionParser(usage='%prog [options] [XML_FILE...]')
+    parser.add_option('-o', '--output', help='write the JSON results here '
+            '(default: standard output)')
+    parser.add_option('-b', '--bench', action='append', help='only run this '
+            'benchmark, can be repeated: ' + ', '.join([n for n, _ in benchmarks]))
+    parser.add_option('-n', '--number', type='int', default=20000,
+            help='calls per timing run, scaled down for slower operations')
+    parser.add_option('--compare', help='baseline JSON results to compare to')
+    parser.add_option('--tolerance', type='float', default=0.1,
+            help='fraction a metric may get worse by before --compare fails')
+    parser.add_option('--child', help=SUPPRESS_HELP)
+    options, options.xml_files = parser.parse_args()
+    if options.child:
+        child(options.child, options.xml_files)
+        return
+    options.temp_dir = tempfile.mkdtemp(prefix='zigsnake-bench-')
+    try:
+        results = {}
+        for name, benchmark in benchmarks:
+            if options.bench and name not in options.bench:
+                continue
+            sys.stderr.write('running %s\n' % name)
+            results[name] = benchmark(options)
+    finally:
+        shutil.rmtree(options.temp_dir)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'xml_files': options.xml_files,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    elif not options.compare:
+        print output
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+Compares the memory and allocation cost of ZCL command calls in the current
+slotted layout against the previous layout, where every call copied its
+cluster ID, code and name and held a list of per-argument objects with their
+own __dict__s. Useful when sizing history buffers for long soak tests.
+
+    python benchmarks/zcl_memory.py [-n CALLS]
+'''
+import os
+import sys
+import gc
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+import zcl
+
+class OldCommandCall:
+    def __init__(self, proto, arglist):
+        self.cluster_code = proto.cluster_code
+        self.code = proto.code
+        self.name = proto.name
+        self.args = list(arglist)
+
+class OldCommandArg:
+    def __init__(self, name, type, value):
+        self.name = name
+        self.type = type
+        self.value = value
+
+def old_call(proto, *args):
+    return OldCommandCall(proto, [OldCommandArg(param.name, param.type, value)
+        for param, value in zip(proto.params, args)])
+
+class FakeElement:
+    '''
+    Just enough of an ElementTree element to build a prototype without any
+    XML files.
+    '''
+    def __init__(self, attributes, args=()):
+        self.attributes = attributes
+        self.args = args
+    def get(self, name, default=None):
+        return self.attributes.get(name, default)
+    def findall(self, tag):
+        return list(self.args)
+
+def deep_size(obj, seen=None):
+    '''
+    Adds up sys.getsizeof for an object and everything it owns, stopping at
+    objects shared with the prototype.
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (zcl.ZCLCommandPrototype,
+            int, long, str)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    if isinstance(obj, dict):
+        for value in obj.values():
+            size += deep_size(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deep_size(item, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        size += deep_size(getattr(obj, slot, None), seen)
+    return size
+
+def measure(name, make, count):
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    start = time.time()
+    history = [make(i) for i in xrange(count)]
+    elapsed = time.time() - start
+    gc.collect()
+    tracked = len(gc.get_objects()) - objects_before
+    print '%-8s %12d %14.1f %16.2f' % (name, deep_size(history[0]),
+            float(tracked) / count, 1e6 * elapsed / count)
+    return history
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--calls', type='int', default=200000,
+            help='calls to keep in the history buffer')
+    options, _ = parser.parse_args()
+    proto = zcl.ZCLCommandPrototype(0x0101, FakeElement(
+        {'name': 'SetPIN', 'code': '0x05'},
+        [FakeElement({'name': 'userId', 'type': 'INT16U'}),
+         FakeElement({'name': 'userStatus', 'type': 'INT8U'}),
+         FakeElement({'name': 'userType', 'type': 'INT8U'}),
+         FakeElement({'name': 'pin', 'type': 'CHAR_STRING'})]))
+    print '%-8s %12s %14s %16s' % ('layout', 'bytes/call', 'gc objs/call',
+            'us/call')
+    measure('old', lambda i: old_call(proto, i & 0xffff, 1, 1, '1234'),
+            options.calls)
+    measure('slotted', lambda i: proto(i & 0xffff, 1, 1, '1234'),
+            options.calls)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''
+Compares process startup time when the ZCL model is built from the XML
+files (cold) against loading it from the cache written by ZCL.load_cached
+(warm). Each run is a fresh Python process, as it is for our test runner.
+
+    python benchmarks/zcl_startup.py general.xml ha.xml ha12.xml ota.xml
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+def child(mode, cache_dir, xml_files):
+    start = time.time()
+    import zcl
+    if mode == 'cold':
+        zcl.ZCL(xml_files)
+    else:
+        zcl.ZCL.load_cached(xml_files, cache_dir)
+    print '%f' % (time.time() - start)
+
+def run(mode, cache_dir, xml_files):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, __file__, '--child',
+        mode, '--cache-dir', cache_dir] + xml_files)
+    return float(output.split()[-1]), time.time() - start
+
+def main():
+    parser = OptionParser(usage='%prog [options] XML_FILE...')
+    parser.add_option('-n', '--runs', type='int', default=5,
+            help='processes to start for each mode')
+    parser.add_option('--cache-dir', help='where to keep the cache')
+    parser.add_option('--child', help=SUPPRESS_HELP)
+    options, xml_files = parser.parse_args()
+    if not xml_files:
+        parser.error('no XML files given')
+    if options.child:
+        child(options.child, options.cache_dir, xml_files)
+        return
+    cache_dir = tempfile.mkdtemp(prefix='zigsnake-bench-')
+    try:
+        # prime the cache so every warm run finds it
+        run('warm', cache_dir, xml_files)
+        print '%-6s %12s %12s' % ('mode', 'model (ms)', 'process (ms)')
+        for mode in ['cold', 'warm']:
+            results = [run(mode, cache_dir, xml_files)
+                    for _ in range(options.runs)]
+            print '%-6s %12.1f %12.1f' % (mode,
+                    1000 * min([model for model, _ in results]),
+                    1000 * min([process for _, process in results]))
+    finally:
+        shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+    main()
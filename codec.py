@@ -0,0 +1,375 @@
+'''
+Encoders and decoders for the data types used in ZCL payloads.
+
+Each type gets one codec object, built when this module is imported, that
+packs values into little-endian bytes with struct and decodes them from any
+buffer (str, bytearray or memoryview) at a given offset, without copying or
+popping the payload. compile_payload builds a codec for a whole parameter
+list once, merging runs of fixed-size fields into a single struct.Struct.
+'''
+import struct
+import binascii
+import warnings
+
+class TypeCodec(object):
+    '''
+    Base class for the codec of a single ZCL data type. size is the encoded
+    size in bytes, or None for variable length types.
+    '''
+    size = None
+
+    def __reduce__(self):
+        # struct.Struct can't be pickled, so look the codec up again by name
+        return (get_codec, (self.name,))
+
+    def encode(self, value):
+        raise NotImplementedError
+
+    def decode(self, data, offset=0):
+        '''
+        Decodes a value starting at offset and returns (value, new offset).
+        '''
+        raise NotImplementedError
+
+class StructCodec(TypeCodec):
+    '''
+    Codec for a type that maps directly onto a struct format character.
+    '''
+    def __init__(self, name, format):
+        self.name = name
+        self.format = format
+        self.struct = struct.Struct('<' + format)
+        self.size = self.struct.size
+
+    def encode(self, value):
+        try:
+            return self.struct.pack(value)
+        except struct.error:
+            raise ValueError('%r out of range for %s' % (value, self.name))
+
+    def decode(self, data, offset=0):
+        return self.struct.unpack_from(data, offset)[0], offset + self.size
+
+class OddIntegerCodec(TypeCodec):
+    '''
+    Codec for the 24, 40, 48 and 56 bit integers, which struct has no format
+    character for. The value is split into a run of smaller fields.
+    '''
+    _formats = {3: 'HB', 5: 'IB', 6: 'IH', 7: 'IHB'}
+
+    def __init__(self, name, size, signed):
+        self.name = name
+        self.size = size
+        self.signed = signed
+        self.struct = struct.Struct('<' + self._formats[size])
+        self.shifts = [0]
+        for format in self._formats[size][:-1]:
+            self.shifts.append(self.shifts[-1] +
+                    8 * struct.calcsize('<' + format))
+        self.masks = [(1 << (8 * struct.calcsize('<' + format))) - 1
+                for format in self._formats[size]]
+        self.sign_bit = 1 << (8 * size - 1)
+        self.limit = 1 << (8 * size)
+
+    def encode(self, value):
+        if self.signed:
+            if value < -self.sign_bit or value >= self.sign_bit:
+                raise ValueError('%r out of range for %s' % (value, self.name))
+            value &= self.limit - 1
+        elif value < 0 or value >= self.limit:
+            raise ValueError('%r out of range for %s' % (value, self.name))
+        return self.struct.pack(*[(value >> shift) & mask
+                for shift, mask in zip(self.shifts, self.masks)])
+
+    def decode(self, data, offset=0):
+        value = 0
+        for field, shift in zip(self.struct.unpack_from(data, offset),
+                self.shifts):
+            value |= field << shift
+        if self.signed and value & self.sign_bit:
+            value -= self.limit
+        return value, offset + self.size
+
+class SemiFloatCodec(TypeCodec):
+    '''
+    Codec for FLOAT_SEMI, the IEEE 754 half precision float.
+    '''
+    name = 'FLOAT_SEMI'
+    size = 2
+    _half = struct.Struct('<H')
+    _single = struct.Struct('<f')
+    _single_bits = struct.Struct('<I')
+
+    def encode(self, value):
+        bits = self._single_bits.unpack(self._single.pack(value))[0]
+        sign = (bits >> 16) & 0x8000
+        exponent = ((bits >> 23) & 0xff) - 127 + 15
+        mantissa = bits & 0x7fffff
+        if exponent >= 0x1f:
+            # too big, infinity or NaN
+            nan = 0x200 if ((bits >> 23) & 0xff) == 0xff and mantissa else 0
+            half = sign | 0x7c00 | nan
+        elif exponent <= 0:
+            # subnormal, or too small and rounded to zero
+            if exponent < -10:
+                half = sign
+            else:
+                mantissa |= 0x800000
+                half = sign | ((mantissa >> (13 - exponent)) + 1) >> 1
+        else:
+            # rounding may carry into the exponent, which is what we want
+            half = sign | ((exponent << 10) + ((mantissa + 0x1000) >> 13))
+        return self._half.pack(half)
+
+    def decode(self, data, offset=0):
+        half = self._half.unpack_from(data, offset)[0]
+        sign = -1.0 if half & 0x8000 else 1.0
+        exponent = (half >> 10) & 0x1f
+        mantissa = half & 0x3ff
+        if exponent == 0:
+            value = sign * mantissa * 2.0 ** -24
+        elif exponent == 0x1f:
+            value = sign * float('inf') if not mantissa else float('nan')
+        else:
+            value = sign * (1 + mantissa / 1024.0) * 2.0 ** (exponent - 15)
+        return value, offset + 2
+
+class StringCodec(TypeCodec):
+    '''
+    Codec for the length-prefixed string types. Character strings are
+    Python strings, octet strings are lists of 1-byte values.
+    '''
+    def __init__(self, name, length_format, characters):
+        self.name = name
+        self.length = struct.Struct('<' + length_format)
+        self.characters = characters
+
+    def encode(self, value):
+        if self.characters:
+            data = str(value)
+        else:
+            data = str(bytearray(value))
+        try:
+            return self.length.pack(len(data)) + data
+        except struct.error:
+            raise ValueError('%s too long for %s' % (repr(value)[:20],
+                self.name))
+
+    def decode(self, data, offset=0):
+        length = self.length.unpack_from(data, offset)[0]
+        start = offset + self.length.size
+        value = bytearray(data[start:start + length])
+        if self.characters:
+            return str(value), start + length
+        return list(value), start + length
+
+class FixedBytesCodec(TypeCodec):
+    '''
+    Codec for fixed size byte strings without a length, like SECURITY_KEY.
+    Values are lists of 1-byte values.
+    '''
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def encode(self, value):
+        if len(value) != self.size:
+            raise ValueError('%s needs exactly %d bytes' % (self.name,
+                self.size))
+        return str(bytearray(value))
+
+    def decode(self, data, offset=0):
+        return (list(bytearray(data[offset:offset + self.size])),
+                offset + self.size)
+
+def _struct_codecs(format, names):
+    return [(name, StructCodec(name, format)) for name in names]
+
+def _odd_codecs(size, signed, names):
+    return [(name, OddIntegerCodec(name, size, signed)) for name in names]
+
+type_codecs = dict(
+    _struct_codecs('B', ['INT8U', 'ENUM8', 'BITMAP8', 'DATA8', 'Status']) +
+    _struct_codecs('b', ['INT8S']) +
+    _struct_codecs('?', ['BOOLEAN']) +
+    _struct_codecs('H', ['INT16U', 'ENUM16', 'BITMAP16', 'DATA16',
+        'CLUSTER_ID', 'ATTRIBUTE_ID']) +
+    _struct_codecs('h', ['INT16S']) +
+    _odd_codecs(3, False, ['INT24U', 'BITMAP24', 'DATA24']) +
+    _odd_codecs(3, True, ['INT24S']) +
+    _struct_codecs('I', ['INT32U', 'ENUM32', 'BITMAP32', 'DATA32',
+        'UTC_TIME', 'TIME_OF_DAY', 'DATE', 'BACNET_OID']) +
+    _struct_codecs('i', ['INT32S']) +
+    _odd_codecs(5, False, ['INT40U', 'BITMAP40', 'DATA40']) +
+    _odd_codecs(5, True, ['INT40S']) +
+    _odd_codecs(6, False, ['INT48U', 'BITMAP48', 'DATA48']) +
+    _odd_codecs(6, True, ['INT48S']) +
+    _odd_codecs(7, False, ['INT56U', 'BITMAP56', 'DATA56']) +
+    _odd_codecs(7, True, ['INT56S']) +
+    _struct_codecs('Q', ['INT64U', 'BITMAP64', 'DATA64', 'IEEE_ADDRESS']) +
+    _struct_codecs('q', ['INT64S']) +
+    _struct_codecs('f', ['FLOAT_SINGLE']) +
+    _struct_codecs('d', ['FLOAT_DOUBLE']) +
+    [('FLOAT_SEMI', SemiFloatCodec()),
+     ('CHAR_STRING', StringCodec('CHAR_STRING', 'B', True)),
+     ('OCTET_STRING', StringCodec('OCTET_STRING', 'B', False)),
+     ('LONG_CHAR_STRING', StringCodec('LONG_CHAR_STRING', 'H', True)),
+     ('LONG_OCTET_STRING', StringCodec('LONG_OCTET_STRING', 'H', False)),
+     ('SECURITY_KEY', FixedBytesCodec('SECURITY_KEY', 16))])
+
+class UnknownTypeCodec(TypeCodec):
+    '''
+    Stands in for a type we don't know how to encode, such as an enumeration
+    or structure named in the XML. The value is treated as INT8U, with a
+    warning the first time a type is used.
+
+    >>> codec = get_codec('ShadeStatus')
+    >>> codec is get_codec('ShadeStatus')
+    True
+    >>> with warnings.catch_warnings(record=True) as caught:
+    ...     values = [codec.encode(3), codec.decode(bytearray([3]))]
+    >>> values, [str(warning.message) for warning in caught]
+    (['\\x03', (3, 1)], ['unrecognized type ShadeStatus, assuming INT8U'])
+    '''
+    size = 1
+
+    def __init__(self, name):
+        self.name = name
+
+    def _warn(self):
+        # warnings shows a message from the same line once, so this warns
+        # once per type
+        warnings.warn('unrecognized type %s, assuming INT8U' % self.name)
+
+    def encode(self, value):
+        self._warn()
+        return type_codecs['INT8U'].encode(value)
+
+    def decode(self, data, offset=0):
+        self._warn()
+        return type_codecs['INT8U'].decode(data, offset)
+
+# one UnknownTypeCodec per type name, as for the known types
+_unknown_codecs = {}
+
+def get_codec(type):
+    '''
+    Returns the codec for a ZCL type string.
+
+    >>> get_codec('INT24S').decode(get_codec('INT24S').encode(-2))
+    (-2, 3)
+    >>> get_codec('CHAR_STRING').encode('hi')
+    '\\x02hi'
+    '''
+    try:
+        return type_codecs[type]
+    except KeyError:
+        pass
+    codec = _unknown_codecs.get(type)
+    if codec is None:
+        codec = _unknown_codecs.setdefault(type, UnknownTypeCodec(type))
+    return codec
+
+class PayloadCodec(object):
+    '''
+    Encoder and decoder for a sequence of ZCL types, such as the parameters
+    of a command. Adjacent fixed-size fields that map onto struct formats
+    are packed and unpacked with one precompiled struct.Struct.
+
+    >>> codec = compile_payload(['INT8U', 'INT16U', 'CHAR_STRING', 'INT8S'])
+    >>> data = codec.encode([1, 0x1092, 'ab', -1])
+    >>> hex_string(data)
+    '01 92 10 02 61 62 FF'
+    >>> codec.decode(data)
+    ([1, 4242, 'ab', -1], 7)
+    '''
+    def __init__(self, types):
+        self.types = tuple(types)
+        # each step is either (struct, count) for a merged run of struct
+        # fields, or (codec, None) for anything else
+        self.steps = []
+        run = ''
+        for type in self.types:
+            codec = get_codec(type)
+            if isinstance(codec, StructCodec):
+                run += codec.format
+                continue
+            if run:
+                self.steps.append((struct.Struct('<' + run), len(run)))
+                run = ''
+            self.steps.append((codec, None))
+        if run:
+            self.steps.append((struct.Struct('<' + run), len(run)))
+        self.size = None
+        if all([count is not None for _, count in self.steps]):
+            self.size = sum([step.size for step, _ in self.steps])
+
+    def __reduce__(self):
+        # struct.Struct can't be pickled, so rebuild from the types
+        return (compile_payload, (self.types,))
+
+    def encode(self, values):
+        values = list(values)
+        if len(values) != len(self.types):
+            raise ValueError('expected %d values, got %d' % (len(self.types),
+                len(values)))
+        chunks = []
+        index = 0
+        for step, count in self.steps:
+            if count is None:
+                chunks.append(step.encode(values[index]))
+                index += 1
+                continue
+            try:
+                chunks.append(step.pack(*values[index:index + count]))
+            except struct.error:
+                # find the offending field for a more useful message
+                for type, value in zip(self.types[index:index + count],
+                        values[index:index + count]):
+                    get_codec(type).encode(value)
+                raise
+            index += count
+        return ''.join(chunks)
+
+    def decode(self, data, offset=0):
+        '''
+        Decodes every field starting at offset and returns (values, new
+        offset).
+        '''
+        values = []
+        for step, count in self.steps:
+            if count is None:
+                value, offset = step.decode(data, offset)
+                values.append(value)
+            else:
+                values.extend(step.unpack_from(data, offset))
+                offset += step.size
+        return values, offset
+
+_compiled_payloads = {}
+
+def compile_payload(types):
+    '''
+    Returns the PayloadCodec for the given sequence of type strings. Codecs
+    are cached, so commands with the same signature share one.
+    '''
+    types = tuple(types)
+    try:
+        return _compiled_payloads[types]
+    except KeyError:
+        codec = _compiled_payloads[types] = PayloadCodec(types)
+        return codec
+
+def hex_string(data):
+    '''
+    Formats bytes as the space-separated hex the Ember CLI expects.
+
+    >>> hex_string('\\x01\\xab')
+    '01 AB'
+    '''
+    digits = binascii.hexlify(data).upper()
+    return ' '.join([digits[i:i + 2] for i in xrange(0, len(digits), 2)])
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,353 @@
+'''
+Finds out what a device supports, and remembers it between runs.
+
+discover() asks a device for its active endpoints and their simple
+descriptors over ZDO, then for the attributes and commands of its server
+clusters with the ZCL Discover Attributes and Discover Commands Received
+commands, and gives the controller the resulting DeviceCapabilities. From
+then on the controller sends each frame to the endpoint that has its
+cluster, and fails frames for clusters or commands the device doesn't have
+with an UnsupportedError straight away, instead of after a timeout.
+
+Given a CapabilityCache, the capabilities are kept on disk by IEEE address,
+with the device's version: its manufacturer name, model identifier,
+application version and software build ID from the Basic cluster. Later
+runs only read those over the air, and discover the device again when they
+changed, after a firmware upgrade for instance:
+
+    cache = CapabilityCache()
+    capabilities = discover(controller, node_id, '000D6F0000A1B2C3', cache)
+    if capabilities.supports_attribute(0x0008, 0x0011):
+        ...
+'''
+import os
+import json
+import time
+import tempfile
+import threading
+
+from zcl import ZCLAttribute, default_cache_dir
+from zigbee import AsyncZBController, UnsupportedError, gather
+
+BASIC_CLUSTER = 0x0000
+
+# manufacturer name, model identifier, application version, SW build ID
+VERSION_ATTRIBUTES = (0x0004, 0x0005, 0x0001, 0x4000)
+
+class SimpleDescriptor(object):
+    '''
+    One endpoint of a device: its profile and device IDs and version, and
+    its input (server) and output (client) cluster codes.
+    '''
+    __slots__ = ('endpoint', 'profile_id', 'device_id', 'device_version',
+            'input_clusters', 'output_clusters')
+
+    def __init__(self, endpoint, profile_id, device_id, device_version,
+            input_clusters, output_clusters):
+        self.endpoint = endpoint
+        self.profile_id = profile_id
+        self.device_id = device_id
+        self.device_version = device_version
+        self.input_clusters = list(input_clusters)
+        self.output_clusters = list(output_clusters)
+
+    def __repr__(self):
+        return 'SimpleDescriptor(%d, profile 0x%04X, device 0x%04X)' % (
+                self.endpoint, self.profile_id, self.device_id)
+
+class DeviceCapabilities:
+    '''
+    What a device supports. endpoints is the list of its SimpleDescriptors,
+    attributes maps the code of each cluster whose attributes were
+    discovered to a dictionary of attribute ID -> type code, and commands
+    maps the code of each cluster whose commands were discovered to the set
+    of command IDs the device accepts. Clusters missing from attributes or
+    commands haven't been discovered, for instance because the device
+    doesn't support discovery, so nothing is assumed about them.
+
+    >>> capabilities = DeviceCapabilities()
+    >>> capabilities.endpoints = [SimpleDescriptor(1, 0x0104, 0x0100,
+    ...         0, [0x0000, 0x0006], [0x0019]),
+    ...     SimpleDescriptor(2, 0x0104, 0x0302, 0, [0x0402], [])]
+    >>> capabilities.commands[0x0006] = set([0x00, 0x01, 0x02])
+    >>> capabilities.check(0x0402, 0x00, 0x00)
+    2
+    >>> capabilities.check(0x0006, 0x01, 0x40)
+    Traceback (most recent call last):
+    ...
+    UnsupportedError: device doesn't accept command 0x40 of cluster 0x0006
+    >>> capabilities.supports_attribute(0x0006, 0x0000) is None
+    True
+    '''
+    def __init__(self, ieee_address=None, version=None):
+        self.ieee_address = ieee_address
+        self.version = version
+        self.endpoints = []
+        self.attributes = {}
+        self.commands = {}
+        self.discovered = time.time()
+
+    def __repr__(self):
+        return 'DeviceCapabilities(%s, endpoints %s)' % (self.ieee_address,
+                [descriptor.endpoint for descriptor in self.endpoints])
+
+    def endpoint_for(self, cluster_code, server=True):
+        '''
+        Returns the first endpoint with the given server cluster, or client
+        cluster when server is False, or None if there's none.
+        '''
+        for descriptor in self.endpoints:
+            if server:
+                clusters = descriptor.input_clusters
+            else:
+                clusters = descriptor.output_clusters
+            if cluster_code in clusters:
+                return descriptor.endpoint
+        return None
+
+    def server_clusters(self):
+        clusters = []
+        for descriptor in self.endpoints:
+            for cluster_code in descriptor.input_clusters:
+                if cluster_code not in clusters:
+                    clusters.append(cluster_code)
+        return clusters
+
+    def supports_cluster(self, cluster_code, server=True):
+        return self.endpoint_for(cluster_code, server) is not None
+
+    def supports_attribute(self, cluster_code, attribute_id):
+        '''
+        Returns whether the device has the attribute, or None if its
+        cluster's attributes weren't discovered.
+        '''
+        if not self.supports_cluster(cluster_code):
+            return False
+        if cluster_code not in self.attributes:
+            return None
+        return attribute_id in self.attributes[cluster_code]
+
+    def supports_command(self, cluster_code, code):
+        '''
+        Returns whether the device accepts the cluster specific command, or
+        None if its cluster's commands weren't discovered.
+        '''
+        if not self.supports_cluster(cluster_code):
+            return False
+        if cluster_code not in self.commands:
+            return None
+        return code in self.commands[cluster_code]
+
+    def check(self, cluster_code, frame_control, code):
+        '''
+        Returns the endpoint to send a ZCL frame to, or raises an
+        UnsupportedError if the device doesn't have its cluster, or doesn't
+        accept its command.
+        '''
+        # frames from a server go to the device's client cluster
+        server = not frame_control & 0x08
+        endpoint = self.endpoint_for(cluster_code, server)
+        if endpoint is None:
+            raise UnsupportedError("device has no %s cluster 0x%04X" % (
+                'server' if server else 'client', cluster_code))
+        if (frame_control & 0x01 and server and
+                self.supports_command(cluster_code, code) is False):
+            raise UnsupportedError("device doesn't accept command 0x%02X of "
+                    "cluster 0x%04X" % (code, cluster_code))
+        return endpoint
+
+    def to_json(self):
+        return json.dumps({'ieee': self.ieee_address,
+            'version': self.version, 'discovered': self.discovered,
+            'endpoints': [[descriptor.endpoint, descriptor.profile_id,
+                descriptor.device_id, descriptor.device_version,
+                descriptor.input_clusters, descriptor.output_clusters]
+                for descriptor in self.endpoints],
+            'attributes': [[cluster_code, sorted(attributes.items())]
+                for cluster_code, attributes in self.attributes.items()],
+            'commands': [[cluster_code, sorted(codes)]
+                for cluster_code, codes in self.commands.items()]})
+
+    @classmethod
+    def from_json(cls, text):
+        entry = json.loads(text)
+        capabilities = cls(entry['ieee'], entry['version'])
+        capabilities.discovered = entry['discovered']
+        capabilities.endpoints = [SimpleDescriptor(*descriptor)
+                for descriptor in entry['endpoints']]
+        for cluster_code, attributes in entry['attributes']:
+            capabilities.attributes[cluster_code] = dict([(attribute_id,
+                type_code) for attribute_id, type_code in attributes])
+        for cluster_code, codes in entry['commands']:
+            capabilities.commands[cluster_code] = set(codes)
+        return capabilities
+
+class CapabilityCache:
+    '''
+    DeviceCapabilities kept on disk, as a JSON file per IEEE address in the
+    given directory (capabilities in the zcl module's cache directory by
+    default), and in memory once read. It can be shared by controllers and
+    threads.
+    '''
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(default_cache_dir, 'capabilities')
+        self.directory = directory
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def _path(self, ieee_address):
+        return os.path.join(self.directory, ieee_address + '.json')
+
+    def get(self, ieee_address, version=None):
+        '''
+        Returns the capabilities stored for the device, or None. When a
+        version is given and the stored one differs, they're removed too.
+        '''
+        ieee_address = ieee_address.upper()
+        with self._lock:
+            capabilities = self._memory.get(ieee_address)
+            if capabilities is None:
+                try:
+                    with open(self._path(ieee_address)) as cached:
+                        capabilities = DeviceCapabilities.from_json(
+                                cached.read())
+                except Exception:
+                    # missing or corrupt, so it has to be discovered
+                    return None
+                self._memory[ieee_address] = capabilities
+        if version is not None and capabilities.version != version:
+            self.remove(ieee_address)
+            return None
+        return capabilities
+
+    def put(self, capabilities):
+        ieee_address = capabilities.ieee_address.upper()
+        with self._lock:
+            self._memory[ieee_address] = capabilities
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                # write to a temporary file first so a concurrent reader
+                # never sees a partial file
+                fd, temp_path = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, 'w') as cached:
+                    cached.write(capabilities.to_json())
+                os.rename(temp_path, self._path(ieee_address))
+            except (IOError, OSError):
+                # the cache is only an optimization
+                pass
+
+    def remove(self, ieee_address):
+        ieee_address = ieee_address.upper()
+        with self._lock:
+            self._memory.pop(ieee_address, None)
+            try:
+                os.remove(self._path(ieee_address))
+            except OSError:
+                pass
+
+def read_version(controller, node_id, attributes=VERSION_ATTRIBUTES,
+        timeout=10):
+    '''
+    Reads the given Basic cluster attributes from a device, and completes
+    with the list of their values, with None for those it doesn't have.
+    '''
+    requested = [_basic_attribute(attribute_id) for attribute_id in attributes]
+    def decode(records):
+        values = []
+        for attribute in requested:
+            record = records.get(attribute)
+            value = None
+            if record is not None and record.status == 0x00:
+                value = record.value
+            if isinstance(value, str):
+                # as it comes back from JSON
+                value = value.decode('latin-1')
+            values.append(value)
+        return values
+    return AsyncZBController.read_attributes(controller, node_id, requested,
+            timeout).then(decode)
+
+def _basic_attribute(attribute_id):
+    '''
+    A Basic cluster attribute to read, which the controller's model may not
+    have.
+    '''
+    attribute = ZCLAttribute(BASIC_CLUSTER)
+    attribute.code = attribute_id
+    attribute.name = 'Basic attribute 0x%04X' % attribute_id
+    return attribute
+
+def discover(target, node_id, ieee_address=None, cache=None, clusters=None,
+        timeout=10):
+    '''
+    Returns the DeviceCapabilities of a device, and sets them on its
+    controller. target is the device's controller or a ZBControllerPool.
+    With a cache and the device's IEEE address, capabilities stored for the
+    same version are used without discovering them again. clusters limits
+    the server clusters whose attributes and commands are discovered.
+    '''
+    if hasattr(target, 'controller_for'):
+        controller = target.controller_for(node_id)
+    else:
+        controller = target
+    controller.capabilities.pop(node_id, None)
+    if cache is not None and ieee_address is not None:
+        cached = cache.get(ieee_address)
+        if cached is not None:
+            # route the version read the way the device was last time
+            controller.capabilities[node_id] = cached
+            try:
+                if _version(controller, node_id, timeout) == cached.version:
+                    return cached
+            except AssertionError:
+                # no answer, so find out where the device went
+                pass
+            controller.capabilities.pop(node_id)
+            cache.remove(ieee_address)
+    capabilities = DeviceCapabilities(ieee_address)
+    endpoints = AsyncZBController.active_endpoints(controller, node_id,
+            timeout).result()
+    for event in gather([AsyncZBController.simple_descriptor(controller,
+            node_id, endpoint, timeout) for endpoint in endpoints]):
+        capabilities.endpoints.append(SimpleDescriptor(event.endpoint,
+            event.profile_id, event.device_id, event.device_version,
+            event.input_clusters, event.output_clusters))
+    controller.capabilities[node_id] = capabilities
+    if clusters is None:
+        clusters = capabilities.server_clusters()
+    clusters = [cluster_code for cluster_code in clusters
+            if capabilities.supports_cluster(cluster_code)]
+    # the discoveries all go out at once
+    attributes = [AsyncZBController.discover_attributes(controller, node_id,
+        cluster_code, timeout) for cluster_code in clusters]
+    commands = [AsyncZBController.discover_commands_received(controller,
+        node_id, cluster_code, timeout) for cluster_code in clusters]
+    capabilities.version = _version(controller, node_id, timeout)
+    for cluster_code, discovered in zip(clusters, attributes):
+        try:
+            capabilities.attributes[cluster_code] = dict(discovered.result())
+        except AssertionError:
+            # left undiscovered, rather than taken to have no attributes
+            pass
+    for cluster_code, discovered in zip(clusters, commands):
+        try:
+            capabilities.commands[cluster_code] = set(discovered.result())
+        except AssertionError:
+            pass
+    capabilities.discovered = time.time()
+    if cache is not None and ieee_address is not None:
+        cache.put(capabilities)
+    return capabilities
+
+def _version(controller, node_id, timeout):
+    try:
+        return read_version(controller, node_id, timeout=timeout).result()
+    except UnsupportedError:
+        # no Basic cluster to read it from
+        return None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,212 @@
+'''
+Parser for the lines printed by the Ember CLI.
+
+Every line shape the library cares about is matched by a single precompiled
+regex, so each line is scanned once, and turned into either an RXFrame (for
+received ZCL frames) or a CLIEvent whose kind and fields callers can match
+on directly.
+'''
+import re
+
+class RXFrame:
+    '''
+    A ZCL frame received by the controller, parsed once from the "RX len ..."
+    line printed by the Ember CLI. The payload is a bytearray, to be decoded
+    in place with the codecs from the codec module.
+
+    The CLI doesn't print the sender's node ID, so source is only filled in
+    when the frame answers a request we sent (matched by sequence number).
+    '''
+    kind = 'rx'
+
+    def __init__(self, endpoint, cluster_code, frame_control, sequence, code,
+            payload, source=None, cluster_name=None, manufacturer_code=None):
+        self.endpoint = endpoint
+        self.cluster_code = cluster_code
+        self.frame_control = frame_control
+        self.sequence = sequence
+        self.code = code
+        self.payload = payload
+        self.source = source
+        self.cluster_name = cluster_name
+        self.manufacturer_code = manufacturer_code
+
+    def is_cluster_specific(self):
+        return bool(self.frame_control & 0x01)
+
+    def is_from_server(self):
+        return bool(self.frame_control & 0x08)
+
+    def __repr__(self):
+        return 'RXFrame(clus 0x%04X, FC %02X, seq %02X, cmd %02X, [%s])' % (
+                self.cluster_code, self.frame_control, self.sequence,
+                self.code, ' '.join(['%02X' % x for x in self.payload]))
+
+class CLIEvent:
+    '''
+    Any other line we recognize, such as a network or ZDO status. kind names
+    the line shape, and the parsed fields are Python attributes:
+
+    ======================  =================================================
+    kind                    fields
+    ======================  =================================================
+    'network'               operation ('form' or 'leave'), status
+    'pjoin'                 duration (seconds), status
+    'network_down'
+    'zdo'                   command, status
+    'announce'              node_id, ieee_address (16 hex digits, or None
+                            when the CLI doesn't print it)
+    'active_endpoints'      node_id, status, endpoints (list)
+    'simple_descriptor'     node_id, status, endpoint, profile_id, device_id,
+                            device_version, input_clusters and
+                            output_clusters (lists); all but the endpoint
+                            are None when the status isn't SUCCESS
+    'read_attr_resp'        cluster_name
+    'read_attr_status'      attribute_code, status
+    'read_attr_value'       type_code, value (bytearray, as printed)
+    ======================  =================================================
+    '''
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.fields = fields
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return 'CLIEvent(%s)' % ', '.join([repr(self.kind)] +
+            ['%s=%r' % item for item in sorted(self.fields.items())])
+
+# lines may start with a timestamp (T000BD5C5:) or a CLI prompt (ha_gw>)
+_line_re = re.compile(r'(?:T[0-9A-F]+:|[\w-]*>)?(?:' + '|'.join([
+    #RX len 11, ep 01, clus 0x000A (Time) FC 18 seq 20 cmd 01 payload[00 00 00 E2 00 00 00 00 ]
+    r'(?P<rx>RX len [0-9]+, ep (?P<ep>[0-9A-F]+), ' +
+        r'clus 0x(?P<cluster>[0-9A-F]{4}) \((?P<cluster_name>[^)]*)\) ' +
+        r'(?:mfgId (?P<mfg>[0-9A-F]{4}) )?' +
+        r'FC (?P<fc>[0-9A-F]{2}) seq (?P<seq>[0-9A-F]{2}) ' +
+        r'cmd (?P<cmd>[0-9A-F]{2}) payload\[(?P<payload>[0-9A-F ]*)\])',
+    #RX: ZDO, command 0x8021, status: 0x00
+    r'(?P<zdo>RX: ZDO, command 0x(?P<zdo_command>[0-9A-Fa-f]{4}), ' +
+        r'status: 0x(?P<zdo_status>[0-9A-Fa-f]{2}))',
+    #Device Announce: 0x3F21 (>)000D6F0000A1B2C3
+    r'(?P<announce>Device Announce: 0x(?P<announce_node>[0-9A-F]{4})' +
+        r'(?:,? +(?:EUI64:? *|ieee:? *)?(?:\(>\))?' +
+        r'(?P<announce_ieee>[0-9A-Fa-f]{16}))?)',
+    #Active Endpoints Response: 0x3F21, status 0x00, endpoints [01 02 ]
+    r'(?P<active_endpoints>Active Endpoints Response: ' +
+        r'0x(?P<active_node>[0-9A-F]{4}), status 0x(?P<active_status>' +
+        r'[0-9A-F]{2}), endpoints \[(?P<active_list>[0-9A-F ]*)\])',
+    #Simple Descriptor Response: 0x3F21, status 0x00, ep 01, profile 0x0104, device 0x0100, version 0, in [0000 0006 ], out [0019 ]
+    r'(?P<simple_descriptor>Simple Descriptor Response: ' +
+        r'0x(?P<simple_node>[0-9A-F]{4}), status 0x(?P<simple_status>' +
+        r'[0-9A-F]{2}), ep (?P<simple_ep>[0-9A-F]{2})' +
+        r'(?:, profile 0x(?P<profile>[0-9A-F]{4}), ' +
+        r'device 0x(?P<device>[0-9A-F]{4}), version (?P<version>[0-9]+), ' +
+        r'in \[(?P<in>[0-9A-F ]*)\], out \[(?P<out>[0-9A-F ]*)\])?)',
+    r'(?P<network>(?P<operation>form|leave) 0x(?P<network_status>[0-9A-F]{2}))',
+    r'(?P<pjoin>pJoin for (?P<duration>[0-9]+) sec: ' +
+        r'0x(?P<pjoin_status>[0-9A-F]{2}))',
+    r'(?P<network_down>EMBER_NETWORK_DOWN)',
+    #READ_ATTR_RESP: (Time)
+    #- attr:0000, status:00
+    #type:E2, val:00000000
+    r'(?P<read_attr_resp>READ_ATTR_RESP: \((?P<read_cluster_name>[^)]*)\))',
+    r'(?P<read_attr_status>- attr:(?P<read_attr>[0-9A-F]{4}), ' +
+        r'status:(?P<read_status>[0-9A-F]{2}))',
+    r'(?P<read_attr_value>type:(?P<read_type>[0-9A-F]{2}), ' +
+        r'val:(?P<read_value>[0-9A-F]*))',
+    ]) + r')\s*$')
+
+def _rx(match):
+    # fetching the groups in one call is noticeably faster for big logs
+    endpoint, cluster, fc, seq, cmd, payload, cluster_name, mfg = \
+            match.group('ep', 'cluster', 'fc', 'seq', 'cmd', 'payload',
+                    'cluster_name', 'mfg')
+    return RXFrame(int(endpoint, 16), int(cluster, 16), int(fc, 16),
+            int(seq, 16), int(cmd, 16), bytearray.fromhex(payload),
+            cluster_name=cluster_name,
+            manufacturer_code=int(mfg, 16) if mfg else None)
+
+def _hex_list(text):
+    return [int(token, 16) for token in text.split()]
+
+def _simple_descriptor(match):
+    profile, device, version, inputs, outputs = match.group('profile',
+            'device', 'version', 'in', 'out')
+    described = profile is not None
+    return CLIEvent('simple_descriptor',
+        node_id=int(match.group('simple_node'), 16),
+        status=int(match.group('simple_status'), 16),
+        endpoint=int(match.group('simple_ep'), 16),
+        profile_id=int(profile, 16) if described else None,
+        device_id=int(device, 16) if described else None,
+        device_version=int(version) if described else None,
+        input_clusters=_hex_list(inputs) if described else None,
+        output_clusters=_hex_list(outputs) if described else None)
+
+_builders = {
+    'rx': _rx,
+    'zdo': lambda match: CLIEvent('zdo',
+        command=int(match.group('zdo_command'), 16),
+        status=int(match.group('zdo_status'), 16)),
+    'announce': lambda match: CLIEvent('announce',
+        node_id=int(match.group('announce_node'), 16),
+        ieee_address=(match.group('announce_ieee') or '').upper() or None),
+    'active_endpoints': lambda match: CLIEvent('active_endpoints',
+        node_id=int(match.group('active_node'), 16),
+        status=int(match.group('active_status'), 16),
+        endpoints=_hex_list(match.group('active_list'))),
+    'simple_descriptor': _simple_descriptor,
+    'network': lambda match: CLIEvent('network',
+        operation=match.group('operation'),
+        status=int(match.group('network_status'), 16)),
+    'pjoin': lambda match: CLIEvent('pjoin',
+        duration=int(match.group('duration')),
+        status=int(match.group('pjoin_status'), 16)),
+    'network_down': lambda match: CLIEvent('network_down'),
+    'read_attr_resp': lambda match: CLIEvent('read_attr_resp',
+        cluster_name=match.group('read_cluster_name')),
+    'read_attr_status': lambda match: CLIEvent('read_attr_status',
+        attribute_code=int(match.group('read_attr'), 16),
+        status=int(match.group('read_status'), 16)),
+    'read_attr_value': lambda match: CLIEvent('read_attr_value',
+        type_code=int(match.group('read_type'), 16),
+        value=bytearray.fromhex(match.group('read_value'))),
+}
+
+def parse_line(line):
+    '''
+    Parses one line of CLI output into an RXFrame or CLIEvent, or returns
+    None for lines we don't recognize.
+
+    >>> frame = parse_line('T000BD5C5:RX len 5, ep 01, clus 0x0020 ' +
+    ...         '(Unknown clus. [0x0020]) FC 18 seq D3 cmd 0B payload[03 00 ]')
+    >>> frame.cluster_code, frame.sequence, frame.code, list(frame.payload)
+    (32, 211, 11, [3, 0])
+    >>> frame.cluster_name
+    'Unknown clus. [0x0020]'
+    >>> parse_line('RX: ZDO, command 0x8021, status: 0x00')
+    CLIEvent('zdo', command=32801, status=0)
+    >>> parse_line('Device Announce: 0x3F21 (>)000D6F0000A1B2C3')
+    CLIEvent('announce', ieee_address='000D6F0000A1B2C3', node_id=16161)
+    >>> parse_line('Active Endpoints Response: 0x3F21, status 0x00, '
+    ...         'endpoints [01 02 ]')
+    CLIEvent('active_endpoints', endpoints=[1, 2], node_id=16161, status=0)
+    >>> event = parse_line('Simple Descriptor Response: 0x3F21, status 0x00, '
+    ...         'ep 01, profile 0x0104, device 0x0100, version 0, '
+    ...         'in [0000 0006 ], out [0019 ]')
+    >>> event.profile_id, event.input_clusters, event.output_clusters
+    (260, [0, 6], [25])
+    >>> parse_line('pJoin for 255 sec: 0x00')
+    CLIEvent('pjoin', duration=255, status=0)
+    >>> parse_line('- attr:0000, status:00')
+    CLIEvent('read_attr_status', attribute_code=0, status=0)
+    >>> parse_line('network form 19 0 0xfafa') is None
+    True
+    '''
+    match = _line_re.match(line)
+    if match is None:
+        return None
+    return _builders[match.lastgroup](match)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,146 @@
+'''
+Reads the frames out of captured Ember CLI logs, however large.
+
+The log is memory-mapped rather than read, and only the lines holding an
+"RX len ..." frame are handed to embercli's parser, so a file of any size is
+scanned with the same few pages of memory. Lines can carry any prefix, such
+as the CLI's own T000BD5C5: timestamps or the "0.041330 RX " that
+transport.RecordingTransport writes, and the time is taken from it when it
+has one.
+
+To use every core, map_chunks splits a file at line boundaries and scans the
+chunks in a pool of processes:
+
+    totals = sum(map_chunks(count_frames, 'gateway.log'),
+            collections.Counter())
+'''
+import os
+import mmap
+import collections
+import multiprocessing
+
+from embercli import parse_line
+
+_marker = 'RX len '
+
+def iter_frames(filename, start=0, end=None):
+    '''
+    Yields (timestamp, RXFrame) for each frame logged between the given byte
+    offsets, which should fall on line boundaries. timestamp is in seconds,
+    or None if the line doesn't start with one. Lines cut short or otherwise
+    garbled are skipped.
+
+    >>> import tempfile
+    >>> log = tempfile.NamedTemporaryFile(suffix='.log')
+    >>> log.write('T000BD5C5:RX len 5, ep 01, clus 0x0020 (Unknown clus. '
+    ...         '[0x0020]) FC 18 seq D3 cmd 0B payload[03 00 ]\\n'
+    ...         'pJoin for 255 sec: 0x00\\n'
+    ...         '0.041330 RX RX len 4, ep 01, clus 0x0006 (On/off) FC 18 '
+    ...         'seq 01 cmd 0A payload[00 00 10 01 ]\\n'
+    ...         'RX len 4, ep 01, clus 0x0006 (On/of\\n')
+    >>> log.flush()
+    >>> for timestamp, frame in iter_frames(log.name):
+    ...     print timestamp, frame
+    775.621 RXFrame(clus 0x0020, FC 18, seq D3, cmd 0B, [03 00])
+    0.04133 RXFrame(clus 0x0006, FC 18, seq 01, cmd 0A, [00 00 10 01])
+    '''
+    with open(filename, 'rb') as log:
+        if os.fstat(log.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if end is None:
+            end = len(data)
+        position = data.find(_marker, start, end)
+        while position != -1:
+            line_start = data.rfind('\n', start, position) + 1
+            line_end = data.find('\n', position, end)
+            if line_end == -1:
+                line_end = end
+            frame = parse_line(data[position:line_end])
+            if frame is not None:
+                yield _timestamp(data[line_start:position]), frame
+            position = data.find(_marker, line_end, end)
+    finally:
+        data.close()
+
+def decode_frames(filename, model, start=0, end=None):
+    '''
+    Yields (timestamp, RXFrame, ZCLCommandCall) for each frame logged, with
+    the command decoded from the frame by the zcl.ZCL model. The command is
+    None when it isn't in the model or its payload doesn't decode.
+    '''
+    for timestamp, frame in iter_frames(filename, start, end):
+        try:
+            command = model.decode_frame(frame)
+        except Exception:
+            command = None
+        yield timestamp, frame, command
+
+def _timestamp(prefix):
+    prefix = prefix.strip()
+    if prefix.startswith('T') and prefix.endswith(':'):
+        # the CLI's millisecond tick, in hex
+        try:
+            return int(prefix[1:-1], 16) / 1000.0
+        except ValueError:
+            return None
+    try:
+        return float(prefix.split(' ', 1)[0])
+    except ValueError:
+        return None
+
+def split_chunks(filename, chunk_size=64 << 20):
+    '''
+    Returns the (start, end) byte offsets of chunks of about chunk_size
+    bytes covering the file, each starting at the beginning of a line.
+    '''
+    chunks = []
+    with open(filename, 'rb') as log:
+        size = os.fstat(log.fileno()).st_size
+        start = 0
+        while start < size:
+            log.seek(min(start + chunk_size, size))
+            # finish the line the chunk's end falls in
+            log.readline()
+            end = min(log.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def _scan_chunk(args):
+    function, filename, start, end = args
+    return function(iter_frames(filename, start, end))
+
+def map_chunks(function, filename, processes=None, chunk_size=64 << 20):
+    '''
+    Calls function with the iter_frames of each chunk of the file, in a
+    pool of processes (one per core by default), and yields what it returns
+    for each chunk, in order. function has to be defined at the top level of
+    a module so it can be sent to the other processes, and should reduce
+    its frames to something small, like count_frames does.
+    '''
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(_scan_chunk, [(function, filename, start, end)
+                for start, end in split_chunks(filename, chunk_size)]):
+            yield result
+    finally:
+        pool.terminate()
+
+def count_frames(frames):
+    '''
+    Counts frames by (cluster code, command code).
+
+    >>> from embercli import RXFrame
+    >>> count_frames([(None, RXFrame(1, 6, 0x18, 1, 0x0A, bytearray()))])
+    Counter({(6, 10): 1})
+    '''
+    counts = collections.Counter()
+    for _, frame in frames:
+        counts[(frame.cluster_code, frame.code)] += 1
+    return counts
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
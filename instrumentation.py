@@ -0,0 +1,174 @@
+'''
+Timing and counting of the operations a controller runs.
+
+Once a controller's instrumentation is enabled, every operation that waits
+for a response is timed from the command being written to the response
+arriving, and recorded by operation name, device and cluster. Latencies go
+into Histograms, and each operation is counted by outcome:
+
+    ==========  ============================================================
+    outcome
+    ==========  ============================================================
+    'ok'        the response came back with a SUCCESS status
+    'status'    the response came back with another status
+    'error'     the operation failed, for instance a response didn't match
+    'timeout'   the caller gave up waiting for the response
+    ==========  ============================================================
+
+Received frames nobody was waiting for are counted as 'unmatched'. Hooks
+are called with each record, to feed another metrics system.
+'''
+import bisect
+import threading
+import collections
+
+class Histogram(object):
+    '''
+    Counts of latencies in buckets that grow by a factor of sqrt(2), from
+    1 ms to about a minute, so percentiles are accurate to within 41%
+    whatever the scale.
+
+    >>> histogram = Histogram()
+    >>> for ms in [3, 5, 8, 20, 400]:
+    ...     histogram.add(ms / 1000.0)
+    >>> histogram.count, round(histogram.percentile(50), 4)
+    (5, 0.008)
+    '''
+    bounds = tuple([0.001 * 2 ** (i / 2.0) for i in xrange(33)])
+
+    __slots__ = ('counts', 'count', 'total', 'minimum', 'maximum')
+
+    def __init__(self):
+        # the last bucket counts everything beyond the largest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        if not other.count:
+            return
+        if not self.count:
+            self.minimum, self.maximum = other.minimum, other.maximum
+        else:
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        '''
+        Returns an upper bound for the given percentile, which is the top of
+        the bucket it falls in, but never more than the largest latency.
+        '''
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.maximum)
+                break
+        return self.maximum
+
+    def __repr__(self):
+        if not self.count:
+            return 'Histogram(empty)'
+        return 'Histogram(n=%d, mean=%.1f ms, p50=%.1f ms, p99=%.1f ms, ' \
+                'max=%.1f ms)' % (self.count, 1000 * self.mean(),
+                        1000 * self.percentile(50),
+                        1000 * self.percentile(99), 1000 * self.maximum)
+
+class Instrumentation:
+    '''
+    The histograms and counters for one or more controllers. Both are keyed
+    by (operation, node ID, cluster code), and histogram() and count() add
+    up the ones matching whichever of those are given.
+
+    Each hook is called as hook(operation, node ID, cluster code, seconds,
+    outcome, status) on the thread that saw the response, so it should
+    return quickly. seconds and status are None when not known.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def record(self, operation, node, cluster_code, seconds, outcome,
+            status=None):
+        key = (operation, node, cluster_code)
+        with self._lock:
+            if seconds is not None and outcome != 'timeout':
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.add(seconds)
+            self.counters[(outcome,) + key] += 1
+        for hook in self.hooks:
+            hook(operation, node, cluster_code, seconds, outcome, status)
+
+    def unmatched(self, frame):
+        self.record('rx', frame.source, frame.cluster_code, None,
+                'unmatched')
+
+    def histogram(self, operation=None, node=None, cluster_code=None):
+        merged = Histogram()
+        with self._lock:
+            for key, histogram in self.histograms.items():
+                if _key_matches(key, operation, node, cluster_code):
+                    merged.merge(histogram)
+        return merged
+
+    def count(self, outcome, operation=None, node=None, cluster_code=None):
+        with self._lock:
+            return sum([count for key, count in self.counters.items()
+                if key[0] == outcome and
+                _key_matches(key[1:], operation, node, cluster_code)])
+
+    def summary(self):
+        '''
+        Returns a table of the latencies and outcomes of each operation.
+        '''
+        operations = sorted(set([key[1] for key in self.counters]))
+        lines = ['%-22s %7s %9s %9s %9s %7s %7s %7s %9s' % ('operation',
+            'count', 'p50 ms', 'p99 ms', 'max ms', 'status', 'error',
+            'timeout', 'unmatched')]
+        for operation in operations:
+            histogram = self.histogram(operation)
+            latencies = ['%9s' % '-'] * 3
+            if histogram.count:
+                latencies = ['%9.1f' % (1000 * value) for value in [
+                    histogram.percentile(50), histogram.percentile(99),
+                    histogram.maximum]]
+            counts = [self.count(outcome, operation) for outcome in
+                    ['ok', 'status', 'error', 'timeout', 'unmatched']]
+            lines.append('%-22s %7d %s %7d %7d %7d %9d' % ((operation,
+                sum(counts)) + (' '.join(latencies),) + tuple(counts[1:])))
+        return '\n'.join(lines)
+
+def _key_matches(key, operation, node, cluster_code):
+    return ((operation is None or key[0] == operation) and
+            (node is None or key[1] == node) and
+            (cluster_code is None or key[2] == cluster_code))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,229 @@
+'''
+Runs one test script against a whole batch of devices at once.
+
+The devices under test are listed in a roster, multidevice.cfg by default,
+with a section per device next to the gateways they joined through:
+
+    [controller]
+    controller_ips = 10.0.0.20, 10.0.0.21
+
+    [device dut01]
+    node_id = 0x3F21
+    ieee_address = 000D6F0000A1B2C3
+    controller_ip = 10.0.0.20
+
+    [device dut02]
+    node_id = 0x8A4C
+    settle_delay = 0.5
+
+controller_ip can be left out when there's only one gateway. Each device's
+test runs on its own thread, against a DeviceUnderTest with the same
+methods as SingleDeviceTester, and all the devices share their gateway's
+connection, so a batch takes about as long as its slowest device.
+'''
+import time
+import threading
+import traceback
+from ConfigParser import RawConfigParser
+
+from pool import ZBControllerPool
+from singledevicetester import DeviceCommands
+from zigbee import AsyncZBController
+
+class DeviceUnderTest(DeviceCommands):
+    '''
+    One device in the batch, and the SingleDeviceTester methods targeting
+    it through its gateway's controller.
+
+    The Ember CLI doesn't print who sent a frame, so a command a device
+    sends unprompted can't be told apart from the same command sent by
+    another device on the same gateway. expect_zcl_command only lets one
+    device at a time wait for a given cluster and command on each gateway,
+    and the others queue up for it, within their own timeouts. That keeps
+    two devices from taking the same frame, but not from taking each
+    other's: if device B sends the command unprompted while device A waits
+    for it, A's expect_zcl_command is satisfied by B's frame. Tests that
+    expect unsolicited commands are only reliable when the other devices on
+    the gateway don't send the same command at the same time. Responses to
+    the commands sent to a device match on sequence number and cluster too,
+    so only such a frame with the same sequence number is taken for one.
+    '''
+    def __init__(self, name, node_id, ieee_address=None, settle_delay=0):
+        self.name = name
+        self.node_id = node_id
+        self.dut_node_id = node_id
+        self.dut_ieee_address = ieee_address
+        self.settle_delay = settle_delay
+        self.controller = None
+        self.tester = None
+
+    def __repr__(self):
+        return 'DeviceUnderTest(%s, 0x%04X)' % (self.name, self.node_id)
+
+    def _dut_controller(self):
+        return self.controller
+
+    def _expect_zcl_command(self, command, timeout, source):
+        deadline = time.time() + timeout
+        key = (self.controller, command.cluster_code, command.code)
+        self.tester._claim(key, self, deadline, command.name)
+        try:
+            AsyncZBController.expect_zcl_command(self.controller, command,
+                    max(deadline - time.time(), 0),
+                    source=source or self.node_id).result()
+        finally:
+            self.tester._release(key)
+
+class DeviceResult:
+    '''
+    How one device's test went. error is the exception the test raised, or
+    None if it passed, and value is whatever the test returned.
+    '''
+    def __init__(self, device):
+        self.device = device
+        self.passed = False
+        self.value = None
+        self.error = None
+        self.traceback = None
+        self.started = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return 'DeviceResult(%s, %s)' % (self.device.name,
+                'passed' if self.passed else 'failed: %r' % self.error)
+
+class MultiDeviceTester:
+    '''
+    A batch of devices under test and the gateways they're on. run() calls
+    a test with each DeviceUnderTest on its own thread, and returns their
+    DeviceResults in roster order.
+
+    >>> tester = MultiDeviceTester() # doctest: +SKIP
+    >>> def test_on_off(dut):
+    ...     dut.send_zcl_command(z.on_off.toggle())
+    ...     assert dut.read_attribute(z.on_off.on_off) == 1
+    >>> results = tester.run(test_on_off) # doctest: +SKIP
+    >>> print tester.summary(results) # doctest: +SKIP
+
+    pool can be an existing ZBControllerPool, for instance of controllers
+    talking to a simulator. The roster's gateways are then looked up in it
+    by hostname rather than connected to.
+    '''
+    def __init__(self, roster='multidevice.cfg', pool=None):
+        self.pool = pool or ZBControllerPool()
+        self.devices = []
+        # (controller, cluster code, command code) -> device waiting for it
+        self._claims = {}
+        self._claims_changed = threading.Condition()
+        if roster is not None:
+            self.load_roster(roster)
+
+    def load_roster(self, filename):
+        config = RawConfigParser()
+        config.read(filename)
+        if config.has_option('controller', 'controller_ips'):
+            for hostname in config.get('controller',
+                    'controller_ips').split(','):
+                self._controller(hostname.strip())
+        for section in config.sections():
+            if not section.startswith('device '):
+                continue
+            options = dict(config.items(section))
+            self.add_device(section[len('device '):].strip(),
+                    int(options['node_id'], 0),
+                    options.get('ieee_address'),
+                    options.get('controller_ip'),
+                    float(options.get('settle_delay') or 0))
+
+    def _controller(self, hostname):
+        for controller in self.pool.controllers:
+            if controller.hostname == hostname:
+                return controller
+        return self.pool.open(hostname)
+
+    def add_device(self, name, node_id, ieee_address=None,
+            controller_ip=None, settle_delay=0):
+        '''
+        Adds a device to the batch. controller_ip names its gateway, and can
+        be left out when the pool has only one.
+        '''
+        if controller_ip is not None:
+            controller = self._controller(controller_ip)
+        elif len(self.pool.controllers) == 1:
+            controller = self.pool.controllers[0]
+        else:
+            raise ValueError('no controller_ip given for %s, and there are '
+                    '%d gateways' % (name, len(self.pool.controllers)))
+        self.pool.assign(node_id, controller)
+        device = DeviceUnderTest(name, node_id, ieee_address, settle_delay)
+        device.controller = controller
+        device.tester = self
+        self.devices.append(device)
+        return device
+
+    def close(self):
+        self.pool.close()
+
+    def _claim(self, key, device, deadline, name):
+        with self._claims_changed:
+            while self._claims.get(key) not in [None, device]:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AssertionError('TIMED OUT waiting for ' + name)
+                self._claims_changed.wait(remaining)
+            self._claims[key] = device
+
+    def _release(self, key):
+        with self._claims_changed:
+            del self._claims[key]
+            self._claims_changed.notify_all()
+
+    def run(self, test, devices=None, timeout=None):
+        '''
+        Calls test(device) for each of the given devices (all of them by
+        default) at once, and waits for them all to finish, or for timeout
+        seconds. Tests still running then are reported as failed and left to
+        finish in the background.
+        '''
+        if devices is None:
+            devices = self.devices
+        results = [DeviceResult(device) for device in devices]
+        def run_one(result):
+            try:
+                result.value = test(result.device)
+                result.passed = True
+            except Exception as e:
+                result.error = e
+                result.traceback = traceback.format_exc()
+            result.elapsed = time.time() - result.started
+        threads = [threading.Thread(target=run_one, args=(result,),
+            name='zigbee-dut-%s' % result.device.name) for result in results]
+        deadline = time.time() + (timeout if timeout is not None else 1e9)
+        for thread, result in zip(threads, results):
+            thread.daemon = True
+            result.started = time.time()
+            thread.start()
+        for thread, result in zip(threads, results):
+            # joining in slices keeps the main thread interruptible
+            while thread.is_alive() and time.time() < deadline:
+                thread.join(min(1, max(deadline - time.time(), 0)))
+            if thread.is_alive():
+                result.error = AssertionError('TIMED OUT running test')
+                result.elapsed = time.time() - result.started
+        return results
+
+    def summary(self, results):
+        '''
+        Returns a table of each device's outcome and time, and the totals.
+        '''
+        lines = ['%-16s %-8s %-8s %9s  %s' % ('device', 'node', 'result',
+            'seconds', 'error')]
+        for result in results:
+            lines.append('%-16s 0x%04X   %-8s %9.2f  %s' % (
+                result.device.name, result.device.node_id,
+                'PASS' if result.passed else 'FAIL', result.elapsed or 0,
+                '' if result.error is None else repr(result.error)))
+        passed = len([result for result in results if result.passed])
+        lines.append('%d passed, %d failed' % (passed,
+            len(results) - passed))
+        return '\n'.join(lines)
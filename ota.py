@@ -0,0 +1,560 @@
+'''
+Serves ZigBee OTA upgrade images to devices from the host.
+
+An OTAImage parses an upgrade file's header once and memory-maps the file,
+so blocks are sliced straight out of the page cache however many devices
+are downloading it. An OTAServer listens to one or more controllers for the
+OTA Upgrade cluster's client commands and answers them:
+
+    ========================  ===========================================
+    request                   answer
+    ========================  ===========================================
+    Query Next Image (0x01)   Query Next Image Response (0x02)
+    Image Block (0x03)        Image Block Response (0x05)
+    Image Page (0x04)         an Image Block Response every response
+                              spacing until the page is sent
+    Upgrade End (0x06)        Upgrade End Response (0x07), upgrade now
+    ========================  ===========================================
+
+Disable the gateway's own OTA server plugin, or give it no images, so the
+devices don't get two answers.
+
+The CLI doesn't print who sent a frame, so requests are matched to
+upgrade sessions by image and offset. Only one session per image and
+gateway is started at a time, until it's received its first block, after
+which the sessions are at different offsets. When two sessions could have
+sent the same block request both are answered, as the block is the same,
+and a request for a block every candidate was just sent is taken to be the
+other's, and skipped.
+
+    server = OTAServer()
+    image = server.add_image('light-2.1.ota')
+    sessions = server.upgrade_all(pool, nodes, image)
+    print server.summary()
+'''
+import time
+import os
+import mmap
+import heapq
+import struct
+import threading
+import traceback
+
+from codec import compile_payload
+from zigbee import Future
+
+OTA_CLUSTER = 0x0019
+FILE_IDENTIFIER = 0x0BEEF11E
+
+# OTA status codes
+SUCCESS = 0x00
+ABORT = 0x95
+INVALID_IMAGE = 0x96
+NO_IMAGE_AVAILABLE = 0x98
+
+# cluster specific, server to client, no default response
+_server_frame_control = 0x19
+
+_header = struct.Struct('<IHHHHHIH32sI')
+_image_notify = compile_payload(['INT8U', 'INT8U', 'INT16U', 'INT16U',
+    'INT32U'])
+_query_next_image_request = compile_payload(['INT8U', 'INT16U', 'INT16U',
+    'INT32U'])
+_query_next_image_response = compile_payload(['INT8U', 'INT16U', 'INT16U',
+    'INT32U', 'INT32U'])
+_image_block_request = compile_payload(['INT8U', 'INT16U', 'INT16U',
+    'INT32U', 'INT32U', 'INT8U'])
+_image_page_request = compile_payload(['INT8U', 'INT16U', 'INT16U',
+    'INT32U', 'INT32U', 'INT8U', 'INT16U', 'INT16U'])
+_image_block_response = compile_payload(['INT8U', 'INT16U', 'INT16U',
+    'INT32U', 'INT32U', 'INT8U'])
+_upgrade_end_request = compile_payload(['INT8U', 'INT16U', 'INT16U',
+    'INT32U'])
+_upgrade_end_response = compile_payload(['INT16U', 'INT16U', 'INT32U',
+    'UTC_TIME', 'UTC_TIME'])
+
+class OTAImage:
+    '''
+    A ZigBee OTA upgrade file, memory-mapped. The header's fields are
+    Python attributes, and size is the total image size, which is what's
+    sent to devices, header included.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as image_file:
+            # mmap can't map an empty file
+            if os.fstat(image_file.fileno()).st_size < _header.size:
+                raise InvalidImageError('%s is too short for an OTA header'
+                        % filename)
+            self.data = mmap.mmap(image_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        (identifier, self.header_version, self.header_length,
+                self.field_control, self.manufacturer_code, self.image_type,
+                self.file_version, self.stack_version, header_string,
+                self.size) = _header.unpack_from(self.data)
+        if identifier != FILE_IDENTIFIER:
+            raise InvalidImageError('%s is not an OTA upgrade file' %
+                    filename)
+        if self.size > len(self.data):
+            raise InvalidImageError('%s is cut short: %d of %d bytes' % (
+                filename, len(self.data), self.size))
+        self.header_string = header_string.rstrip('\0')
+
+    def key(self):
+        return (self.manufacturer_code, self.image_type, self.file_version)
+
+    def block(self, offset, size):
+        return self.data[offset:min(offset + size, self.size)]
+
+    def close(self):
+        self.data.close()
+
+    def __repr__(self):
+        return 'OTAImage(%s, mfg 0x%04X, type 0x%04X, version 0x%08X)' % (
+                self.header_string or self.filename, self.manufacturer_code,
+                self.image_type, self.file_version)
+
+class OTASession:
+    '''
+    One device's upgrade. state is one of:
+
+    ===============  ========================================================
+    'waiting'        queued behind another session starting on its gateway
+    'notified'       sent an Image Notify, waiting for Query Next Image
+    'downloading'    requesting blocks
+    'verifying'      has every block, waiting for its Upgrade End Request
+    'done'           told to upgrade
+    'current'        already runs this version or a newer one
+    'failed'         error says why
+    ===============  ========================================================
+
+    offset is how much of the image has been sent, and future completes
+    with the session once it's finished.
+    '''
+    def __init__(self, controller, node, image):
+        self.controller = controller
+        self.node = node
+        self.image = image
+        self.state = 'waiting'
+        self.status = None
+        self.error = None
+        # the image sent so far, and where the device last asked from
+        self.offset = 0
+        self.requested = 0
+        self.blocks_sent = 0
+        self.bytes_sent = 0
+        self.notifies = 0
+        self.queued = time.time()
+        self.started = None
+        self.notified = None
+        self.first_block = None
+        self.last_request = None
+        self.downloaded = None
+        self.finished = None
+        self.future = Future()
+
+    def progress(self):
+        return float(self.offset) / self.image.size
+
+    def throughput(self):
+        '''
+        Returns the bytes per second sent to the device while downloading.
+        '''
+        if self.first_block is None or self.last_request == self.first_block:
+            return None
+        return self.bytes_sent / ((self.downloaded or self.last_request) -
+                self.first_block)
+
+    def finished_ok(self):
+        return self.state in ['done', 'current']
+
+    def __repr__(self):
+        return 'OTASession(0x%04X, %s, %.0f%%)' % (self.node, self.state,
+                100 * self.progress())
+
+class OTAServer:
+    '''
+    Answers the OTA requests of the devices being upgraded through the
+    controllers it's attached to. Requests are handled, and answers sent,
+    on the server's own thread, as the gateway's reader thread mustn't
+    block.
+
+    block_size caps the data in each Image Block Response, below what the
+    devices ask for if need be. A notified device that hasn't asked for the
+    image after notify_timeout seconds is notified again, up to
+    notify_retries times, and a session that stops requesting blocks for
+    idle_timeout seconds fails. Requests for a block that every session that
+    could have sent them was sent less than duplicate_window seconds ago
+    are counted as duplicates and not answered.
+    '''
+    def __init__(self, block_size=64, notify_timeout=10, notify_retries=3,
+            idle_timeout=60, query_jitter=100, duplicate_window=0.5):
+        self.block_size = block_size
+        self.duplicate_window = duplicate_window
+        self.notify_timeout = notify_timeout
+        self.notify_retries = notify_retries
+        self.idle_timeout = idle_timeout
+        self.query_jitter = query_jitter
+        # (manufacturer code, image type, file version) -> OTAImage
+        self.images = {}
+        # (controller, node ID) -> OTASession
+        self.sessions = {}
+        self.unmatched = 0
+        self.ambiguous = 0
+        self.duplicates = 0
+        self.blocks_sent = 0
+        self.bytes_sent = 0
+        self._controllers = {}
+        # (controller, image, offset) -> (time, sessions) of blocks sent
+        self._recent = {}
+        self._timers = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def add_image(self, image):
+        '''
+        Makes an OTAImage, or the upgrade file with the given name,
+        available to devices, and returns it.
+        '''
+        if not isinstance(image, OTAImage):
+            image = OTAImage(image)
+        self.images[image.key()] = image
+        return image
+
+    def attach(self, controller):
+        '''
+        Starts answering OTA requests received through the controller. This
+        is done for you by upgrade().
+        '''
+        if controller in self._controllers:
+            return
+        def received(frame):
+            if (frame.cluster_code == OTA_CLUSTER and
+                    frame.is_cluster_specific() and
+                    not frame.is_from_server()):
+                self._call_later(0, lambda: self._handle(controller, frame))
+        self._controllers[controller] = received
+        controller.dispatcher.listeners.append(received)
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                        name='zigbee-ota')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def close(self):
+        for controller, received in self._controllers.items():
+            controller.dispatcher.listeners.remove(received)
+        self._controllers = {}
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def upgrade(self, controller, node, image):
+        '''
+        Starts upgrading a device to the image, and returns its OTASession.
+        '''
+        if not isinstance(image, OTAImage) or image.key() not in self.images:
+            image = self.add_image(image)
+        self.attach(controller)
+        session = OTASession(controller, node, image)
+        def queue():
+            previous = self.sessions.get((controller, node))
+            if previous is not None and not previous.future.done():
+                self._finish(previous, 'failed', error='replaced')
+            self.sessions[(controller, node)] = session
+            self._admit()
+        self._call_later(0, queue)
+        return session
+
+    def upgrade_all(self, target, nodes, image, timeout=None):
+        '''
+        Upgrades every device to the image at once, through target, which is
+        either a controller or a pool.ZBControllerPool, and waits up to
+        timeout seconds for them all to finish. Returns a dictionary mapping
+        each node ID to its OTASession.
+        '''
+        controller_for = getattr(target, 'controller_for', lambda node: target)
+        sessions = dict([(node, self.upgrade(controller_for(node), node,
+            image)) for node in nodes])
+        deadline = None if timeout is None else time.time() + timeout
+        for session in sessions.values():
+            remaining = None if deadline is None else max(
+                    deadline - time.time(), 0)
+            session.future.wait(remaining)
+        return sessions
+
+    def summary(self):
+        '''
+        Returns a table of every session's state, progress and throughput.
+        '''
+        lines = ['%-6s %-12s %8s %10s %10s  %s' % ('node', 'state',
+            'progress', 'bytes/s', 'seconds', 'error')]
+        for (_, node), session in sorted(self.sessions.items(),
+                key=lambda item: item[0][1]):
+            throughput = session.throughput()
+            elapsed = ((session.finished or time.time()) - session.started
+                    if session.started else 0)
+            lines.append('0x%04X %-12s %7.1f%% %10s %10.1f  %s' % (node,
+                session.state, 100 * session.progress(),
+                '-' if throughput is None else '%.0f' % throughput,
+                elapsed, session.error or ''))
+        states = {}
+        for session in self.sessions.values():
+            states[session.state] = states.get(session.state, 0) + 1
+        lines.append(', '.join(['%d %s' % (count, state)
+            for state, count in sorted(states.items())]) +
+            '; %d blocks, %d bytes sent, %d unmatched, %d ambiguous, '
+            '%d duplicates' % (self.blocks_sent, self.bytes_sent,
+                self.unmatched, self.ambiguous, self.duplicates))
+        return '\n'.join(lines)
+
+    # the server's thread
+
+    def _call_later(self, delay, function):
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._timers, (time.time() + delay, self._counter,
+                function))
+            self._condition.notify()
+
+    def _run(self):
+        next_sweep = 0
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = time.time()
+                    if self._timers and self._timers[0][0] <= now:
+                        function = heapq.heappop(self._timers)[2]
+                        break
+                    if now >= next_sweep:
+                        function = self._sweep
+                        next_sweep = now + 1
+                        break
+                    wait = next_sweep - now
+                    if self._timers:
+                        wait = min(self._timers[0][0] - now, wait)
+                    self._condition.wait(wait)
+                else:
+                    return
+            try:
+                function()
+            except Exception:
+                traceback.print_exc()
+
+    def _sweep(self):
+        now = time.time()
+        for key, (sent, _) in self._recent.items():
+            if now - sent > self.duplicate_window:
+                del self._recent[key]
+        for session in self.sessions.values():
+            if (session.state in ['downloading', 'verifying'] and
+                    now - session.last_request > self.idle_timeout):
+                self._finish(session, 'failed', error='timed out')
+            elif (session.state == 'notified' and
+                    now - session.notified > self.notify_timeout):
+                if session.notifies > self.notify_retries:
+                    self._finish(session, 'failed', error='no query')
+                else:
+                    self._notify(session)
+        self._admit()
+
+    def _admit(self):
+        '''
+        Starts the waiting sessions whose gateway isn't already starting a
+        session for the same image, oldest first.
+        '''
+        starting = set()
+        waiting = []
+        for session in self.sessions.values():
+            key = (session.controller, session.image)
+            if session.state == 'notified' or (session.state ==
+                    'downloading' and session.offset == 0):
+                starting.add(key)
+            elif session.state == 'waiting':
+                waiting.append((session.queued, session))
+        for _, session in sorted(waiting):
+            key = (session.controller, session.image)
+            if key not in starting:
+                starting.add(key)
+                session.started = time.time()
+                self._notify(session)
+
+    def _notify(self, session):
+        session.state = 'notified'
+        session.notifies += 1
+        session.notified = time.time()
+        image = session.image
+        session.controller.send_frame(session.node, OTA_CLUSTER,
+                _server_frame_control, 0x00, _image_notify.encode([0x03,
+                    self.query_jitter, image.manufacturer_code,
+                    image.image_type, image.file_version]))
+
+    def _finish(self, session, state, status=None, error=None):
+        session.state = state
+        session.status = status
+        session.error = error
+        session.finished = time.time()
+        session.future.set_result(session)
+        self._admit()
+
+    def _candidates(self, controller, image, offset):
+        return [session for session in self.sessions.values()
+                if session.controller is controller and
+                session.image is image and
+                session.state in ['downloading', 'verifying'] and
+                session.requested <= offset <= session.offset]
+
+    def _handle(self, controller, frame):
+        handler = self._handlers.get(frame.code)
+        if handler is None:
+            return
+        try:
+            values, _ = handler[0].decode(frame.payload)
+        except (IndexError, struct.error):
+            self.unmatched += 1
+            return
+        handler[1](self, controller, frame, values)
+
+    def _query_next_image(self, controller, frame, values):
+        _, manufacturer_code, image_type, current_version = values
+        candidates = [session for session in self.sessions.values()
+                if session.controller is controller and
+                session.state == 'notified' and
+                session.image.manufacturer_code == manufacturer_code and
+                session.image.image_type == image_type]
+        if not candidates:
+            self.unmatched += 1
+            return
+        for session in candidates:
+            image = session.image
+            if current_version >= image.file_version:
+                controller.send_frame(session.node, OTA_CLUSTER,
+                        _server_frame_control, 0x02,
+                        bytearray([NO_IMAGE_AVAILABLE]), frame.sequence)
+                self._finish(session, 'current', NO_IMAGE_AVAILABLE)
+                continue
+            session.state = 'downloading'
+            session.last_request = time.time()
+            controller.send_frame(session.node, OTA_CLUSTER,
+                    _server_frame_control, 0x02,
+                    _query_next_image_response.encode([SUCCESS,
+                        image.manufacturer_code, image.image_type,
+                        image.file_version, image.size]), frame.sequence)
+
+    def _image_block(self, controller, frame, values):
+        _, manufacturer_code, image_type, version, offset, size = values
+        self._send_blocks(controller, frame,
+                (manufacturer_code, image_type, version), offset, size)
+
+    def _image_page(self, controller, frame, values):
+        (_, manufacturer_code, image_type, version, offset, size, page_size,
+                spacing) = values
+        self._send_blocks(controller, frame,
+                (manufacturer_code, image_type, version), offset, size,
+                page_size, spacing / 1000.0)
+
+    def _send_blocks(self, controller, frame, key, offset, size, length=None,
+            spacing=0):
+        '''
+        Answers a request for length bytes from offset (one block if None)
+        with blocks of up to size bytes, spacing seconds apart.
+        '''
+        image = self.images.get(key)
+        candidates = []
+        if image is not None:
+            candidates = self._candidates(controller, image, offset)
+        if not candidates:
+            self.unmatched += 1
+            return
+        now = time.time()
+        sent, sessions = self._recent.get((controller, image, offset),
+                (0, ()))
+        if now - sent < self.duplicate_window and set(candidates) <= sessions:
+            self.duplicates += 1
+            return
+        if len(candidates) > 1:
+            self.ambiguous += 1
+        self._recent[(controller, image, offset)] = (now, set(candidates))
+        for session in candidates:
+            session.requested = offset
+            session.last_request = now
+        size = min(size, self.block_size) or self.block_size
+        end = min(offset + (length or size), image.size)
+        for index, block_offset in enumerate(xrange(offset, end, size)):
+            send = lambda block_offset=block_offset: self._send_block(
+                    controller, frame.sequence, image, candidates,
+                    block_offset, min(size, end - block_offset))
+            if index and spacing:
+                self._call_later(index * spacing, send)
+            else:
+                send()
+
+    def _send_block(self, controller, sequence, image, sessions, offset,
+            size):
+        data = image.block(offset, size)
+        payload = _image_block_response.encode([SUCCESS,
+            image.manufacturer_code, image.image_type, image.file_version,
+            offset, len(data)]) + data
+        now = time.time()
+        started = False
+        for session in sessions:
+            if session.future.done():
+                continue
+            controller.send_frame(session.node, OTA_CLUSTER,
+                    _server_frame_control, 0x05, payload, sequence)
+            self.blocks_sent += 1
+            self.bytes_sent += len(data)
+            session.blocks_sent += 1
+            session.bytes_sent += len(data)
+            if session.first_block is None:
+                session.first_block = now
+                started = True
+            session.offset = max(session.offset, offset + len(data))
+            if session.offset >= image.size and session.state != 'verifying':
+                session.state = 'verifying'
+                session.downloaded = now
+        if started:
+            # the next session on the gateway can start
+            self._admit()
+
+    def _upgrade_end(self, controller, frame, values):
+        status, manufacturer_code, image_type, version = values
+        image = self.images.get((manufacturer_code, image_type, version))
+        candidates = sorted([(session.downloaded, session)
+            for session in self.sessions.values()
+            if session.controller is controller and session.image is image
+            and session.state == 'verifying'])
+        if not candidates and status != SUCCESS:
+            # a device giving up part way through
+            candidates = [(None, session)
+                    for session in self.sessions.values()
+                    if session.controller is controller and
+                    session.image is image and
+                    session.state == 'downloading']
+        if not candidates:
+            self.unmatched += 1
+            return
+        # the first to finish downloading is the likeliest to be done
+        session = candidates[0][1]
+        if status != SUCCESS:
+            self._finish(session, 'failed', status,
+                    'upgrade end status 0x%02X' % status)
+            return
+        controller.send_frame(session.node, OTA_CLUSTER, _server_frame_control,
+                0x07, _upgrade_end_response.encode([image.manufacturer_code,
+                    image.image_type, image.file_version, 0, 0]),
+                frame.sequence)
+        self._finish(session, 'done', status)
+
+    _handlers = {
+        0x01: (_query_next_image_request, _query_next_image),
+        0x03: (_image_block_request, _image_block),
+        0x04: (_image_page_request, _image_page),
+        0x06: (_upgrade_end_request, _upgrade_end),
+    }
+
+class InvalidImageError(StandardError):
+    pass
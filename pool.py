@@ -0,0 +1,232 @@
+'''
+Drives several Ember gateways as one.
+
+Every gateway forms its own network, so a ZBControllerPool remembers which
+gateway each device joined through, from the Device Announce lines the
+gateways print, and sends each device's commands through that gateway.
+Operations over many devices are started on every gateway at once, so they
+take about as long as the busiest gateway's share of the devices instead of
+the whole list going through one Telnet session.
+'''
+import Queue
+import threading
+from zigbee import AsyncZBController, ZBController, Future, gather, \
+        ReportSubscription, TimeoutError
+
+class ZBControllerPool:
+    '''
+    A set of gateway controllers and the map of which one reaches each
+    device. The send_zcl_command, read_attribute(s), write_attribute(s),
+    configure_reporting and bind_node methods take the same arguments as the
+    controller's, and return whatever the device's controller returns. The
+    methods acting on every gateway or many devices block until done.
+
+    >>> pool = ZBControllerPool(['gw1', 'gw2', 'gw3']) # doctest: +SKIP
+    >>> pool.enable_permit_join() # doctest: +SKIP
+    >>> node = pool.wait_for_join(60) # doctest: +SKIP
+    >>> levels, errors = pool.read_attribute_all(
+    ...         z.level_control.current_level) # doctest: +SKIP
+    '''
+    def __init__(self, hostnames=(), controller_class=ZBController):
+        self.controller_class = controller_class
+        self.controllers = []
+        # node ID -> controller
+        self.devices = {}
+        self._lock = threading.Lock()
+        for hostname in hostnames:
+            self.open(hostname)
+
+    def open(self, hostname):
+        '''
+        Connects to another gateway and adds it to the pool.
+        '''
+        controller = self.controller_class()
+        controller.open(hostname)
+        self.add_controller(controller)
+        return controller
+
+    def add_controller(self, controller):
+        '''
+        Adds a controller that's already connected, and starts tracking the
+        devices that announce themselves through it.
+        '''
+        def announced(event):
+            if event.kind == 'announce':
+                self.assign(event.node_id, controller)
+        controller.dispatcher.event_listeners.append(announced)
+        with self._lock:
+            self.controllers.append(controller)
+
+    def close(self):
+        for controller in self.controllers:
+            controller.close()
+
+    def assign(self, node_id, controller):
+        '''
+        Routes a device's commands through the given controller. Devices are
+        assigned automatically when they announce themselves, so this is
+        only needed for devices that joined before the pool was started.
+        '''
+        with self._lock:
+            previous = self.devices.get(node_id)
+            self.devices[node_id] = controller
+        # each gateway has its own network, so node IDs can collide
+        if previous is not None and previous is not controller:
+            print 'WARNING: device 0x%04X announced on %s, was on %s' % (
+                    node_id, controller.hostname, previous.hostname)
+
+    def controller_for(self, node_id):
+        '''
+        Returns the controller of the gateway the device joined through.
+        '''
+        try:
+            return self.devices[node_id]
+        except KeyError:
+            raise UnknownDeviceError('no gateway knows device 0x%04X' %
+                    node_id)
+
+    def nodes_on(self, controller):
+        return sorted([node for node, owner in self.devices.items()
+            if owner is controller])
+
+    def wait_for_join(self, timeout=None):
+        '''
+        Waits for a device to join through any of the gateways, and returns
+        its node ID.
+        '''
+        joins = Queue.Queue()
+        pending = [(controller,
+            controller.dispatcher.expect_event('announce', timeout))
+            for controller in self.controllers]
+        for _, future in pending:
+            future.add_done_callback(joins.put)
+        try:
+            # Queue.get with a timeout keeps the main thread interruptible
+            event = joins.get(timeout=timeout or 1e9).result()
+        except Queue.Empty:
+            raise TimeoutError()
+        finally:
+            # left behind, the other waiters would swallow later announces
+            for controller, future in pending:
+                controller.dispatcher.cancel(future)
+        print 'Device 0x%04X joined' % event.node_id
+        return event.node_id
+
+    def enable_permit_join(self):
+        gather([AsyncZBController.enable_permit_join(controller)
+            for controller in self.controllers])
+
+    def disable_permit_join(self):
+        gather([AsyncZBController.disable_permit_join(controller)
+            for controller in self.controllers])
+
+    def send_zcl_command(self, destination, *args, **kwargs):
+        return self.controller_for(destination).send_zcl_command(
+                destination, *args, **kwargs)
+
+    def read_attribute(self, destination, *args, **kwargs):
+        return self.controller_for(destination).read_attribute(
+                destination, *args, **kwargs)
+
+    def read_attributes(self, destination, *args, **kwargs):
+        return self.controller_for(destination).read_attributes(
+                destination, *args, **kwargs)
+
+    def write_attribute(self, destination, *args, **kwargs):
+        return self.controller_for(destination).write_attribute(
+                destination, *args, **kwargs)
+
+    def write_attributes(self, destination, *args, **kwargs):
+        return self.controller_for(destination).write_attributes(
+                destination, *args, **kwargs)
+
+    def configure_reporting(self, destination, *args, **kwargs):
+        return self.controller_for(destination).configure_reporting(
+                destination, *args, **kwargs)
+
+    def bind_node(self, node_id, *args, **kwargs):
+        return self.controller_for(node_id).bind_node(node_id, *args,
+                **kwargs)
+
+    def subscribe_reports(self, attributes=None, cluster_code=None,
+            source=None, maxlen=1024, overflow='drop_oldest'):
+        '''
+        Returns one ReportSubscription fed by every gateway, or only by the
+        source's gateway when a source is given.
+        '''
+        subscription = ReportSubscription(attributes, cluster_code, source,
+                maxlen, overflow)
+        if source is None:
+            controllers = self.controllers
+        else:
+            controllers = [self.controller_for(source)]
+        for controller in controllers:
+            subscription.listen(controller.dispatcher)
+        return subscription
+
+    def for_each(self, operation, nodes=None, timeout=None):
+        '''
+        Calls operation(controller, node_id) for each of the given devices
+        (every known device by default) and waits for them all. operation
+        should start the work and return a Future, as the AsyncZBController
+        methods do, so each gateway keeps all its devices' transactions in
+        flight. Every gateway gets its own thread, so a slow or busy gateway
+        doesn't hold up the others.
+
+        Returns (results, errors), two dictionaries keyed by node ID, so one
+        device failing or timing out doesn't lose the others' results.
+        '''
+        if nodes is None:
+            nodes = sorted(self.devices)
+        results = {}
+        errors = {}
+        by_controller = {}
+        for node in nodes:
+            try:
+                by_controller.setdefault(self.controller_for(node),
+                        []).append(node)
+            except UnknownDeviceError as e:
+                errors[node] = e
+        def run(controller, nodes):
+            started = []
+            for node in nodes:
+                try:
+                    started.append((node, operation(controller, node)))
+                except Exception as e:
+                    errors[node] = e
+            for node, result in started:
+                try:
+                    if isinstance(result, Future):
+                        result = result.result(timeout)
+                    results[node] = result
+                except Exception as e:
+                    errors[node] = e
+        threads = [threading.Thread(target=run, args=item,
+            name='zigbee-pool-%s' % item[0].hostname)
+            for item in by_controller.items()]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # joining in slices keeps the main thread interruptible
+            while thread.is_alive():
+                thread.join(1)
+        return results, errors
+
+    def send_zcl_command_all(self, cmd, nodes=None, timeout=10):
+        return self.for_each(lambda controller, node:
+                AsyncZBController.send_zcl_command(controller, node, cmd,
+                    timeout=timeout), nodes)
+
+    def read_attribute_all(self, attribute, nodes=None, timeout=10):
+        return self.for_each(lambda controller, node:
+                AsyncZBController.read_attribute(controller, node, attribute,
+                    timeout), nodes)
+
+    def write_attribute_all(self, attribute, value, nodes=None, timeout=10):
+        return self.for_each(lambda controller, node:
+                AsyncZBController.write_attribute(controller, node, attribute,
+                    value, timeout), nodes)
+
+class UnknownDeviceError(StandardError):
+    pass
@@ -0,0 +1,319 @@
+'''
+A persistent record of the devices commissioned onto the gateways.
+
+A DeviceRegistry keeps one RegisteredDevice per device, known by its IEEE
+address, with the node ID and gateway it last announced itself on, and
+indexes them by IEEE address, node ID and gateway so lookups don't scan
+the list. The file is a journal: each change is appended to it as a line
+of JSON, and the registry is rebuilt by replaying the lines when it's
+opened, so a device rejoining with a new node ID costs one short write
+rather than rewriting every device. compact() rewrites the journal as one
+line per device once it's mostly superseded lines, which happens by itself
+past compact_threshold of them.
+
+commission() keeps permit join open on a controller, or every gateway of a
+ZBControllerPool, and records every device that announces itself:
+
+    registry = DeviceRegistry('devices.journal')
+    joined = commission(pool, registry, count=200, timeout=600)
+    device = registry.by_ieee('000D6F0000A1B2C3')
+    print device.node_id, device.gateway
+'''
+import os
+import json
+import time
+import Queue
+import threading
+
+from zigbee import AsyncZBController, gather
+
+# permit join lasts 255 seconds at most, so commission() renews it sooner
+PERMIT_JOIN_RENEWAL = 240
+
+class RegisteredDevice(object):
+    '''
+    A device's IEEE address (16 hex digits, or None if it's never been seen
+    with one), and the node ID and gateway hostname it last announced
+    itself with. node_id is None once another device has taken its node ID
+    on the same gateway. last_seen is only kept in memory for announces
+    that didn't change anything.
+    '''
+    __slots__ = ('ieee_address', 'node_id', 'gateway', 'first_seen',
+            'last_seen')
+
+    def __init__(self, ieee_address, node_id, gateway, seen):
+        self.ieee_address = ieee_address
+        self.node_id = node_id
+        self.gateway = gateway
+        self.first_seen = seen
+        self.last_seen = seen
+
+    def __repr__(self):
+        return 'RegisteredDevice(%s, %s, %s)' % (self.ieee_address,
+                'None' if self.node_id is None else '0x%04X' % self.node_id,
+                self.gateway)
+
+class DeviceRegistry:
+    '''
+    The devices recorded in a journal file, which is created if it doesn't
+    exist. filename can be None to keep the registry in memory only.
+
+    >>> registry = DeviceRegistry(None)
+    >>> registry.record(0x3F21, '000d6f0000a1b2c3', 'gw1')
+    RegisteredDevice(000D6F0000A1B2C3, 0x3F21, gw1)
+    >>> registry.record(0x8A4C, '000D6F0000A1B2C3', 'gw1')
+    RegisteredDevice(000D6F0000A1B2C3, 0x8A4C, gw1)
+    >>> registry.by_node(0x3F21), registry.by_node(0x8A4C)
+    ([], [RegisteredDevice(000D6F0000A1B2C3, 0x8A4C, gw1)])
+    >>> registry.record(0x8A4C, '000D6F0000D4E5F6', 'gw1')
+    RegisteredDevice(000D6F0000D4E5F6, 0x8A4C, gw1)
+    >>> registry.on_gateway('gw1')
+    [RegisteredDevice(000D6F0000A1B2C3, None, gw1), RegisteredDevice(000D6F0000D4E5F6, 0x8A4C, gw1)]
+    '''
+    def __init__(self, filename='devices.journal', compact_threshold=10000):
+        self.filename = filename
+        self.compact_threshold = compact_threshold
+        self.devices = []
+        # journal lines replaced by later ones
+        self.stale = 0
+        self._by_ieee = {}
+        # (gateway, node ID) -> device
+        self._by_address = {}
+        # node ID -> devices with it, one per gateway at most
+        self._by_node = {}
+        # gateway -> devices
+        self._by_gateway = {}
+        self._lock = threading.Lock()
+        self._journal = None
+        if filename is not None:
+            self._replay()
+            self._journal = open(filename, 'a')
+
+    def __len__(self):
+        return len(self.devices)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _replay(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                    node_id = entry['node']
+                    ieee_address = entry['ieee']
+                    gateway = entry['gateway']
+                    seen = entry['time']
+                    first_seen = entry['first']
+                except (ValueError, KeyError, TypeError):
+                    # most likely the last line, cut short by a crash
+                    self.stale += 1
+                    continue
+                device = self._apply(node_id, ieee_address, gateway, seen)
+                if device is None:
+                    self.stale += 1
+                else:
+                    device.first_seen = first_seen
+
+    def record(self, node_id, ieee_address=None, gateway=None, seen=None):
+        '''
+        Records that a device announced itself with the given node ID,
+        through the given gateway, and returns its RegisteredDevice. The
+        device is looked up by IEEE address, or by node ID and gateway when
+        the address isn't known. Only announces that change something are
+        written to the journal.
+        '''
+        if ieee_address is not None:
+            ieee_address = ieee_address.upper()
+        with self._lock:
+            if seen is None:
+                seen = time.time()
+            changed = self._apply(node_id, ieee_address, gateway, seen)
+            device = changed or self._find(node_id, ieee_address, gateway)
+            device.last_seen = seen
+            if changed is not None and self._journal is not None:
+                self._journal.write(self._line(device))
+                self._journal.flush()
+                if self.stale > max(self.compact_threshold,
+                        len(self.devices)):
+                    self._compact()
+            return device
+
+    def _find(self, node_id, ieee_address, gateway):
+        if ieee_address is not None:
+            return self._by_ieee.get(ieee_address)
+        return self._by_address.get((gateway, node_id))
+
+    def _apply(self, node_id, ieee_address, gateway, seen):
+        '''
+        Updates the indexes for an announce, and returns the device if it
+        was new or changed, or None if it was already recorded that way.
+        '''
+        device = self._find(node_id, ieee_address, gateway)
+        if device is None and ieee_address is not None:
+            # first seen without an address, when the CLI didn't print one
+            device = self._by_address.get((gateway, node_id))
+            if device is not None and device.ieee_address is not None:
+                device = None
+        if device is None:
+            device = RegisteredDevice(ieee_address, None, None, seen)
+            self.devices.append(device)
+        elif (device.node_id == node_id and device.gateway == gateway and
+                ieee_address in [None, device.ieee_address]):
+            return None
+        else:
+            self._unindex(device)
+            self.stale += 1
+        if ieee_address is not None:
+            device.ieee_address = ieee_address
+            self._by_ieee[ieee_address] = device
+        # a node ID can be handed out again once its device has moved on
+        previous = self._by_address.get((gateway, node_id))
+        if previous is not None and previous is not device:
+            self._unindex(previous)
+            previous.node_id = None
+            self._index(previous)
+        device.node_id = node_id
+        device.gateway = gateway
+        device.last_seen = seen
+        self._index(device)
+        return device
+
+    def _index(self, device):
+        self._by_gateway.setdefault(device.gateway, []).append(device)
+        if device.node_id is not None:
+            self._by_address[(device.gateway, device.node_id)] = device
+            self._by_node.setdefault(device.node_id, []).append(device)
+
+    def _unindex(self, device):
+        self._by_gateway[device.gateway].remove(device)
+        if device.node_id is not None:
+            del self._by_address[(device.gateway, device.node_id)]
+            self._by_node[device.node_id].remove(device)
+            if not self._by_node[device.node_id]:
+                del self._by_node[device.node_id]
+
+    def _line(self, device):
+        return json.dumps({'node': device.node_id,
+            'ieee': device.ieee_address, 'gateway': device.gateway,
+            'time': device.last_seen, 'first': device.first_seen}) + '\n'
+
+    def compact(self):
+        '''
+        Rewrites the journal as one line per device. The new journal is
+        written alongside and renamed over the old one, so a crash leaves
+        one or the other.
+        '''
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        if self.filename is None:
+            self.stale = 0
+            return
+        temporary = self.filename + '.new'
+        with open(temporary, 'w') as journal:
+            for device in self.devices:
+                journal.write(self._line(device))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._journal.close()
+        os.rename(temporary, self.filename)
+        self._journal = open(self.filename, 'a')
+        self.stale = 0
+
+    def by_ieee(self, ieee_address):
+        '''
+        Returns the device with the given IEEE address, or None.
+        '''
+        with self._lock:
+            return self._by_ieee.get(ieee_address.upper())
+
+    def get(self, node_id, gateway):
+        '''
+        Returns the device with the given node ID on the given gateway, or
+        None.
+        '''
+        with self._lock:
+            return self._by_address.get((gateway, node_id))
+
+    def by_node(self, node_id):
+        '''
+        Returns the devices with the given node ID, one per gateway at most,
+        as each gateway has its own network.
+        '''
+        with self._lock:
+            return list(self._by_node.get(node_id, []))
+
+    def on_gateway(self, gateway):
+        '''
+        Returns the devices last seen through the given gateway.
+        '''
+        with self._lock:
+            return list(self._by_gateway.get(gateway, []))
+
+    def gateways(self):
+        with self._lock:
+            return sorted([gateway for gateway, devices in
+                self._by_gateway.items() if devices])
+
+def commission(target, registry, count=None, timeout=None, on_join=None):
+    '''
+    Opens permit join on a controller, or on every controller of a pool,
+    and records each device that announces itself in the registry, until
+    count different devices have joined or timeout seconds have passed.
+    With neither, it runs until interrupted. Permit join is renewed before
+    it runs out, and disabled again at the end. on_join is called with each
+    RegisteredDevice as it joins. Returns the devices that joined, in the
+    order they first did.
+    '''
+    controllers = getattr(target, 'controllers', None) or [target]
+    announces = Queue.Queue()
+    listeners = []
+    for controller in controllers:
+        def announced(event, controller=controller):
+            if event.kind == 'announce':
+                announces.put((controller, event))
+        controller.dispatcher.event_listeners.append(announced)
+        listeners.append((controller, announced))
+    deadline = time.time() + timeout if timeout is not None else None
+    joined = []
+    try:
+        renew = 0
+        while count is None or len(joined) < count:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            if now >= renew:
+                gather([AsyncZBController.enable_permit_join(controller)
+                    for controller in controllers])
+                renew = now + PERMIT_JOIN_RENEWAL
+            wait = renew - now
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            try:
+                # Queue.get with a timeout keeps the main thread interruptible
+                controller, event = announces.get(timeout=max(wait, 0.01))
+            except Queue.Empty:
+                continue
+            device = registry.record(event.node_id, event.ieee_address,
+                    controller.hostname)
+            if device not in joined:
+                joined.append(device)
+            if on_join is not None:
+                on_join(device)
+    finally:
+        for controller, announced in listeners:
+            controller.dispatcher.event_listeners.remove(announced)
+        gather([AsyncZBController.disable_permit_join(controller)
+            for controller in controllers])
+    return joined
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,346 @@
+'''
+Compact storage of the attribute values received from devices.
+
+A SampleStore keeps every value read from or reported by a device as a row
+of (time, node ID, origin, value) in the Series for its attribute. Each
+column of a Series is an array.array, with the values in the narrowest
+array type that holds the attribute's ZCL type, so a sample takes about 20
+bytes rather than a few hundred as Python objects. Values that aren't
+numbers, such as strings, aren't stored.
+
+Rows are kept in the order they're received, so time ranges are found by
+bisection, and save() writes the columns' buffers straight to disk:
+
+    store = controller.enable_sample_store()
+    ...
+    levels = store.select(0x0008, 0x0000, start=time.time() - 3600)
+    print levels.stats()
+    store.save('soak.samples')
+
+The CLI doesn't print who sent a report, so reported values are stored
+with node UNKNOWN_NODE unless the source is known.
+'''
+import sys
+import json
+import time
+import array
+import bisect
+import operator
+import functools
+import itertools
+import threading
+
+import zcl
+from codec import get_codec, StructCodec, OddIntegerCodec, SemiFloatCodec
+
+# where a sample came from
+READ = 0
+REPORT = 1
+
+UNKNOWN_NODE = -1
+
+# 64 bit integers need a 64 bit array type, where there is one
+if array.array('l').itemsize >= 8:
+    _wide = {False: 'L', True: 'l'}
+else:
+    _wide = {False: 'd', True: 'd'}
+
+def value_typecode(type_code):
+    '''
+    Returns the array typecode for values of the given ZCL type code, or
+    None if they aren't numbers.
+
+    >>> value_typecode(0x21), value_typecode(0x2A), value_typecode(0x42)
+    ('H', 'i', None)
+    '''
+    try:
+        codec = get_codec(zcl.get_type_string(type_code))
+    except KeyError:
+        return None
+    if isinstance(codec, StructCodec):
+        if codec.format == '?':
+            return 'B'
+        if codec.format in 'qQ':
+            return _wide[codec.format == 'q']
+        return codec.format
+    if isinstance(codec, OddIntegerCodec):
+        if codec.size <= 4:
+            return 'i' if codec.signed else 'I'
+        return _wide[codec.signed]
+    if isinstance(codec, SemiFloatCodec):
+        return 'f'
+    return None
+
+class SeriesStats(object):
+    '''
+    The count, minimum, maximum and mean of some values.
+    '''
+    __slots__ = ('count', 'minimum', 'maximum', 'total')
+
+    def __init__(self):
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+        self.total = 0
+
+    def mean(self):
+        return float(self.total) / self.count if self.count else None
+
+    def __repr__(self):
+        return 'SeriesStats(n=%d, min=%r, max=%r, mean=%r)' % (self.count,
+                self.minimum, self.maximum, self.mean())
+
+class Series(object):
+    '''
+    The samples of one attribute, as parallel columns.
+
+    >>> series = Series(0x0402, 0x0000, 0x29)
+    >>> for received, node, value in [(1.0, 1, 2100), (2.0, 2, 2150),
+    ...         (31.0, 1, 2105), (91.0, 1, 2110), (92.0, 2, 2160)]:
+    ...     series.append(received, node, REPORT, value)
+    >>> series.values
+    array('h', [2100, 2150, 2105, 2110, 2160])
+    >>> series.stats()[1]
+    SeriesStats(n=3, min=2100, max=2110, mean=2105.0)
+    >>> series.select(start=2.0, end=91.0).nodes
+    array('i', [2, 1])
+    >>> series.percentiles([50, 100])
+    {1: [2105, 2110], 2: [2150, 2160]}
+    >>> series.gaps(30)
+    [(1, 31.0, 91.0), (2, 2.0, 92.0)]
+    '''
+    __slots__ = ('cluster_code', 'attribute_code', 'type_code', 'times',
+            'nodes', 'origins', 'values')
+
+    def __init__(self, cluster_code, attribute_code, type_code,
+            typecode=None):
+        self.cluster_code = cluster_code
+        self.attribute_code = attribute_code
+        self.type_code = type_code
+        self.times = array.array('d')
+        self.nodes = array.array('i')
+        self.origins = array.array('B')
+        self.values = array.array(typecode or value_typecode(type_code))
+
+    def append(self, received, node, origin, value):
+        '''
+        Adds a sample. The samples are kept in order of time for select()
+        to bisect, so one received before the last is inserted in its place
+        rather than appended.
+
+        >>> series = Series(0x0402, 0x0000, 0x29)
+        >>> for received, value in [(1.0, 2100), (3.0, 2120), (2.0, 2110)]:
+        ...     series.append(received, 1, READ, value)
+        >>> series.times, series.values
+        (array('d', [1.0, 2.0, 3.0]), array('h', [2100, 2110, 2120]))
+        >>> series.select(start=2.0).values
+        array('h', [2110, 2120])
+        '''
+        if not self.times or received >= self.times[-1]:
+            self.times.append(received)
+            self.nodes.append(node)
+            self.origins.append(origin)
+            self.values.append(value)
+            return
+        index = bisect.bisect_right(self.times, received)
+        self.times.insert(index, received)
+        self.nodes.insert(index, node)
+        self.origins.insert(index, origin)
+        self.values.insert(index, value)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return 'Series(0x%04X, 0x%04X, %d samples)' % (self.cluster_code,
+                self.attribute_code, len(self))
+
+    def _empty(self):
+        return Series(self.cluster_code, self.attribute_code, self.type_code,
+                self.values.typecode)
+
+    def select(self, start=None, end=None, node=None, origin=None):
+        '''
+        Returns a new Series of the samples received from start up to, but
+        not including, end (both times in seconds), and from the given node
+        and origin when those are given.
+        '''
+        low = 0 if start is None else bisect.bisect_left(self.times, start)
+        high = (len(self.times) if end is None else
+                bisect.bisect_left(self.times, end))
+        selected = self._empty()
+        columns = ['times', 'nodes', 'origins', 'values']
+        if node is None and origin is None:
+            for name in columns:
+                getattr(selected, name).extend(getattr(self, name)[low:high])
+            return selected
+        mask = [True] * (high - low)
+        if node is not None:
+            mask = map(functools.partial(operator.eq, node),
+                    self.nodes[low:high])
+        if origin is not None:
+            mask = map(operator.and_, mask, map(functools.partial(
+                operator.eq, origin), self.origins[low:high]))
+        for name in columns:
+            getattr(selected, name).extend(itertools.compress(
+                getattr(self, name)[low:high], mask))
+        return selected
+
+    def by_node(self):
+        '''
+        Returns a dictionary mapping each node ID to an array of its values.
+        '''
+        values = {}
+        typecode = self.values.typecode
+        for node, value in itertools.izip(self.nodes, self.values):
+            column = values.get(node)
+            if column is None:
+                column = values[node] = array.array(typecode)
+            column.append(value)
+        return values
+
+    def stats(self):
+        '''
+        Returns a dictionary mapping each node ID to the SeriesStats of its
+        values.
+        '''
+        stats = {}
+        for node, values in self.by_node().items():
+            node_stats = stats[node] = SeriesStats()
+            node_stats.count = len(values)
+            node_stats.minimum = min(values)
+            node_stats.maximum = max(values)
+            node_stats.total = sum(values)
+        return stats
+
+    def percentiles(self, percents):
+        '''
+        Returns a dictionary mapping each node ID to the list of its values
+        at the given percentiles (nearest rank).
+        '''
+        percentiles = {}
+        for node, values in self.by_node().items():
+            values = sorted(values)
+            percentiles[node] = [values[max(int(round(percent / 100.0 *
+                len(values))) - 1, 0)] for percent in percents]
+        return percentiles
+
+    def gaps(self, interval, tolerance=1.5, end=None):
+        '''
+        Returns (node ID, time, next time) for each time a node went more
+        than tolerance times interval seconds between samples, to check
+        reporting intervals. When end is given, a node whose last sample is
+        too long before it counts too, with end as its next time.
+        '''
+        limit = interval * tolerance
+        last = {}
+        gaps = []
+        for node, received in itertools.izip(self.nodes, self.times):
+            previous = last.get(node)
+            if previous is not None and received - previous > limit:
+                gaps.append((node, previous, received))
+            last[node] = received
+        if end is not None:
+            for node, previous in last.items():
+                if end - previous > limit:
+                    gaps.append((node, previous, end))
+        return sorted(gaps)
+
+class SampleStore:
+    '''
+    A Series for each attribute samples have been received for, keyed by
+    (cluster code, attribute code). It's safe to add samples from the reader
+    thread while other threads query; queries return copies.
+    '''
+    def __init__(self):
+        self.series = {}
+        # values that aren't numbers, or of a different type than before
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def add(self, node, cluster_code, attribute_code, type_code, value,
+            origin=READ, received=None):
+        self.add_records(node, cluster_code,
+                [(attribute_code, type_code, value)], origin, received)
+
+    def add_records(self, node, cluster_code, records, origin=READ,
+            received=None):
+        '''
+        Stores (attribute code, type code, value) records received together,
+        at the given time, or now.
+        '''
+        if node is None:
+            node = UNKNOWN_NODE
+        with self._lock:
+            if received is None:
+                received = time.time()
+            for attribute_code, type_code, value in records:
+                key = (cluster_code, attribute_code)
+                series = self.series.get(key)
+                if series is None:
+                    if value_typecode(type_code) is None:
+                        self.skipped += 1
+                        continue
+                    series = self.series[key] = Series(cluster_code,
+                            attribute_code, type_code)
+                elif series.type_code != type_code:
+                    self.skipped += 1
+                    continue
+                series.append(received, node, origin, value)
+
+    def __len__(self):
+        with self._lock:
+            return sum([len(series) for series in self.series.values()])
+
+    def select(self, cluster_code, attribute_code, start=None, end=None,
+            node=None, origin=None):
+        '''
+        Returns a copy of an attribute's samples, limited as for
+        Series.select. Raises KeyError if there are none.
+        '''
+        with self._lock:
+            return self.series[(cluster_code, attribute_code)].select(start,
+                    end, node, origin)
+
+    def save(self, filename):
+        '''
+        Writes every Series to a file: a line of JSON describing them,
+        followed by their columns as raw machine values.
+        '''
+        with self._lock:
+            series = sorted(self.series.values(),
+                    key=lambda series: (series.cluster_code,
+                        series.attribute_code))
+            header = {'byteorder': sys.byteorder, 'series': [
+                {'cluster': s.cluster_code, 'attribute': s.attribute_code,
+                    'type': s.type_code, 'typecode': s.values.typecode,
+                    'count': len(s)} for s in series]}
+            with open(filename, 'wb') as samples:
+                samples.write(json.dumps(header) + '\n')
+                for s in series:
+                    for column in [s.times, s.nodes, s.origins, s.values]:
+                        column.tofile(samples)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Reads a file written by save() into a new SampleStore.
+        '''
+        store = cls()
+        with open(filename, 'rb') as samples:
+            header = json.loads(samples.readline())
+            for entry in header['series']:
+                series = Series(entry['cluster'], entry['attribute'],
+                        entry['type'], str(entry['typecode']))
+                for column in [series.times, series.nodes, series.origins,
+                        series.values]:
+                    column.fromfile(samples, entry['count'])
+                    if header['byteorder'] != sys.byteorder:
+                        column.byteswap()
+                store.series[(series.cluster_code,
+                    series.attribute_code)] = series
+        return store
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,829 @@
+#!/usr/bin/env python
+'''
+A stand-in for an Ember gateway, for exercising controllers at scale without
+any hardware.
+
+EmberSimulator speaks the part of the Ember CLI that the zigbee module uses,
+on TCP port 4900 like the real gateway, and hosts any number of virtual
+devices built from a zcl.ZCL model. Each device answers Read, Write and
+Configure Reporting, sends attribute reports on its configured intervals
+and changes, and answers cluster specific commands with a Default Response.
+It also answers attribute and command discovery, and the ZDO Active
+Endpoints and Simple Descriptor requests for its one endpoint.
+Everything a device sends back can be delayed by a latency (plus random
+jitter) and lost with a given probability.
+
+    python simulator.py -n 2000 --latency 0.02 --loss 0.01 general.xml ha.xml
+
+Devices start out of the network and announce themselves as soon as
+permit join is enabled, so controllers learn their node IDs as usual. They
+also act as OTA Upgrade clients: an Image Notify makes them query for and
+download the image, a block at a time, asking again for blocks that don't
+arrive, and switch to its version once told to upgrade.
+'''
+import re
+import zlib
+import time
+import heapq
+import Queue
+import random
+import socket
+import struct
+import threading
+import SocketServer
+from optparse import OptionParser
+
+import zcl
+from codec import get_codec, StringCodec, FixedBytesCodec, UnknownTypeCodec
+
+# ZCL status codes
+SUCCESS = 0x00
+UNSUP_CLUSTER_COMMAND = 0x81
+UNSUP_GENERAL_COMMAND = 0x82
+UNSUPPORTED_ATTRIBUTE = 0x86
+INVALID_DATA_TYPE = 0x8D
+UNSUPPORTED_CLUSTER = 0xC3
+
+# ZDO status codes
+NOT_ACTIVE = 0x83
+
+OTA_CLUSTER = 0x0019
+# seconds an OTA client waits for a block before asking again
+OTA_RETRY = 1.0
+
+# attributes of these types are reported when they change by a threshold,
+# the others on any change
+_analog_type_codes = set(range(0x20, 0x30) + range(0x38, 0x3B) +
+        range(0xE0, 0xE3))
+
+# records per discovery response, as a real device only sends what fits
+_discovery_limit = 20
+
+class VirtualDevice:
+    '''
+    One simulated node. Attributes hold the default value for their type
+    until they're written, and only written values are stored, so thousands
+    of devices with full clusters stay small.
+    '''
+    def __init__(self, node_id, ieee_address, cluster_codes):
+        self.node_id = node_id
+        self.ieee_address = ieee_address
+        self.cluster_codes = frozenset(cluster_codes)
+        # the one endpoint, with every cluster on it
+        self.endpoint = 1
+        self.profile_id = 0x0104
+        self.device_id = 0x0100
+        self.joined = False
+        self.sequence = 0
+        # (cluster code, attribute code) -> value
+        self.values = {}
+        # (cluster code, attribute code) -> ReportingConfig
+        self.reporting = {}
+        # the OTA client's firmware, and the download in progress
+        self.manufacturer_code = 0x1002
+        self.image_type = 0x0000
+        self.file_version = 0x00000001
+        self.ota_block_size = 48
+        self.download = None
+        self.upgrades = 0
+
+    def next_sequence(self):
+        self.sequence = (self.sequence + 1) % 0x100
+        return self.sequence
+
+    def get(self, attribute):
+        key = (attribute.cluster_code, attribute.code)
+        if key in self.values:
+            return self.values[key]
+        return _default_value(attribute.codec)
+
+class OTADownload:
+    '''
+    An image a device is downloading. crc is the CRC-32 of the data so far,
+    to check what was sent.
+    '''
+    def __init__(self, file_version, size):
+        self.file_version = file_version
+        self.size = size
+        self.offset = 0
+        self.crc = 0
+        self.requests = 0
+
+class ReportingConfig:
+    def __init__(self, attribute, min_interval, max_interval, change):
+        self.attribute = attribute
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.change = change
+        self.last_value = None
+        self.last_report = 0
+
+def _default_value(codec):
+    if isinstance(codec, StringCodec):
+        return '' if codec.characters else []
+    if isinstance(codec, FixedBytesCodec):
+        return [0] * codec.size
+    return 0
+
+def _number(token):
+    return int(token, 0)
+
+def _payload_string(payload):
+    return ''.join(['%02X ' % byte for byte in payload])
+
+class EmberSimulator:
+    '''
+    The simulated gateway and its network. Lines from every connected
+    client are handled in order, like the one CLI of a real gateway, and
+    everything the gateway prints goes to every client.
+    '''
+    def __init__(self, model, latency=0.0, jitter=0.0, loss=0.0,
+            join_interval=0.001, seed=None):
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.join_interval = join_interval
+        self.random = random.Random(seed)
+        # node ID -> VirtualDevice
+        self.devices = {}
+        self.network_up = False
+        self.local_values = {}
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.frames_lost = 0
+        self.reports_sent = 0
+        self._sequence = 0
+        self._direction = 0
+        self._buffer = None
+        self._sessions = []
+        self._lock = threading.RLock()
+        # (time due, counter, function) for delayed output and timers
+        self._timers = []
+        self._counter = 0
+        self._condition = threading.Condition(self._lock)
+        self._scheduler = None
+        self._closed = False
+        self._commands = [
+            (re.compile(r'network form (\S+) (\S+) (\S+)$'), self._form),
+            (re.compile(r'network leave$'), self._leave),
+            (re.compile(r'network pjoin (\S+)$'), self._pjoin),
+            (re.compile(r'raw (\S+) \{([0-9A-Fa-f ]*)\}$'), self._raw),
+            (re.compile(r'send (\S+) (\S+) (\S+)$'), self._send),
+            (re.compile(r'zcl global direction (\S+)$'), self._set_direction),
+            (re.compile(r'zcl global read (\S+) (\S+)$'), self._global_read),
+            (re.compile(r'zcl global write (\S+) (\S+) (\S+) ' +
+                r'\{([0-9A-Fa-f ]*)\}$'), self._global_write),
+            (re.compile(r'zcl global send-me-a-report (\S+) (\S+) (\S+) ' +
+                r'(\S+) (\S+) \{([0-9A-Fa-f ]*)\}$'), self._global_report),
+            (re.compile(r'zcl ota server notify (\S+) .*$'), self._ota_notify),
+            (re.compile(r'zdo bind (\S+) (\S+) (\S+) (\S+) \{([^}]*)\} ' +
+                r'\{([^}]*)\}$'), self._bind),
+            (re.compile(r'zdo active (\S+)$'), self._active_endpoints),
+            (re.compile(r'zdo simple (\S+) (\S+)$'), self._simple_descriptor),
+            (re.compile(r'write (\S+) (\S+) (\S+) (\S+) (\S+) ' +
+                r'\{([0-9A-Fa-f ]*)\}$'), self._write_local),
+        ]
+
+    def add_devices(self, count, cluster_codes=None, joined=False):
+        '''
+        Adds count devices with the given clusters (every cluster in the
+        model by default), which join when permit join is next enabled
+        unless they're already joined. Returns them.
+        '''
+        if cluster_codes is None:
+            cluster_codes = self.model.cluster_codes()
+        added = []
+        with self._lock:
+            for _ in xrange(count):
+                node_id = self.random.randint(0x0001, 0xFFF7)
+                while node_id in self.devices:
+                    node_id = self.random.randint(0x0001, 0xFFF7)
+                device = VirtualDevice(node_id,
+                        self.random.getrandbits(64), cluster_codes)
+                device.joined = joined
+                self.devices[node_id] = device
+                added.append(device)
+        return added
+
+    def set_attribute(self, node_id, attribute, value):
+        '''
+        Changes an attribute on a device, as if it had measured something,
+        which may trigger a report.
+        '''
+        with self._lock:
+            device = self.devices[node_id]
+            device.values[(attribute.cluster_code, attribute.code)] = value
+            self._value_changed(device, attribute)
+
+    def rejoin(self, node_id):
+        '''
+        Makes a device leave and join again, as after a power cycle, with a
+        new node ID, and announce itself once its rejoin completes. Returns
+        the new node ID.
+        '''
+        with self._lock:
+            device = self.devices.pop(node_id)
+            device.joined = False
+            while device.node_id in self.devices or device.node_id == node_id:
+                device.node_id = self.random.randint(0x0001, 0xFFF7)
+            self.devices[device.node_id] = device
+        self.call_later(self.latency + self.join_interval,
+                lambda: self._announce(device))
+        return device.node_id
+
+    # output and timers
+
+    def output(self, line):
+        '''
+        Prints a line to every connected client.
+        '''
+        data = line + '\r\n'
+        with self._lock:
+            for session in list(self._sessions):
+                try:
+                    session(data)
+                except (socket.error, ValueError):
+                    self._sessions.remove(session)
+
+    def add_session(self, write):
+        with self._lock:
+            self._sessions.append(write)
+
+    def remove_session(self, write):
+        with self._lock:
+            if write in self._sessions:
+                self._sessions.remove(write)
+
+    def call_later(self, delay, function):
+        with self._lock:
+            self._counter += 1
+            heapq.heappush(self._timers, (time.time() + delay, self._counter,
+                function))
+            self._condition.notify()
+
+    def start(self):
+        '''
+        Starts the thread that runs the timers. serve() calls this for you.
+        '''
+        self._scheduler = threading.Thread(target=self._run_timers,
+                name='simulator-timers')
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    def stop(self):
+        '''
+        Stops the timer thread, dropping any output and timers still due.
+        '''
+        with self._lock:
+            self._closed = True
+            self._condition.notify()
+        if (self._scheduler is not None and
+                self._scheduler is not threading.current_thread()):
+            self._scheduler.join()
+
+    def _run_timers(self):
+        with self._lock:
+            while not self._closed:
+                now = time.time()
+                while (self._timers and self._timers[0][0] <= now and
+                        not self._closed):
+                    heapq.heappop(self._timers)[2]()
+                if self._timers:
+                    self._condition.wait(min(self._timers[0][0] - now, 1))
+                else:
+                    self._condition.wait(1)
+
+    def _over_the_air(self, line):
+        '''
+        Prints something a device sent, after the latency, unless it's lost.
+        '''
+        if self.loss and self.random.random() < self.loss:
+            self.frames_lost += 1
+            return
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        if delay:
+            self.call_later(delay, lambda: self.output(line))
+        else:
+            self.output(line)
+
+    def _send_frame(self, device, cluster_code, frame_control, sequence,
+            code, payload):
+        cluster = self.model.cluster_by_code(cluster_code)
+        name = cluster.name if cluster is not None else (
+                'Unknown clus. [0x%04X]' % cluster_code)
+        self.frames_sent += 1
+        self._over_the_air('RX len %d, ep %02X, clus 0x%04X (%s) FC %02X '
+                'seq %02X cmd %02X payload[%s]' % (len(payload) + 3,
+                    device.endpoint, cluster_code, name, frame_control,
+                    sequence, code, _payload_string(payload)))
+
+    # CLI commands
+
+    def handle_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        with self._lock:
+            for regex, handler in self._commands:
+                match = regex.match(line)
+                if match is not None:
+                    handler(*match.groups())
+                    return
+        self.output('Error: unknown command "%s"' % line)
+
+    def _form(self, channel, power, pan_id):
+        if self.network_up:
+            self.output('form 0x70')
+            return
+        self.network_up = True
+        self.output('form 0x00')
+
+    def _leave(self):
+        if not self.network_up:
+            self.output('leave 0x70')
+            return
+        self.network_up = False
+        for device in self.devices.values():
+            device.joined = False
+        self.output('leave 0x00')
+        self.output('EMBER_NETWORK_DOWN')
+
+    def _pjoin(self, duration):
+        duration = _number(duration)
+        self.output('pJoin for %d sec: 0x00' % duration)
+        if not duration:
+            return
+        delay = self.latency
+        for device in self.devices.values():
+            if not device.joined:
+                delay += self.join_interval
+                self.call_later(delay, lambda device=device:
+                        self._announce(device))
+
+    def _announce(self, device):
+        if device.joined:
+            return
+        device.joined = True
+        self.output('Device Announce: 0x%04X (>)%016X' % (device.node_id,
+            device.ieee_address))
+
+    def _raw(self, cluster_code, data):
+        self._buffer = (_number(cluster_code), bytearray.fromhex(data))
+
+    def _load_global(self, cluster_code, code, payload):
+        frame_control = 0x08 if self._direction else 0x00
+        self._buffer = (_number(cluster_code),
+                bytearray([frame_control, self._sequence, code]) + payload)
+        self._sequence = (self._sequence + 1) % 0x100
+
+    def _set_direction(self, direction):
+        self._direction = _number(direction)
+
+    def _global_read(self, cluster_code, attribute_code):
+        attribute_code = _number(attribute_code)
+        self._load_global(cluster_code, 0x00,
+                bytearray([attribute_code & 0xff, attribute_code >> 8]))
+
+    def _global_write(self, cluster_code, attribute_code, type_code, data):
+        attribute_code = _number(attribute_code)
+        self._load_global(cluster_code, 0x02,
+                bytearray([attribute_code & 0xff, attribute_code >> 8,
+                    _number(type_code)]) + bytearray.fromhex(data))
+
+    def _global_report(self, cluster_code, attribute_code, type_code,
+            min_interval, max_interval, change):
+        attribute_code = _number(attribute_code)
+        min_interval = _number(min_interval)
+        max_interval = _number(max_interval)
+        self._load_global(cluster_code, 0x06,
+                bytearray([0x00, attribute_code & 0xff, attribute_code >> 8,
+                    _number(type_code), min_interval & 0xff,
+                    min_interval >> 8, max_interval & 0xff,
+                    max_interval >> 8]) + bytearray.fromhex(change))
+
+    def _ota_notify(self, node_id):
+        device = self.devices.get(_number(node_id))
+        if device is None or not device.joined:
+            return
+        self.frames_received += 1
+        self._ota_client(device, 0x00, bytearray())
+
+    def _write_local(self, endpoint, cluster_code, attribute_code, mask,
+            type_code, data):
+        self.local_values[(_number(cluster_code), _number(attribute_code))] = (
+                _number(type_code), bytearray.fromhex(data))
+
+    def _bind(self, node_id, source_endpoint, destination_endpoint,
+            cluster_code, ieee_address, destination):
+        device = self.devices.get(_number(node_id))
+        if device is None or not device.joined:
+            # no response, as with a device that's gone
+            return
+        self._over_the_air('RX: ZDO, command 0x8021, status: 0x00')
+
+    def _active_endpoints(self, node_id):
+        device = self.devices.get(_number(node_id))
+        if device is None or not device.joined:
+            return
+        self._over_the_air('RX: ZDO, command 0x8005, status: 0x00')
+        self._over_the_air('Active Endpoints Response: 0x%04X, status 0x00, '
+                'endpoints [%02X ]' % (device.node_id, device.endpoint))
+
+    def _simple_descriptor(self, node_id, endpoint):
+        device = self.devices.get(_number(node_id))
+        if device is None or not device.joined:
+            return
+        endpoint = _number(endpoint)
+        if endpoint != device.endpoint:
+            self._over_the_air('RX: ZDO, command 0x8004, status: 0x%02X' %
+                    NOT_ACTIVE)
+            self._over_the_air('Simple Descriptor Response: 0x%04X, status '
+                    '0x%02X, ep %02X' % (device.node_id, NOT_ACTIVE, endpoint))
+            return
+        self._over_the_air('RX: ZDO, command 0x8004, status: 0x00')
+        self._over_the_air('Simple Descriptor Response: 0x%04X, status 0x00, '
+                'ep %02X, profile 0x%04X, device 0x%04X, version 0, '
+                'in [%s], out [%04X ]' % (device.node_id, endpoint,
+                    device.profile_id, device.device_id,
+                    ''.join(['%04X ' % cluster_code for cluster_code in
+                        sorted(device.cluster_codes)]), OTA_CLUSTER))
+
+    def _send(self, node_id, source_endpoint, destination_endpoint):
+        if self._buffer is None:
+            return
+        cluster_code, frame = self._buffer
+        device = self.devices.get(_number(node_id))
+        if device is None or not device.joined or len(frame) < 3:
+            return
+        if _number(destination_endpoint) != device.endpoint:
+            # dropped by the device's stack, so never answered
+            return
+        self.frames_received += 1
+        frame_control = frame[0]
+        header = 3
+        if frame_control & 0x04:
+            # skip the manufacturer code
+            header = 5
+        sequence, code = frame[header - 2], frame[header - 1]
+        payload = frame[header:]
+        if cluster_code == OTA_CLUSTER and frame_control & 0x09 == 0x09:
+            self._ota_client(device, code, payload)
+            return
+        response = None
+        if cluster_code not in device.cluster_codes:
+            response = (0x0B, bytearray([code, UNSUPPORTED_CLUSTER]))
+        elif frame_control & 0x03 == 0x00:
+            handler = self._global_handlers.get(code)
+            if handler is None:
+                response = (0x0B, bytearray([code, UNSUP_GENERAL_COMMAND]))
+            else:
+                response = handler(self, device, cluster_code, payload)
+        else:
+            cluster = self.model.cluster_by_code(cluster_code)
+            source = 'server' if frame_control & 0x08 else 'client'
+            if (cluster is None or
+                    cluster.command_by_code(code, source) is None):
+                status = UNSUP_CLUSTER_COMMAND
+            else:
+                status = SUCCESS
+            if not frame_control & 0x10 or status != SUCCESS:
+                response = (0x0B, bytearray([code, status]))
+        if response is not None:
+            # responses go the other way, with default responses disabled
+            direction = 0x00 if frame_control & 0x08 else 0x08
+            self._send_frame(device, cluster_code, 0x10 | direction,
+                    sequence, response[0], response[1])
+
+    # the OTA Upgrade client
+
+    def _ota_client(self, device, code, payload):
+        download = device.download
+        try:
+            if code == 0x00:
+                # Image Notify
+                self._ota_send(device, 0x01, struct.pack('<BHHI', 0x00,
+                    device.manufacturer_code, device.image_type,
+                    device.file_version))
+            elif code == 0x02 and payload[0] == SUCCESS and download is None:
+                # Query Next Image Response
+                file_version, size = struct.unpack_from('<II', payload, 5)
+                device.download = OTADownload(file_version, size)
+                self._ota_request(device)
+            elif (code == 0x05 and download is not None and
+                    payload[0] == SUCCESS):
+                # Image Block Response
+                offset = struct.unpack_from('<I', payload, 9)[0]
+                data = payload[14:14 + payload[13]]
+                # a block asked for by someone else, or a late duplicate
+                if offset != download.offset or not data:
+                    return
+                download.offset += len(data)
+                download.crc = zlib.crc32(str(data), download.crc)
+                self._ota_request(device)
+            elif code == 0x07 and download is not None and (
+                    download.offset >= download.size):
+                # Upgrade End Response, upgrading now
+                device.file_version = download.file_version
+                device.download = None
+                device.upgrades += 1
+        except (IndexError, struct.error):
+            pass
+
+    def _ota_request(self, device):
+        '''
+        Asks for the next block, or says the download is done, and asks
+        again if nothing comes of it.
+        '''
+        download = device.download
+        download.requests += 1
+        if download.offset >= download.size:
+            self._ota_send(device, 0x06, struct.pack('<BHHI', SUCCESS,
+                device.manufacturer_code, device.image_type,
+                download.file_version))
+        else:
+            self._ota_send(device, 0x03, struct.pack('<BHHIIB', 0x00,
+                device.manufacturer_code, device.image_type,
+                download.file_version, download.offset,
+                device.ota_block_size))
+        requests = download.requests
+        def retry():
+            if device.download is download and download.requests == requests:
+                self._ota_request(device)
+        self.call_later(OTA_RETRY, retry)
+
+    def _ota_send(self, device, code, payload):
+        # cluster specific, client to server
+        self._send_frame(device, OTA_CLUSTER, 0x01, device.next_sequence(),
+                code, bytearray(payload))
+
+    # global commands received by devices
+
+    def _attribute(self, device, cluster_code, attribute_code):
+        cluster = self.model.cluster_by_code(cluster_code)
+        if cluster is None:
+            return None
+        attribute = cluster.attribute_by_code(attribute_code)
+        if attribute is None or isinstance(attribute.codec, UnknownTypeCodec):
+            return None
+        return attribute
+
+    def _read_attributes(self, device, cluster_code, payload):
+        records = bytearray()
+        for offset in xrange(0, len(payload) - 1, 2):
+            attribute_code = payload[offset] | payload[offset + 1] << 8
+            records += payload[offset:offset + 2]
+            attribute = self._attribute(device, cluster_code, attribute_code)
+            if attribute is None:
+                records.append(UNSUPPORTED_ATTRIBUTE)
+                continue
+            records.append(SUCCESS)
+            records.append(attribute.type_code)
+            records += attribute.codec.encode(device.get(attribute))
+        return 0x01, records
+
+    def _write_attributes(self, device, cluster_code, payload, code):
+        writes = []
+        failed = bytearray()
+        offset = 0
+        while offset + 3 <= len(payload):
+            attribute_code = payload[offset] | payload[offset + 1] << 8
+            type_code = payload[offset + 2]
+            try:
+                codec = get_codec(zcl.get_type_string(type_code))
+                value, offset = codec.decode(payload, offset + 3)
+            except Exception:
+                # can't find the next record after one we can't decode
+                failed += bytearray([INVALID_DATA_TYPE, attribute_code & 0xff,
+                    attribute_code >> 8])
+                break
+            attribute = self._attribute(device, cluster_code, attribute_code)
+            if attribute is None:
+                status = UNSUPPORTED_ATTRIBUTE
+            elif attribute.type_code != type_code:
+                status = INVALID_DATA_TYPE
+            else:
+                writes.append((attribute, value))
+                continue
+            failed += bytearray([status, attribute_code & 0xff,
+                attribute_code >> 8])
+        # Write Attributes Undivided writes nothing if anything failed
+        if code != 0x03 or not failed:
+            for attribute, value in writes:
+                device.values[(cluster_code, attribute.code)] = value
+                self._value_changed(device, attribute)
+        if code == 0x05:
+            return None
+        # a lone SUCCESS status means every record was written
+        return 0x04, failed or bytearray([SUCCESS])
+
+    def _configure_reporting(self, device, cluster_code, payload):
+        failed = bytearray()
+        offset = 0
+        while offset + 3 <= len(payload):
+            direction = payload[offset]
+            attribute_code = payload[offset + 1] | payload[offset + 2] << 8
+            if direction == 0x01:
+                # a timeout period for reports we'd receive, ignored
+                offset += 5
+                continue
+            type_code = payload[offset + 3]
+            min_interval = payload[offset + 4] | payload[offset + 5] << 8
+            max_interval = payload[offset + 6] | payload[offset + 7] << 8
+            offset += 8
+            change = None
+            attribute = self._attribute(device, cluster_code, attribute_code)
+            if type_code in _analog_type_codes:
+                try:
+                    change, offset = get_codec(zcl.get_type_string(
+                        type_code)).decode(payload, offset)
+                except Exception:
+                    break
+            if attribute is None:
+                failed += bytearray([UNSUPPORTED_ATTRIBUTE, direction,
+                    attribute_code & 0xff, attribute_code >> 8])
+                continue
+            config = ReportingConfig(attribute, min_interval, max_interval,
+                    change)
+            device.reporting[(cluster_code, attribute_code)] = config
+            if max_interval not in [0x0000, 0xFFFF]:
+                self._schedule_report(device, config, max_interval)
+        return 0x07, failed or bytearray([SUCCESS])
+
+    def _discover_attributes(self, device, cluster_code, payload):
+        start = payload[0] | payload[1] << 8
+        cluster = self.model.cluster_by_code(cluster_code)
+        codes = []
+        if cluster is not None:
+            codes = sorted([code for code in cluster.attributes_by_code
+                if code >= start and
+                self._attribute(device, cluster_code, code) is not None])
+        limit = min(payload[2], _discovery_limit)
+        records = bytearray([len(codes) <= limit])
+        for code in codes[:limit]:
+            records += bytearray([code & 0xff, code >> 8,
+                cluster.attribute_by_code(code).type_code])
+        return 0x0D, records
+
+    def _discover_commands_received(self, device, cluster_code, payload):
+        start = payload[0]
+        cluster = self.model.cluster_by_code(cluster_code)
+        codes = []
+        if cluster is not None:
+            codes = sorted(set([code for code, source in
+                cluster.commands_by_code if source == 'client' and
+                code >= start]))
+        limit = min(payload[1], _discovery_limit)
+        return 0x12, bytearray([len(codes) <= limit]) + bytearray(
+                codes[:limit])
+
+    _global_handlers = {
+        0x00: _read_attributes,
+        0x02: lambda self, device, cluster_code, payload:
+            self._write_attributes(device, cluster_code, payload, 0x02),
+        0x03: lambda self, device, cluster_code, payload:
+            self._write_attributes(device, cluster_code, payload, 0x03),
+        0x05: lambda self, device, cluster_code, payload:
+            self._write_attributes(device, cluster_code, payload, 0x05),
+        0x06: _configure_reporting,
+        0x0C: _discover_attributes,
+        0x11: _discover_commands_received,
+    }
+
+    # reporting
+
+    def _schedule_report(self, device, config, delay):
+        def due():
+            key = (config.attribute.cluster_code, config.attribute.code)
+            # a newer configuration replaces this one's timer
+            if device.reporting.get(key) is not config or not device.joined:
+                return
+            if time.time() - config.last_report >= config.max_interval - 0.001:
+                self._report(device, config)
+            self._schedule_report(device, config, config.max_interval -
+                    (time.time() - config.last_report))
+        self.call_later(max(delay, 0), due)
+
+    def _value_changed(self, device, attribute):
+        config = device.reporting.get((attribute.cluster_code, attribute.code))
+        if config is None or config.max_interval == 0xFFFF:
+            return
+        value = device.get(attribute)
+        if config.last_value is not None:
+            if config.change is not None:
+                if abs(value - config.last_value) < config.change:
+                    return
+            elif value == config.last_value:
+                return
+        wait = config.min_interval - (time.time() - config.last_report)
+        if wait <= 0:
+            self._report(device, config)
+        else:
+            self.call_later(wait, lambda: self._value_changed(device,
+                attribute))
+
+    def _report(self, device, config):
+        attribute = config.attribute
+        value = device.get(attribute)
+        config.last_value = value
+        config.last_report = time.time()
+        self.reports_sent += 1
+        self._send_frame(device, attribute.cluster_code, 0x18,
+                device.next_sequence(), 0x0A,
+                bytearray([attribute.code & 0xff, attribute.code >> 8,
+                    attribute.type_code]) + attribute.codec.encode(value))
+
+    def serve(self, host='', port=4900):
+        '''
+        Accepts CLI connections until interrupted.
+        '''
+        server = SimulatorServer((host, port), self)
+        self.start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.stop()
+
+class SimulatorTransport:
+    '''
+    Connects a controller straight to an EmberSimulator in the same process,
+    without a socket, for instance ZBController(SimulatorTransport(sim)).
+    '''
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self._received = Queue.Queue()
+        simulator.add_session(self._received.put)
+
+    def open(self, host, port):
+        pass
+
+    def read_some(self):
+        return self._received.get()
+
+    def write(self, data):
+        for line in data.splitlines():
+            self.simulator.handle_line(line)
+
+    def close(self):
+        self.simulator.remove_session(self._received.put)
+        self._received.put('')
+
+class SimulatorServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, simulator):
+        SocketServer.ThreadingTCPServer.__init__(self, address, CLIHandler)
+        self.simulator = simulator
+
+class CLIHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        simulator = self.server.simulator
+        lock = threading.Lock()
+        def write(data):
+            with lock:
+                self.wfile.write(data)
+                self.wfile.flush()
+        simulator.add_session(write)
+        try:
+            for line in iter(self.rfile.readline, ''):
+                simulator.handle_line(line)
+        except socket.error:
+            pass
+        finally:
+            simulator.remove_session(write)
+
+def main():
+    parser = OptionParser(usage='%prog [options] XML_FILE...')
+    parser.add_option('-p', '--port', type='int', default=4900)
+    parser.add_option('-n', '--devices', type='int', default=100,
+            help='number of virtual devices')
+    parser.add_option('--clusters', help='comma separated cluster IDs ' +
+            'the devices have (default: every cluster in the XML)')
+    parser.add_option('--latency', type='float', default=0.0,
+            help='seconds before a device response is printed')
+    parser.add_option('--jitter', type='float', default=0.0,
+            help='up to this many seconds are added to the latency')
+    parser.add_option('--loss', type='float', default=0.0,
+            help='fraction of device responses lost')
+    parser.add_option('--seed', type='int', help='for repeatable runs')
+    options, xml_files = parser.parse_args()
+    if not xml_files:
+        parser.error('no XML files given')
+    cluster_codes = None
+    if options.clusters:
+        cluster_codes = [_number(code) for code in options.clusters.split(',')]
+    simulator = EmberSimulator(zcl.ZCL(xml_files, lazy=True), options.latency,
+            options.jitter, options.loss, seed=options.seed)
+    simulator.add_devices(options.devices, cluster_codes)
+    print 'Simulating %d devices on port %d' % (options.devices, options.port)
+    try:
+        simulator.serve(port=options.port)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
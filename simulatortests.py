@@ -0,0 +1,60 @@
+'''
+A TestCase base for tests run against an EmberSimulator in the same
+process, through a SimulatorTransport, rather than a gateway.
+'''
+import os
+import unittest
+
+import zcl
+from zigbee import ZBController
+from simulator import EmberSimulator, SimulatorTransport
+
+# a small model covering the clusters the tests use
+TEST_MODEL_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'test_clusters.xml')
+
+class SimulatorTestCase(unittest.TestCase):
+    '''
+    Starts a simulator with device_count devices, joined unless joined is
+    cleared, and opens self.controller on it, an instance of
+    controller_class. With controller_class None, the test opens its own
+    with open_controller(). Everything started is stopped after the test.
+    '''
+    xml_files = [TEST_MODEL_XML]
+    device_count = 1
+    joined = True
+    controller_class = ZBController
+
+    def setUp(self):
+        self.model = zcl.ZCL(self.xml_files)
+        self.simulator = self.start_simulator()
+        self.devices = self.simulator.add_devices(self.device_count,
+                joined=self.joined)
+        self.device = self.devices[0] if self.devices else None
+        self.controller = None
+        if self.controller_class is not None:
+            self.controller = self.open_controller()
+
+    def start_simulator(self, seed=1, **kwargs):
+        '''
+        Starts another simulator of the same model, to be stopped after the
+        test.
+        '''
+        simulator = EmberSimulator(self.model, seed=seed, **kwargs)
+        simulator.start()
+        self.addCleanup(simulator.stop)
+        return simulator
+
+    def open_controller(self, conn=None, hostname='simulator',
+            controller_class=None):
+        '''
+        Opens a controller on conn, a SimulatorTransport to self.simulator by
+        default, to be closed after the test.
+        '''
+        if conn is None:
+            conn = SimulatorTransport(self.simulator)
+        controller = (controller_class or self.controller_class or
+                ZBController)(conn)
+        controller.open(hostname)
+        self.addCleanup(controller.close)
+        return controller
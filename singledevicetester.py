@@ -1,17 +1,92 @@
-from zigbee import ZBController, NetworkOperationError
+from zigbee import AsyncZBController, ZBController, NetworkOperationError, \
+        _validate_payload
 import time
 from ConfigParser import RawConfigParser, NoSectionError, NoOptionError
 
-class SingleDeviceTester(ZBController):
+class DeviceCommands:
+    '''
+    The commands a tester sends to its device under test, dut_node_id, shared
+    by SingleDeviceTester and multidevicetester.DeviceUnderTest. They go out
+    through the controller _dut_controller() returns, and wait settle_delay
+    seconds after each command that changes the device. _expect_zcl_command
+    waits for a command that send_zcl_command didn't already return.
+    '''
+    # the last response send_zcl_command returned, until it's expected
+    _last_response = None
+
+    def settle(self):
+        if self.settle_delay:
+            time.sleep(self.settle_delay)
+
+    def send_zcl_command(self, zcl_command, *args, **kwargs):
+        '''
+        Sends the command to the device under test and waits up to
+        response_timeout seconds (3 by default) for its response or Default
+        Response. Returns the response frame, or None if the device didn't
+        respond in time.
+        '''
+        response_timeout = kwargs.pop('response_timeout', 3)
+        response = AsyncZBController.send_zcl_command(self._dut_controller(),
+                self.dut_node_id, zcl_command, *args, **kwargs)
+        response.wait(response_timeout)
+        self.settle()
+        if response.done():
+            self._last_response = response.result()
+            return self._last_response
+        self._last_response = None
+        return None
+
+    def expect_zcl_command(self, command, timeout=10, source=None):
+        '''
+        Like ZBController.expect_zcl_command, except that the response
+        send_zcl_command just returned counts as arriving after it, so a
+        script can send a command and then expect its response.
+        '''
+        response = self._last_response
+        if (response is not None and response.code == command.code and
+                source in [None, response.source]):
+            self._last_response = None
+            _validate_payload(command.args, response.payload,
+                    getattr(command, 'codec', None))
+            return
+        self._expect_zcl_command(command, timeout, source)
+
+    def read_attribute(self, attribute):
+        return AsyncZBController.read_attribute(self._dut_controller(),
+                self.dut_node_id, attribute).result()
+
+    def write_attribute(self, attribute, value):
+        # returns once the Write Attributes Response arrives
+        AsyncZBController.write_attribute(self._dut_controller(),
+                self.dut_node_id, attribute, value).result()
+        self.settle()
+
+    def write_attributes(self, values, **kwargs):
+        records = AsyncZBController.write_attributes(self._dut_controller(),
+                self.dut_node_id, values, **kwargs).result()
+        self.settle()
+        return records
+
+    def bind_node(self, cluster_id):
+        AsyncZBController.bind_node(self._dut_controller(), self.dut_node_id,
+                self.dut_ieee_address, cluster_id).result()
+
+    def configure_reporting(self, *args):
+        AsyncZBController.configure_reporting(self._dut_controller(),
+                self.dut_node_id, *args).result()
+
+class SingleDeviceTester(DeviceCommands, ZBController):
     '''
     This class is intended to take care of some of the bookkeeping when writing
     test scripts that test a single device. It takes care of including the
     device under test if it hasn't been included already. It also wraps the
     commands that interact with other ZigBee nodes and targets the device under
     test, so the test writer doesn't need to keep track of the device node ID.
+    conn is passed on to ZBController, for instance to replay a recorded
+    session.
     '''
-    def __init__(self):
-        ZBController.__init__(self)
+    def __init__(self, conn=None):
+        ZBController.__init__(self, conn)
         self.load_configs()
         if not self.controller_ip:
             self.controller_ip = raw_input("Please enter the controller IP: ")
@@ -37,6 +112,11 @@ class SingleDeviceTester(ZBController):
             self.dut_node_id = int(self.dut_node_id, 0)
         self.dut_ieee_address = self.get_config_or_none(
                 'device_under_test', 'ieee_address')
+        # some devices need a moment after responding before they're ready
+        # for the next command, so allow an extra delay to be configured
+        self.settle_delay = self.get_config_or_none(
+                'device_under_test', 'settle_delay')
+        self.settle_delay = float(self.settle_delay or 0)
         self.controller_ip = self.get_config_or_none(
                 'controller', 'controller_ip')
 
@@ -60,32 +140,27 @@ class SingleDeviceTester(ZBController):
         try:
             self.enable_permit_join()
             print "Please initiate the inclusion process on the device"
-            self.dut_node_id = ZBController.wait_for_join(self)
+            self._joined(ZBController.wait_for_announce(self))
             self.disable_permit_join()
         except NetworkOperationError:
             print "Error joining device. Trying to form a new network"
             self.form_network()
             self.enable_permit_join()
             print "Please initiate the inclusion process on the device"
-            self.dut_node_id = ZBController.wait_for_join(self)
+            self._joined(ZBController.wait_for_announce(self))
             self.disable_permit_join()
 
-    def send_zcl_command(self, zcl_command, *args, **kwargs):
-        ZBController.send_zcl_command(self, self.dut_node_id, zcl_command, *args, **kwargs)
-        time.sleep(3)
+    def _joined(self, announce):
+        self.dut_node_id = announce.node_id
+        if announce.ieee_address is not None:
+            self.dut_ieee_address = announce.ieee_address
 
-    def read_attribute(self, attribute):
-        value = ZBController.read_attribute(self, self.dut_node_id, attribute)
-        return value
+    def _dut_controller(self):
+        return self
 
-    def write_attribute(self, attribute, value):
-        ZBController.write_attribute(self, self.dut_node_id, attribute, value)
-        time.sleep(4)
-
-    def bind_node(self, cluster_id):
-        ZBController.bind_node(self, self.dut_node_id,
-                               self.dut_ieee_address, cluster_id)
-
-    def configure_reporting(self, *args):
-        ZBController.configure_reporting(self, self.dut_node_id, *args)
+    def _expect_zcl_command(self, command, timeout, source):
+        ZBController.expect_zcl_command(self, command, timeout, source)
 
+    def write_local_attribute(self, attribute, value):
+        ZBController.write_local_attribute(self, attribute, value,
+                self.settle_delay)
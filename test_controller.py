@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import unittest
+
+import zcl
+from codec import get_codec
+from embercli import RXFrame
+from simulatortests import SimulatorTestCase
+
+class ZBControllerTest(SimulatorTestCase):
+    '''
+    Runs the blocking ZBController against simulated devices.
+    '''
+    def test_wait_for_join(self):
+        joining = self.simulator.add_devices(1)[0]
+        # long enough for wait_for_join to be waiting when it announces
+        self.simulator.join_interval = 0.2
+        self.controller.enable_permit_join()
+        self.assertEqual(self.controller.wait_for_join(timeout=1),
+                joining.node_id)
+
+    def test_response_not_taken_from_report(self):
+        on_off = getattr(self.model, 'on/off')
+        self.simulator.latency = 0.1
+        response = self.controller.send_zcl_command(self.device.node_id,
+                on_off.on(), timeout=1)
+        sequence = (self.controller.sequence - 1) % 0x100
+        # another device's Temperature Measurement report, same sequence
+        report = RXFrame(1, 0x0402, 0x18, sequence, 0x0A,
+                bytearray([0x00, 0x00, 0x29, 0x34, 0x08]))
+        self.controller.dispatcher.dispatch_frame(report)
+        self.assertFalse(response.done())
+        self.assertTrue(report.source is None)
+        frame = response.result()
+        self.assertEqual((frame.cluster_code, frame.code, list(frame.payload)),
+                (0x0006, 0x0B, [on_off.on.code, 0x00]))
+
+    def test_write_attribute(self):
+        transition_time = self.model.level_control.on_off_transition_time
+        self.controller.write_attribute(self.device.node_id, transition_time,
+                20, timeout=1)
+        self.assertEqual(self.controller.read_attribute(self.device.node_id,
+            transition_time), 20)
+
+    def missing_attribute(self):
+        # a Level Control attribute the simulated devices don't have
+        attribute = zcl.ZCLAttribute(0x0008)
+        attribute.name = 'missing attribute'
+        attribute.code = 0x4321
+        attribute.type = 'INT8U'
+        attribute.type_code = 0x20
+        attribute.codec = get_codec('INT8U')
+        attribute.size = 1
+        return attribute
+
+    def test_write_attribute_failure_raises(self):
+        attribute = self.missing_attribute()
+        try:
+            self.controller.write_attribute(self.device.node_id, attribute, 1,
+                    timeout=1)
+        except AssertionError as e:
+            self.assertTrue('0x86' in str(e), str(e))
+        else:
+            self.fail('write_attribute returned despite the failure status')
+
+    def test_read_attributes(self):
+        level_control = self.model.level_control
+        on_off = getattr(getattr(self.model, 'on/off'), 'on/off')
+        missing = self.missing_attribute()
+        node = self.device.node_id
+        self.simulator.set_attribute(node, level_control.current_level, 0x42)
+        self.simulator.set_attribute(node, on_off, 1)
+        self.controller.write_attribute(node,
+                level_control.on_off_transition_time, 20, timeout=1)
+        received = self.simulator.frames_received
+        records = self.controller.read_attributes(node,
+                [level_control.current_level, missing,
+                    level_control.on_off_transition_time, on_off], timeout=1)
+        # one frame for each cluster
+        self.assertEqual(self.simulator.frames_received - received, 2)
+        self.assertEqual(dict([(attribute.name, (record.status, record.value))
+            for attribute, record in records.items()]), {
+                'current level': (0x00, 0x42),
+                'missing attribute': (0x86, None),
+                'on off transition time': (0x00, 20),
+                'on/off': (0x00, 1)})
+        self.assertTrue(records[missing].attribute is missing)
+
+    def test_instrumentation(self):
+        instrumentation = self.controller.enable_instrumentation()
+        node = self.device.node_id
+        self.simulator.latency = 0.05
+        self.controller.read_attribute(node,
+                self.model.level_control.current_level, timeout=1)
+        self.assertRaises(AssertionError, self.controller.read_attribute,
+                node, self.missing_attribute(), timeout=1)
+        self.simulator.loss = 1.0
+        self.assertRaises(AssertionError, self.controller.read_attribute,
+                node, self.model.level_control.current_level, timeout=0.2)
+        # a report nobody is waiting for
+        self.controller.dispatcher.dispatch_frame(RXFrame(1, 0x0402, 0x18,
+            0x42, 0x0A, bytearray([0x00, 0x00, 0x29, 0x34, 0x08])))
+        self.assertEqual([instrumentation.count(outcome, 'read_attribute',
+            node, 0x0008) for outcome in ['ok', 'status', 'error', 'timeout']],
+            [1, 1, 0, 1])
+        self.assertEqual(instrumentation.count('unmatched', 'rx'), 1)
+        # timed out operations have no latency to record
+        histogram = instrumentation.histogram('read_attribute', node)
+        self.assertEqual(histogram.count, 2)
+        self.assertTrue(0.05 <= histogram.minimum <= histogram.maximum < 1,
+                histogram)
+        lines = instrumentation.summary().splitlines()
+        self.assertEqual(lines[0].split()[-1], 'unmatched')
+        read, rx = [line.split() for line in lines[1:]]
+        self.assertEqual(read[:2] + read[5:],
+                ['read_attribute', '3', '1', '0', '1', '0'])
+        self.assertEqual(rx, ['rx', '1', '-', '-', '-', '0', '0', '0', '1'])
+
+if __name__ == '__main__':
+    unittest.main()
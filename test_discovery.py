@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import shutil
+import tempfile
+import unittest
+
+import simulator
+from discovery import discover, CapabilityCache
+from simulatortests import SimulatorTestCase
+from zigbee import UnsupportedError
+
+LEVEL_CONTROL = 0x0008
+
+class DiscoverTest(SimulatorTestCase):
+    '''
+    Discovers the capabilities of simulated devices, which have every
+    cluster of the model on endpoint 1 unless they're given others.
+    '''
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.ieee_address = '%016X' % self.device.ieee_address
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_discover(self):
+        capabilities = discover(self.controller, self.device.node_id)
+        self.assertTrue(self.controller.capabilities[self.device.node_id] is
+                capabilities)
+        self.assertEqual([descriptor.endpoint
+            for descriptor in capabilities.endpoints], [1])
+        self.assertEqual(capabilities.attributes[LEVEL_CONTROL],
+                {0x0000: 0x20, 0x0001: 0x21, 0x0010: 0x21})
+        self.assertEqual(capabilities.commands[LEVEL_CONTROL],
+                set([0x00, 0x01]))
+        # the model has no application version
+        self.assertEqual(capabilities.version, [u'', u'', None, u''])
+
+    def test_discovery_pages(self):
+        self.addCleanup(setattr, simulator, '_discovery_limit',
+                simulator._discovery_limit)
+        simulator._discovery_limit = 1
+        received = self.simulator.frames_received
+        self.assertEqual(self.controller.discover_attributes(
+            self.device.node_id, LEVEL_CONTROL, timeout=1),
+            [(0x0000, 0x20), (0x0001, 0x21), (0x0010, 0x21)])
+        self.assertEqual(self.simulator.frames_received - received, 3)
+        self.assertEqual(self.controller.discover_commands_received(
+            self.device.node_id, LEVEL_CONTROL, timeout=1), [0x00, 0x01])
+
+    def test_cache_hit(self):
+        cache = CapabilityCache(self.directory)
+        discovered = discover(self.controller, self.device.node_id,
+                self.ieee_address, cache, timeout=1)
+        received = self.simulator.frames_received
+        # a new cache reads what the first one stored on disk
+        capabilities = discover(self.controller, self.device.node_id,
+                self.ieee_address, CapabilityCache(self.directory), timeout=1)
+        # only the version was read over the air
+        self.assertEqual(self.simulator.frames_received - received, 1)
+        self.assertEqual(capabilities.version, discovered.version)
+        self.assertEqual(capabilities.attributes, discovered.attributes)
+        self.assertEqual(capabilities.commands, discovered.commands)
+        self.assertTrue(self.controller.capabilities[self.device.node_id] is
+                capabilities)
+
+    def test_refetch_on_new_version(self):
+        cache = CapabilityCache(self.directory)
+        discovered = discover(self.controller, self.device.node_id,
+                self.ieee_address, cache, timeout=1)
+        self.simulator.set_attribute(self.device.node_id,
+                self.model.basic.sw_build_id, '2.0')
+        received = self.simulator.frames_received
+        capabilities = discover(self.controller, self.device.node_id,
+                self.ieee_address, cache, timeout=1)
+        self.assertTrue(capabilities is not discovered)
+        self.assertTrue(self.simulator.frames_received - received > 1)
+        self.assertEqual(capabilities.version[3], u'2.0')
+        self.assertEqual(cache.get(self.ieee_address).version,
+                capabilities.version)
+
+    def test_unsupported_device(self):
+        # only an On/off server, so no Basic cluster to read a version from
+        device = self.simulator.add_devices(1, [0x0006], joined=True)[0]
+        capabilities = discover(self.controller, device.node_id, timeout=1)
+        self.assertEqual(capabilities.version, None)
+        self.assertEqual(capabilities.server_clusters(), [0x0006])
+        self.assertFalse(capabilities.supports_command(LEVEL_CONTROL, 0x00))
+        received = self.simulator.frames_received
+        self.assertRaises(UnsupportedError, self.controller.read_attribute,
+                device.node_id, self.model.level_control.current_level)
+        self.assertEqual(self.simulator.frames_received, received)
+
+if __name__ == '__main__':
+    unittest.main()
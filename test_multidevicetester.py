@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+import unittest
+
+from pool import ZBControllerPool
+from multidevicetester import MultiDeviceTester
+from simulatortests import SimulatorTestCase
+
+class MultiDeviceTesterTest(SimulatorTestCase):
+    '''
+    Runs tests on a batch of simulated devices behind one gateway.
+    '''
+    device_count = 3
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.pool = ZBControllerPool()
+        self.pool.add_controller(self.controller)
+        self.tester = MultiDeviceTester(roster=None, pool=self.pool)
+        for number, device in enumerate(self.devices):
+            self.tester.add_device('dut%02d' % number, device.node_id)
+
+    def test_send_then_expect_response(self):
+        on_off = getattr(self.model, 'on/off')
+        default_response = self.model.global_.default_response
+        def test(dut):
+            dut.send_zcl_command(on_off.toggle())
+            dut.expect_zcl_command(default_response(on_off.toggle.code, 0x00),
+                    timeout=1)
+        results = self.tester.run(test, timeout=10)
+        self.assertEqual([result.error for result in results],
+                [None] * len(results))
+
+    def test_write_then_read(self):
+        transition_time = self.model.level_control.on_off_transition_time
+        def test(dut):
+            value = 0x100 + dut.node_id % 0x100
+            dut.write_attribute(transition_time, value)
+            return value, dut.read_attribute(transition_time)
+        results = self.tester.run(test, timeout=10)
+        for result in results:
+            self.assertEqual(result.error, None)
+            written, read = result.value
+            self.assertEqual(read, written)
+
+if __name__ == '__main__':
+    unittest.main()
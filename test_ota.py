@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+import os
+import Queue
+import shutil
+import struct
+import tempfile
+import unittest
+
+import zigbee
+from embercli import RXFrame
+from simulatortests import SimulatorTestCase
+from ota import OTAImage, OTAServer, InvalidImageError, FILE_IDENTIFIER, \
+        OTA_CLUSTER, SUCCESS, NO_IMAGE_AVAILABLE
+
+HEADER_SIZE = 56
+
+def write_image(filename, manufacturer_code=0x1002, image_type=0x0000,
+        file_version=0x00000002, data_size=500, identifier=FILE_IDENTIFIER,
+        size=None):
+    '''
+    Writes an OTA upgrade file whose data after the header counts up from
+    zero.
+    '''
+    if size is None:
+        size = HEADER_SIZE + data_size
+    header = struct.pack('<IHHHHHIH32sI', identifier, 0x0100, HEADER_SIZE,
+            0x0000, manufacturer_code, image_type, file_version, 0x0002,
+            'test image', size)
+    with open(filename, 'wb') as image_file:
+        image_file.write(header + ''.join([chr(i % 0x100)
+            for i in xrange(data_size)]))
+    return filename
+
+class OTAImageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_header(self):
+        image = OTAImage(write_image(self.path('light.ota')))
+        self.assertEqual(image.key(), (0x1002, 0x0000, 0x00000002))
+        self.assertEqual((image.header_version, image.header_length,
+            image.stack_version, image.header_string),
+            (0x0100, HEADER_SIZE, 0x0002, 'test image'))
+        self.assertEqual(image.size, HEADER_SIZE + 500)
+        image.close()
+
+    def test_block(self):
+        image = OTAImage(write_image(self.path('light.ota')))
+        self.assertEqual(image.block(HEADER_SIZE, 4), '\x00\x01\x02\x03')
+        # the last block stops at the end of the image
+        self.assertEqual(len(image.block(image.size - 10, 64)), 10)
+        image.close()
+
+    def test_invalid(self):
+        write_image(self.path('short.ota'), data_size=0)
+        with open(self.path('short.ota'), 'r+b') as image_file:
+            image_file.truncate(HEADER_SIZE - 1)
+        write_image(self.path('other.ota'), identifier=0x12345678)
+        write_image(self.path('cut.ota'), size=HEADER_SIZE + 1000)
+        open(self.path('empty.ota'), 'wb').close()
+        for name in ['short.ota', 'other.ota', 'cut.ota', 'empty.ota']:
+            self.assertRaises(InvalidImageError, OTAImage, self.path(name))
+
+class FakeController:
+    '''
+    Stands in for a controller, keeping whatever the server sends.
+    '''
+    hostname = 'fake'
+
+    def __init__(self):
+        self.dispatcher = zigbee.FrameDispatcher()
+        self.sent = Queue.Queue()
+        self.sequence = 0
+
+    def send_frame(self, destination, cluster_code, frame_control, code,
+            payload, sequence=None, response=None):
+        if sequence is None:
+            self.sequence = (self.sequence + 1) % 0x100
+            sequence = self.sequence
+        self.sent.put((destination, code, bytearray(payload)))
+        return sequence
+
+    def receive(self, code, payload, sequence=0x10):
+        # cluster specific, client to server
+        self.dispatcher.dispatch_frame(RXFrame(1, OTA_CLUSTER, 0x01, sequence,
+            code, bytearray(payload)))
+
+    def next_sent(self):
+        return self.sent.get(timeout=1)
+
+class OTAServerTest(unittest.TestCase):
+    '''
+    Plays the part of one device against an OTAServer.
+    '''
+    node = 0x1234
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image = OTAImage(write_image(os.path.join(self.directory,
+            'light.ota')))
+        self.server = OTAServer(block_size=64)
+        self.controller = FakeController()
+        self.session = self.server.upgrade(self.controller, self.node,
+                self.image)
+        destination, code, payload = self.controller.next_sent()
+        self.assertEqual((destination, code), (self.node, 0x00))
+
+    def tearDown(self):
+        self.server.close()
+        self.image.close()
+        shutil.rmtree(self.directory)
+
+    def query(self, current_version=0x00000001):
+        self.controller.receive(0x01, struct.pack('<BHHI', 0x00, 0x1002,
+            0x0000, current_version))
+        return self.controller.next_sent()
+
+    def request_block(self, offset, size):
+        self.controller.receive(0x03, struct.pack('<BHHIIB', 0x00, 0x1002,
+            0x0000, 0x00000002, offset, size))
+        return self.controller.next_sent()
+
+    def test_query_next_image(self):
+        _, code, payload = self.query()
+        self.assertEqual(code, 0x02)
+        self.assertEqual(struct.unpack('<BHHII', str(payload)),
+                (SUCCESS, 0x1002, 0x0000, 0x00000002, self.image.size))
+        self.assertEqual(self.session.state, 'downloading')
+
+    def test_query_when_current(self):
+        _, code, payload = self.query(current_version=0x00000002)
+        self.assertEqual((code, list(payload)), (0x02, [NO_IMAGE_AVAILABLE]))
+        self.assertTrue(self.session.future.wait(1))
+        self.assertEqual(self.session.state, 'current')
+
+    def test_image_block(self):
+        self.query()
+        _, code, payload = self.request_block(0, 48)
+        self.assertEqual(code, 0x05)
+        self.assertEqual(struct.unpack_from('<BHHIIB', str(payload)),
+                (SUCCESS, 0x1002, 0x0000, 0x00000002, 0, 48))
+        self.assertEqual(str(payload[14:]), self.image.block(0, 48))
+        # capped at the server's block size
+        _, code, payload = self.request_block(48, 100)
+        self.assertEqual(payload[13], 64)
+        self.assertEqual(str(payload[14:]), self.image.block(48, 64))
+        self.assertEqual(self.session.offset, 112)
+
+    def test_image_page(self):
+        self.query()
+        self.controller.receive(0x04, struct.pack('<BHHIIBHH', 0x00, 0x1002,
+            0x0000, 0x00000002, 0, 64, 200, 0))
+        sizes = [self.controller.next_sent()[2][13] for _ in xrange(4)]
+        self.assertEqual(sizes, [64, 64, 64, 8])
+        self.assertRaises(Queue.Empty, self.controller.sent.get, timeout=0.1)
+
+    def test_upgrade_end(self):
+        self.query()
+        offset = 0
+        while offset < self.image.size:
+            _, _, payload = self.request_block(offset, 64)
+            offset += payload[13]
+        self.assertEqual(self.session.state, 'verifying')
+        self.controller.receive(0x06, struct.pack('<BHHI', SUCCESS, 0x1002,
+            0x0000, 0x00000002))
+        _, code, payload = self.controller.next_sent()
+        self.assertEqual(code, 0x07)
+        self.assertEqual(struct.unpack_from('<HHI', str(payload)),
+                (0x1002, 0x0000, 0x00000002))
+        self.assertTrue(self.session.future.wait(1))
+        self.assertEqual(self.session.state, 'done')
+
+    def test_upgrade_end_failure(self):
+        self.query()
+        self.request_block(0, 64)
+        # the device gives up part way through
+        self.controller.receive(0x06, struct.pack('<BHHI', 0x96, 0x1002,
+            0x0000, 0x00000002))
+        self.assertTrue(self.session.future.wait(1))
+        self.assertEqual((self.session.state, self.session.status),
+                ('failed', 0x96))
+
+class SimulatedUpgradeTest(SimulatorTestCase):
+    '''
+    Upgrades simulated devices, which download the image a block at a time.
+    '''
+    device_count = 3
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.server = OTAServer(block_size=64)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_upgrade_all(self):
+        image = self.server.add_image(write_image(os.path.join(
+            self.directory, 'light.ota')))
+        sessions = self.server.upgrade_all(self.controller,
+                [device.node_id for device in self.devices], image,
+                timeout=10)
+        self.assertEqual(sorted([session.state
+            for session in sessions.values()]), ['done'] * 3)
+        for device in self.devices:
+            self.assertEqual((device.file_version, device.upgrades),
+                    (0x00000002, 1))
+        image.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import threading
+import time
+import unittest
+
+from simulatortests import SimulatorTestCase
+from zigbee import AsyncZBController, OutboundQueue, Future, gather
+
+class RecordingConnection:
+    '''
+    Stands in for a gateway connection, keeping each write with the time
+    it was made. Writes wait while release is cleared.
+    '''
+    def __init__(self):
+        self.writes = []
+        self.release = threading.Event()
+        self.release.set()
+        self._condition = threading.Condition()
+
+    def write(self, data):
+        self.release.wait(5)
+        with self._condition:
+            self.writes.append((time.time(), data))
+            self._condition.notify_all()
+
+    def wait_for_lines(self, count, timeout=2):
+        deadline = time.time() + timeout
+        with self._condition:
+            while len(self.lines()) < count and time.time() < deadline:
+                self._condition.wait(0.01)
+            return self.lines()
+
+    def lines(self):
+        return [line for _, data in self.writes
+                for line in data.splitlines()]
+
+    def line_times(self):
+        return [written for written, data in self.writes
+                for _ in data.splitlines()]
+
+class OutboundQueueTest(unittest.TestCase):
+    '''
+    Checks how an OutboundQueue paces, holds back and batches the commands
+    it writes.
+    '''
+    def setUp(self):
+        self.conn = RecordingConnection()
+        self.queue = None
+
+    def tearDown(self):
+        self.conn.release.set()
+        if self.queue is not None:
+            self.queue.close()
+
+    def open_queue(self, **kwargs):
+        self.queue = OutboundQueue(self.conn, **kwargs)
+        return self.queue
+
+    def put_commands(self, count, responses=None):
+        for number in xrange(count):
+            self.queue.put(['command %d' % number],
+                    responses and responses[number])
+
+    def test_rate(self):
+        self.open_queue(rate=20)
+        self.put_commands(5)
+        self.assertTrue(self.queue.flush(2))
+        self.assertEqual(self.conn.wait_for_lines(5),
+                ['command %d' % number for number in xrange(5)])
+        times = self.conn.line_times()
+        for earlier, later in zip(times, times[1:]):
+            self.assertTrue(later - earlier >= 0.04, later - earlier)
+        self.assertEqual(self.queue.writes, 5)
+
+    def test_burst(self):
+        self.open_queue(rate=10, burst=3)
+        self.put_commands(5)
+        self.assertTrue(self.queue.flush(2))
+        times = self.conn.line_times()
+        self.assertEqual(len(times), 5)
+        # the first three go out at once, then the rest at the rate
+        self.assertTrue(times[2] - times[0] < 0.05, times[2] - times[0])
+        self.assertTrue(times[3] - times[2] >= 0.08, times[3] - times[2])
+        self.assertTrue(times[4] - times[3] >= 0.08, times[4] - times[3])
+
+    def test_max_in_flight(self):
+        self.open_queue(max_in_flight=2)
+        # the second never completes, but its deadline frees its slot
+        responses = [Future(), Future(time.time() + 0.3), Future()]
+        self.put_commands(3, responses)
+        self.assertEqual(len(self.conn.wait_for_lines(2)), 2)
+        time.sleep(0.1)
+        self.assertEqual(len(self.conn.lines()), 2)
+        responses[0].set_result(None)
+        self.assertEqual(len(self.conn.wait_for_lines(3)), 3)
+        # both slots are taken again until the second's deadline passes
+        started = time.time()
+        self.queue.put(['command 3'])
+        self.assertEqual(len(self.conn.wait_for_lines(4)), 4)
+        self.assertTrue(time.time() - started >= 0.1)
+
+    def test_maxlen_blocks_callers(self):
+        self.open_queue(max_in_flight=1, maxlen=2)
+        held = Future()
+        self.queue.put(['held'], held)
+        self.conn.wait_for_lines(1)
+        # the writer holds these back while held is in flight
+        self.put_commands(2)
+        put = threading.Thread(target=self.queue.put, args=(['blocked'],))
+        put.daemon = True
+        put.start()
+        put.join(0.2)
+        self.assertTrue(put.is_alive())
+        self.assertEqual(self.queue.blocked, 1)
+        held.set_result(None)
+        put.join(1)
+        self.assertFalse(put.is_alive())
+        self.assertTrue(self.queue.flush(1))
+        self.assertEqual(self.conn.lines(),
+                ['held', 'command 0', 'command 1', 'blocked'])
+
+    def test_lines_joined_into_one_write(self):
+        self.open_queue()
+        self.conn.release.clear()
+        self.queue.put(['raw first', 'send first'])
+        # the writer is stuck writing the first command while these queue
+        time.sleep(0.05)
+        for name in ['second', 'third']:
+            self.queue.put(['raw ' + name, 'send ' + name])
+        self.conn.release.set()
+        self.assertTrue(self.queue.flush(1))
+        self.conn.wait_for_lines(6)
+        self.assertEqual([data for _, data in self.conn.writes],
+                ['raw first\nsend first\n',
+                    'raw second\nsend second\nraw third\nsend third\n'])
+        self.assertEqual((self.queue.commands, self.queue.writes), (3, 2))
+
+class ControllerOutboundQueueTest(SimulatorTestCase):
+    '''
+    Reads attributes through a controller with an outbound queue.
+    '''
+    device_count = 3
+    controller_class = AsyncZBController
+
+    def test_reads_through_queue(self):
+        current_level = self.model.level_control.current_level
+        for level, device in enumerate(self.devices):
+            self.simulator.set_attribute(device.node_id, current_level,
+                    level + 1)
+        queue = self.controller.enable_outbound_queue(rate=50, burst=1,
+                max_in_flight=1)
+        self.assertTrue(self.controller.enable_outbound_queue() is queue)
+        levels = gather([self.controller.read_attribute(device.node_id,
+            current_level, timeout=1) for device in self.devices])
+        self.assertEqual(levels, [1, 2, 3])
+        # one at a time, each after the previous one's response
+        self.assertEqual((queue.commands, queue.writes), (3, 3))
+
+if __name__ == '__main__':
+    unittest.main()
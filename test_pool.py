@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import time
+import unittest
+
+from pool import ZBControllerPool, UnknownDeviceError
+from simulator import SimulatorTransport
+from simulatortests import SimulatorTestCase
+
+class ZBControllerPoolTest(SimulatorTestCase):
+    '''
+    Runs a pool of two simulated gateways, each with its own devices.
+    '''
+    device_count = 3
+    joined = False
+    controller_class = None
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.current_level = self.model.level_control.current_level
+        self.simulators = [self.simulator, self.start_simulator(seed=2)]
+        self.simulators[1].add_devices(self.device_count)
+        self.pool = ZBControllerPool()
+        for number, sim in enumerate(self.simulators):
+            self.pool.add_controller(self.open_controller(
+                SimulatorTransport(sim), 'gw%d' % (number + 1)))
+
+    def join_all(self):
+        self.pool.enable_permit_join()
+        deadline = time.time() + 2
+        while len(self.pool.devices) < 6 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.pool.devices), 6)
+
+    def test_join_assigns_gateway(self):
+        self.join_all()
+        for sim, controller in zip(self.simulators, self.pool.controllers):
+            self.assertEqual(self.pool.nodes_on(controller),
+                    sorted(sim.devices))
+            for node in sim.devices:
+                self.assertTrue(self.pool.controller_for(node) is controller)
+
+    def test_wait_for_join(self):
+        for sim in self.simulators:
+            # long enough for wait_for_join to be waiting when they announce
+            sim.join_interval = 0.2
+        self.pool.enable_permit_join()
+        node = self.pool.wait_for_join(2)
+        self.assertTrue(any([node in sim.devices for sim in self.simulators]))
+        self.pool.disable_permit_join()
+
+    def test_read_through_owning_gateway(self):
+        self.join_all()
+        expected = {}
+        for sim in self.simulators:
+            for level, node in enumerate(sorted(sim.devices)):
+                sim.set_attribute(node, self.current_level, level + 1)
+                expected[node] = level + 1
+        for node, level in expected.items():
+            self.assertEqual(self.pool.read_attribute(node,
+                self.current_level, timeout=1), level)
+        results, errors = self.pool.read_attribute_all(self.current_level,
+                timeout=1)
+        self.assertEqual((results, errors), (expected, {}))
+
+    def test_write_attribute_all(self):
+        self.join_all()
+        results, errors = self.pool.write_attribute_all(self.current_level,
+                0x33, timeout=1)
+        self.assertEqual(errors, {})
+        self.assertEqual(sorted(results), sorted(self.pool.devices))
+        for sim in self.simulators:
+            for device in sim.devices.values():
+                self.assertEqual(device.get(self.current_level), 0x33)
+
+    def test_unknown_device(self):
+        self.join_all()
+        unknown = 0xFFFE
+        self.assertRaises(UnknownDeviceError, self.pool.read_attribute,
+                unknown, self.current_level)
+        known = sorted(self.pool.devices)[0]
+        results, errors = self.pool.read_attribute_all(self.current_level,
+                [known, unknown], timeout=1)
+        self.assertEqual(results, {known: 0})
+        self.assertTrue(isinstance(errors[unknown], UnknownDeviceError))
+
+    def test_gateway_failure_keeps_other_results(self):
+        self.join_all()
+        lossy, working = self.simulators
+        lossy.loss = 1.0
+        results, errors = self.pool.read_attribute_all(self.current_level,
+                timeout=0.5)
+        self.assertEqual(sorted(results), sorted(working.devices))
+        self.assertEqual(sorted(errors), sorted(lossy.devices))
+        for error in errors.values():
+            self.assertTrue('TIMED OUT' in str(error), str(error))
+
+if __name__ == '__main__':
+    unittest.main()
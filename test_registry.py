@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+from registry import DeviceRegistry, commission
+from simulatortests import SimulatorTestCase
+
+def state(registry):
+    return sorted([(device.ieee_address, device.node_id, device.gateway,
+        device.first_seen) for device in registry.devices])
+
+class DeviceRegistryJournalTest(unittest.TestCase):
+    '''
+    Writes journals, and checks what reopening them rebuilds.
+    '''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'devices.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_registry(self, **kwargs):
+        registry = DeviceRegistry(self.filename, **kwargs)
+        self.addCleanup(registry.close)
+        return registry
+
+    def journal_lines(self):
+        with open(self.filename) as journal:
+            return journal.readlines()
+
+    def test_reopen(self):
+        registry = self.open_registry()
+        registry.record(0x3F21, '000D6F0000A1B2C3', 'gw1', seen=1)
+        registry.record(0x8A4C, '000D6F0000D4E5F6', 'gw1', seen=2)
+        registry.record(0x3F21, '000D6F0000112233', 'gw2', seen=3)
+        # unchanged, so not written
+        registry.record(0x3F21, '000D6F0000A1B2C3', 'gw1', seen=4)
+        # rejoined with a new node ID
+        registry.record(0x1234, '000D6F0000A1B2C3', 'gw1', seen=5)
+        registry.close()
+        self.assertEqual(len(self.journal_lines()), 4)
+        reopened = self.open_registry()
+        self.assertEqual(state(reopened), state(registry))
+        self.assertEqual(reopened.stale, 1)
+        device = reopened.by_ieee('000d6f0000a1b2c3')
+        self.assertEqual((device.node_id, device.gateway, device.first_seen),
+                (0x1234, 'gw1', 1))
+        self.assertEqual(reopened.get(0x3F21, 'gw1'), None)
+        self.assertEqual([device.gateway
+            for device in reopened.by_node(0x3F21)], ['gw2'])
+
+    def test_line_cut_short(self):
+        registry = self.open_registry()
+        registry.record(0x3F21, '000D6F0000A1B2C3', 'gw1')
+        registry.close()
+        with open(self.filename, 'a') as journal:
+            journal.write(self.journal_lines()[0][:20])
+        reopened = self.open_registry()
+        self.assertEqual(state(reopened), state(registry))
+        self.assertEqual(reopened.stale, 1)
+
+    def test_compaction(self):
+        registry = self.open_registry(compact_threshold=3)
+        registry.record(0x0001, '000D6F0000A1B2C3', 'gw1', seen=1)
+        registry.record(0x0002, '000D6F0000D4E5F6', 'gw1', seen=2)
+        for node_id in xrange(0x0010, 0x0013):
+            registry.record(node_id, '000D6F0000A1B2C3', 'gw1')
+        self.assertEqual((registry.stale, len(self.journal_lines())), (3, 5))
+        # the fourth superseded line is one too many
+        registry.record(0x0020, '000D6F0000A1B2C3', 'gw1')
+        self.assertEqual((registry.stale, len(self.journal_lines())), (0, 2))
+        # still appended to after compacting
+        registry.record(0x0030, '000D6F0000D4E5F6', 'gw1')
+        registry.close()
+        self.assertEqual(len(self.journal_lines()), 3)
+        reopened = self.open_registry()
+        self.assertEqual(state(reopened), state(registry))
+        self.assertEqual([device.first_seen for device in reopened.devices],
+                [1, 2])
+        reopened.compact()
+        self.assertEqual((reopened.stale, len(self.journal_lines())), (0, 2))
+        self.assertFalse(os.path.exists(self.filename + '.new'))
+
+class CommissionTest(SimulatorTestCase):
+    '''
+    Commissions simulated devices onto a registry.
+    '''
+    device_count = 3
+    joined = False
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.registry = DeviceRegistry(None)
+
+    def test_commission(self):
+        seen = []
+        joined = commission(self.controller, self.registry, count=3,
+                timeout=5, on_join=seen.append)
+        self.assertEqual(joined, seen)
+        self.assertEqual(sorted([(device.ieee_address, device.node_id,
+            device.gateway) for device in joined]),
+            sorted([('%016X' % device.ieee_address, device.node_id,
+                'simulator') for device in self.devices]))
+        self.assertEqual(self.registry.gateways(), ['simulator'])
+
+    def test_rejoin_with_new_node_id(self):
+        commission(self.controller, self.registry, count=3, timeout=5)
+        old_node_id = self.device.node_id
+        # long enough for commission to be listening when it announces
+        self.simulator.join_interval = 0.2
+        new_node_id = self.simulator.rejoin(old_node_id)
+        [device] = commission(self.controller, self.registry, count=1,
+                timeout=5)
+        self.assertEqual((device.ieee_address, device.node_id),
+                ('%016X' % self.device.ieee_address, new_node_id))
+        self.assertTrue(self.registry.by_ieee(device.ieee_address) is device)
+        self.assertEqual(self.registry.get(old_node_id, 'simulator'), None)
+        self.assertEqual(len(self.registry), 3)
+
+    def test_timeout(self):
+        joined = commission(self.controller, self.registry, count=4,
+                timeout=0.5)
+        self.assertEqual(len(joined), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import struct
+import unittest
+
+import zcl
+import zigbee
+from simulatortests import SimulatorTestCase
+
+class EmberSimulatorTest(SimulatorTestCase):
+    '''
+    Drives an EmberSimulator through a controller on a SimulatorTransport.
+    '''
+    def test_form(self):
+        self.controller.form_network()
+        self.assertTrue(self.simulator.network_up)
+        # forming again answers "already in a network", which isn't an error
+        self.controller.form_network()
+
+    def test_join(self):
+        joining = self.simulator.add_devices(2)
+        announces = [self.controller.dispatcher.expect_event('announce',
+            timeout=1) for _ in joining]
+        self.controller.enable_permit_join()
+        announced = dict([(event.node_id, event.ieee_address)
+            for event in zigbee.gather(announces)])
+        self.assertEqual(announced, dict([(device.node_id,
+            '%016X' % device.ieee_address) for device in joining]))
+        self.assertTrue(all([device.joined for device in joining]))
+
+    def test_read(self):
+        current_level = self.model.level_control.current_level
+        self.assertEqual(self.controller.read_attribute(self.device.node_id,
+            current_level, timeout=1), 0)
+        self.simulator.set_attribute(self.device.node_id, current_level, 0x7F)
+        self.assertEqual(self.controller.read_attribute(self.device.node_id,
+            current_level, timeout=1), 0x7F)
+
+    def test_read_unsupported_attribute(self):
+        attribute = zcl.ZCLAttribute(0x0008)
+        attribute.name = 'missing attribute'
+        attribute.code = 0x4321
+        try:
+            self.controller.read_attribute(self.device.node_id, attribute,
+                    timeout=1)
+        except AssertionError as e:
+            self.assertTrue('0x86' in str(e), str(e))
+        else:
+            self.fail('read_attribute returned an unsupported attribute')
+
+    def test_write(self):
+        transition_time = self.model.level_control.on_off_transition_time
+        self.controller.write_attribute(self.device.node_id, transition_time,
+                300, timeout=1)
+        self.assertEqual(self.device.get(transition_time), 300)
+
+    def test_report_on_max_interval(self):
+        current_level = self.model.level_control.current_level
+        with self.controller.subscribe_reports([current_level]) as reports:
+            self.controller.configure_reporting(self.device.node_id,
+                    current_level, 0, 1, 10, timeout=1)
+            self.simulator.set_attribute(self.device.node_id, current_level,
+                    0x20)
+            self.assertEqual(reports.get(timeout=1).value, 0x20)
+            # nothing changes, so the next one is on the maximum interval
+            self.assertEqual(reports.get(timeout=2).value, 0x20)
+        self.assertEqual(self.simulator.reports_sent, 2)
+
+    def test_report_on_change(self):
+        current_level = self.model.level_control.current_level
+        with self.controller.subscribe_reports([current_level]) as reports:
+            self.controller.configure_reporting(self.device.node_id,
+                    current_level, 0, 60, 10, timeout=1)
+            self.simulator.set_attribute(self.device.node_id, current_level,
+                    0x20)
+            self.assertEqual(reports.get(timeout=1).value, 0x20)
+            # less than the reportable change
+            self.simulator.set_attribute(self.device.node_id, current_level,
+                    0x25)
+            self.simulator.set_attribute(self.device.node_id, current_level,
+                    0x40)
+            self.assertEqual(reports.get(timeout=1).value, 0x40)
+        self.assertEqual(self.simulator.reports_sent, 2)
+
+    def test_ota_notify_queries_next_image(self):
+        ota = self.model.over_the_air_bootloading
+        query = self.controller.dispatcher.expect_frame(ota.code, 0x01,
+                timeout=1)
+        self.controller.send_zcl_ota_notify(self.device.node_id,
+                ota.image_notify(0x00, 100, 0x1002, 0x0000, 0x00000002))
+        frame = query.result()
+        self.assertTrue(frame.is_cluster_specific())
+        self.assertEqual(struct.unpack('<BHHI', str(frame.payload)),
+                (0x00, self.device.manufacturer_code, self.device.image_type,
+                    self.device.file_version))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+from simulator import SimulatorTransport
+from simulatortests import SimulatorTestCase
+from singledevicetester import SingleDeviceTester
+
+class SingleDeviceTesterTest(SimulatorTestCase):
+    '''
+    Runs a SingleDeviceTester against one simulated device, configured in a
+    singledevice.cfg written to a scratch directory.
+    '''
+    controller_class = None
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        with open('singledevice.cfg', 'w') as config_file:
+            config_file.write('[controller]\ncontroller_ip = simulator\n'
+                    '[device_under_test]\nnode_id = 0x%04X\n'
+                    'ieee_address = %016X\n' % (self.device.node_id,
+                        self.device.ieee_address))
+        self.tester = SingleDeviceTester(SimulatorTransport(self.simulator))
+        self.addCleanup(self.tester.close)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_send_then_expect_response(self):
+        on_off = getattr(self.model, 'on/off')
+        default_response = self.model.global_.default_response
+        response = self.tester.send_zcl_command(on_off.on())
+        self.assertEqual(response.code, default_response.code)
+        self.tester.expect_zcl_command(default_response(on_off.on.code, 0x00),
+                timeout=1)
+
+    def test_expect_validates_response(self):
+        on_off = getattr(self.model, 'on/off')
+        self.tester.send_zcl_command(on_off.on())
+        self.assertRaises(AssertionError, self.tester.expect_zcl_command,
+                self.model.global_.default_response(on_off.on.code, 0x81),
+                timeout=1)
+
+    def test_response_is_expected_once(self):
+        on_off = getattr(self.model, 'on/off')
+        default_response = self.model.global_.default_response(
+                on_off.on.code, None)
+        self.tester.send_zcl_command(on_off.on())
+        self.tester.expect_zcl_command(default_response, timeout=1)
+        self.assertRaises(AssertionError, self.tester.expect_zcl_command,
+                default_response, timeout=0.2)
+
+if __name__ == '__main__':
+    unittest.main()
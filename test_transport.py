@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+from simulator import SimulatorTransport
+from simulatortests import SimulatorTestCase
+from transport import RecordingTransport, ReplayTransport, ReplayError
+
+class RecordReplayTest(SimulatorTestCase):
+    '''
+    Records a session with a simulated gateway, then replays it without one.
+    '''
+    joined = False
+    controller_class = None
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'session.log')
+        # long enough for wait_for_announce to be waiting when it announces
+        self.simulator.join_interval = 0.2
+        self.simulator.set_attribute(self.device.node_id,
+                self.model.level_control.current_level, 0x42)
+        controller = self.open_controller(RecordingTransport(
+            SimulatorTransport(self.simulator), self.log))
+        self.recorded = self.session(controller)
+        controller.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def session(self, controller):
+        controller.form_network()
+        controller.enable_permit_join()
+        announce = controller.wait_for_announce(timeout=2)
+        return announce.node_id, controller.read_attribute(announce.node_id,
+                self.model.level_control.current_level, timeout=1)
+
+    def test_replay(self):
+        self.assertEqual(self.recorded, (self.device.node_id, 0x42))
+        transport = ReplayTransport(self.log)
+        controller = self.open_controller(transport)
+        self.assertEqual(self.session(controller), self.recorded)
+        self.assertTrue(transport.done())
+
+    def test_replay_realtime(self):
+        controller = self.open_controller(ReplayTransport(self.log,
+            realtime=True))
+        self.assertEqual(self.session(controller), self.recorded)
+
+    def test_strict_mismatch(self):
+        controller = self.open_controller(ReplayTransport(self.log))
+        # the recording formed the network on the default channel
+        self.assertRaises(ReplayError, controller.form_network, channel=20)
+
+if __name__ == '__main__':
+    unittest.main()
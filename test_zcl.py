@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+import os
+import glob
+import shutil
+import tempfile
+import cPickle
+import unittest
+
+import zcl
+from simulatortests import TEST_MODEL_XML
+
+# a manufacturer's additions to the test model, in a file of their own
+EXTENSION_XML = '''<?xml version="1.0"?>
+<configurator>
+  <domain name="Manufacturer"/>
+  <enum name="StepMode" type="ENUM8">
+    <item name="Up" value="0x00"/>
+    <item name="Down" value="0x01"/>
+  </enum>
+  <clusterExtension code="0x0008">
+    <attribute side="server" code="0x4000" define="STEP_SIZE" type="INT8U" writable="true" optional="true">step size</attribute>
+    <command source="client" code="0x40" name="StepToMax" optional="true">
+      <arg name="transitionTime" type="INT16U"/>
+    </command>
+  </clusterExtension>
+</configurator>
+'''
+
+def describe(model):
+    '''
+    Returns what a test can compare of a model: each cluster with its
+    commands and attributes, the global commands and the enums.
+    '''
+    def commands(cluster):
+        return sorted([(key, command.name, [param.type
+            for param in command.params])
+            for key, command in cluster.commands_by_code.items()])
+    clusters = {}
+    for code in model.cluster_codes():
+        cluster = model.cluster_by_code(code)
+        clusters[code] = (cluster.name, cluster.define, commands(cluster),
+                sorted([(attribute.code, attribute.name, attribute.type)
+                    for attribute in cluster.attributes_by_code.values()]))
+    return (clusters, commands(model.global_), model.move_mode.values,
+            model.step_mode.values)
+
+class ZCLModelTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.extension = os.path.join(self.directory, 'extension.xml')
+        with open(self.extension, 'w') as extension_file:
+            extension_file.write(EXTENSION_XML)
+        self.xml_files = [TEST_MODEL_XML, self.extension]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lazy_matches_eager(self):
+        eager = zcl.ZCL(self.xml_files)
+        lazy = zcl.ZCL(self.xml_files, lazy=True)
+        self.assertEqual(describe(lazy), describe(eager))
+        self.assertEqual(lazy.level_control.step_size.code, 0x4000)
+        self.assertEqual(lazy.level_control.step_to_max.code, 0x40)
+
+    def cached_paths(self):
+        return glob.glob(os.path.join(self.directory, 'cache', '*.pickle'))
+
+    def load_cached(self):
+        return zcl.ZCL.load_cached(self.xml_files,
+                os.path.join(self.directory, 'cache'))
+
+    def replace_cache(self, path, data):
+        with open(path, 'wb') as cache_file:
+            cache_file.write(data)
+
+    def test_load_cached(self):
+        model = self.load_cached()
+        self.assertEqual(describe(model), describe(zcl.ZCL(self.xml_files)))
+        [path] = self.cached_paths()
+        self.assertEqual(describe(cPickle.load(open(path, 'rb'))),
+                describe(model))
+        # what's in the cache is returned as it is
+        self.replace_cache(path, cPickle.dumps('cached'))
+        self.assertEqual(self.load_cached(), 'cached')
+
+    def test_xml_change_invalidates(self):
+        self.load_cached()
+        [path] = self.cached_paths()
+        self.replace_cache(path, cPickle.dumps('stale'))
+        with open(self.extension, 'w') as extension_file:
+            extension_file.write(EXTENSION_XML.replace('step size',
+                'step limit'))
+        model = self.load_cached()
+        self.assertEqual(model.level_control.step_limit.code, 0x4000)
+        self.assertEqual(len(self.cached_paths()), 2)
+
+    def test_cache_version_change_invalidates(self):
+        self.load_cached()
+        [path] = self.cached_paths()
+        self.replace_cache(path, cPickle.dumps('stale'))
+        self.addCleanup(setattr, zcl, 'CACHE_VERSION', zcl.CACHE_VERSION)
+        zcl.CACHE_VERSION += 1
+        self.assertEqual(self.load_cached().level_control.code, 0x0008)
+        self.assertEqual(len(self.cached_paths()), 2)
+
+    def test_corrupt_cache_rebuilt(self):
+        self.load_cached()
+        [path] = self.cached_paths()
+        good = open(path, 'rb').read()
+        # empty, not a pickle, cut short, and of a class since renamed
+        for data in ['', 'garbage', good[:len(good) // 2],
+                'czcl\nNoSuchClass\n.']:
+            self.replace_cache(path, data)
+            self.assertEqual(self.load_cached().level_control.code, 0x0008)
+            # and cached again
+            self.assertEqual(describe(cPickle.load(open(path, 'rb'))),
+                    describe(zcl.ZCL(self.xml_files)))
+
+if __name__ == '__main__':
+    unittest.main()
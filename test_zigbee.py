@@ -1,28 +1,36 @@
 #!/usr/bin/env python
 import zigbee
+import zcl
 import sys
 
-class TelnetMock():
-    def __init__(self):
-        self.read_buffer = []
-    def expect(self, regexes, timeout):
-        return None, None, None
+class TransportMock():
+    '''
+    Stands in for the gateway connection and prints whatever is written.
+    Nothing is ever received, so commands time out.
+    '''
+    def open(self, host, port):
+        pass
+    def read_some(self):
+        return ''
     def write(self, data):
         sys.stdout.write(data)
-    def read_until(self, regex, timeout):
-        return []
-    def read_eager(self):
-        return []
+    def close(self):
+        pass
 
-z = zigbee.ZCL(['ha.xml', 'ha12.xml'])
-conn = zigbee.ZBController()
-conn.conn = TelnetMock()
+z = zcl.ZCL(['ha.xml', 'ha12.xml'])
+conn = zigbee.ZBController(TransportMock())
+conn.open('localhost')
 conn.send_zcl_command(0x1234, z.door_lock.set_p_i_n(7,1,1,4, "1234"))
 
-a = zigbee.ZCLAttribute()
+a = zcl.ZCLAttribute(123)
+a.name = 'test attribute'
 a.cluster_code = 123
 a.code = 456
-a.type_code = 789
+a.type_code = 0x21
 a.type = 'INT16U'
 
-conn.write_attribute(0x1234, a, 255)
+try:
+    conn.write_attribute(0x1234, a, 255, timeout=1)
+except AssertionError as e:
+    # nothing answers the TransportMock
+    print e
@@ -0,0 +1,201 @@
+'''
+Connections a controller can talk to a gateway through.
+
+A controller's conn can be anything with these methods, which
+telnetlib.Telnet already has:
+
+    open(host, port)    connect
+    read_some()         return some received data, waiting for it if there's
+                        none, or '' once the connection is closed
+    write(data)         send data
+    close()
+
+RecordingTransport wraps a real connection and logs every line sent and
+received, with the time since the session started, to a file:
+
+    0.000000 TX network pjoin 0xff
+    0.041330 RX pJoin for 255 sec: 0x00
+
+ReplayTransport plays such a log back without a gateway. It checks that the
+controller writes the recorded lines in order, and releases the lines
+received after each of them once it has been written, either with the
+recorded delays or as fast as possible. A released line is only read once
+the controller is waiting for it, so a device announcing itself a while
+after permit join was enabled still arrives after the script starts
+waiting for it, as it did when recorded.
+'''
+import time
+import heapq
+import threading
+
+from embercli import parse_line
+
+# seconds between checks for a waiter to take a line that's being held
+HOLD_POLL = 0.01
+
+class RecordingTransport:
+    '''
+    Passes everything through to another connection, and logs it to
+    filename.
+    '''
+    def __init__(self, conn, filename):
+        self.conn = conn
+        self.log = open(filename, 'w')
+        self.start = time.time()
+        self._received = ''
+        self._lock = threading.Lock()
+
+    def _record(self, direction, line):
+        with self._lock:
+            self.log.write('%f %s %s\n' % (time.time() - self.start,
+                direction, line.rstrip('\r')))
+            self.log.flush()
+
+    def open(self, host, port):
+        self.conn.open(host, port)
+
+    def read_some(self):
+        data = self.conn.read_some()
+        self._received += data
+        lines = self._received.split('\n')
+        self._received = lines.pop()
+        for line in lines:
+            self._record('RX', line)
+        return data
+
+    def write(self, data):
+        for line in data.splitlines():
+            self._record('TX', line)
+        self.conn.write(data)
+
+    def close(self):
+        self.conn.close()
+        with self._lock:
+            self.log.close()
+
+def load_recording(filename):
+    '''
+    Reads a log written by RecordingTransport into a list of (time,
+    direction, line).
+    '''
+    records = []
+    with open(filename) as log:
+        for line in log:
+            timestamp, direction, text = (line.rstrip('\n').split(' ', 2) +
+                    [''])[:3]
+            records.append((float(timestamp), direction, text))
+    return records
+
+class ReplayTransport:
+    '''
+    Serves a recorded session back to a controller. Lines received before
+    the first line written are available right away, and each line written
+    releases the received lines that followed it in the recording. With
+    realtime set they arrive with the same delays as when recorded,
+    otherwise immediately.
+
+    Once the controller has attached its FrameDispatcher, which open() does,
+    a released line is held until something is waiting for it, or until
+    the next recorded line is written, since by then it had arrived in the
+    recording whether anyone took it or not.
+
+    With strict set, writing anything other than the next recorded line
+    raises a ReplayError, so a test that has drifted from its recording
+    fails instead of hanging.
+    '''
+    def __init__(self, filename, realtime=False, strict=True):
+        self.records = load_recording(filename)
+        self.realtime = realtime
+        self.strict = strict
+        self.closed = False
+        self._position = 0
+        # position of the last line written
+        self._written = -1
+        self._dispatcher = None
+        # (time due, position, line)
+        self._ready = []
+        self._condition = threading.Condition()
+        with self._condition:
+            self._release(0.0)
+
+    def _release(self, written):
+        '''
+        Schedules the received lines that follow the current position, which
+        were recorded at the given time relative to the last line written.
+        '''
+        now = time.time()
+        while (self._position < len(self.records) and
+                self.records[self._position][1] == 'RX'):
+            recorded, _, line = self.records[self._position]
+            due = now
+            if self.realtime:
+                due += recorded - written
+            heapq.heappush(self._ready, (due, self._position, line))
+            self._position += 1
+        self._condition.notify_all()
+
+    def open(self, host, port):
+        pass
+
+    def attach(self, dispatcher):
+        with self._condition:
+            self._dispatcher = dispatcher
+
+    def _wanted(self, position, line):
+        if self._dispatcher is None or position < self._written:
+            return True
+        event = parse_line(line.strip())
+        return event is None or self._dispatcher.wants(event)
+
+    def write(self, data):
+        with self._condition:
+            for line in data.splitlines():
+                if self._position >= len(self.records):
+                    raise ReplayError('%r written after the end of the '
+                            'recording' % line)
+                recorded, _, expected = self.records[self._position]
+                if self.strict and line != expected:
+                    raise ReplayError('expected %r to be written, got %r' %
+                            (expected, line))
+                self._written = self._position
+                self._position += 1
+                self._release(recorded)
+
+    def read_some(self):
+        with self._condition:
+            while True:
+                now = time.time()
+                lines = []
+                while self._ready and self._ready[0][0] <= now:
+                    _, position, line = self._ready[0]
+                    if not self._wanted(position, line):
+                        break
+                    lines.append(heapq.heappop(self._ready)[2])
+                if lines:
+                    return ''.join([line + '\n' for line in lines])
+                if self.closed or (not self._ready and
+                        self._position >= len(self.records)):
+                    return ''
+                if self._ready and self._ready[0][0] <= now:
+                    # held until the controller waits for it, which doesn't
+                    # notify us
+                    self._condition.wait(HOLD_POLL)
+                elif self._ready:
+                    self._condition.wait(min(self._ready[0][0] - now, 1))
+                else:
+                    self._condition.wait(1)
+
+    def done(self):
+        '''
+        Returns True once every recorded line has been written and read.
+        '''
+        with self._condition:
+            return not self._ready and self._position >= len(self.records)
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+class ReplayError(StandardError):
+    pass
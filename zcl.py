@@ -1,9 +1,22 @@
-import xml.etree.ElementTree as xml
+try:
+    import xml.etree.cElementTree as xml
+except ImportError:
+    import xml.etree.ElementTree as xml
 import string
 import doctest
+import os
+import hashlib
+import tempfile
+import cPickle
+import threading
+from codec import get_codec, compile_payload
 
 class ZCLCluster:
     def __init__(self, cluster_xml, has_metadata=True):
+        # commands are indexed by (code, source), as client and server
+        # commands in the same cluster can share a code
+        self.commands_by_code = {}
+        self.attributes_by_code = {}
         if has_metadata:
             self.name = cluster_xml.find('name').text
             self.define = cluster_xml.find('define').text
@@ -15,25 +28,59 @@ class ZCLCluster:
 
     def add_commands(self, cluster_xml):
         for cmd_xml in cluster_xml.findall('command'):
-            setattr(self,
-                    _attr_from_name(cmd_xml.get('name')),
-                    ZCLCommandPrototype(self.code, cmd_xml))
+            command = ZCLCommandPrototype(self.code, cmd_xml)
+            setattr(self, _attr_from_name(cmd_xml.get('name')), command)
+            if command.source == 'either':
+                sources = ['client', 'server']
+            else:
+                sources = [command.source]
+            for source in sources:
+                self.commands_by_code[(command.code, source)] = command
 
     def add_attributes(self, cluster_xml):
         for attr_xml in cluster_xml.findall('attribute'):
-            setattr(self,
-                    _attr_from_name(attr_xml.text),
-                    ZCLAttribute(self.code, attr_xml))
-
-class ZCLCommandCall:
-    def __init__(self, proto, arglist):
-        self.cluster_code = proto.cluster_code
-        self.code = proto.code
-        self.name = proto.name
-        # copy the list to make sure there's no interaction with the given payload
-        # note that we're not going as far as copying all the arguments.
-        # maybe we should?
-        self.args = list(arglist)
+            attribute = ZCLAttribute(self.code, attr_xml)
+            setattr(self, _attr_from_name(attr_xml.text), attribute)
+            self.attributes_by_code[attribute.code] = attribute
+
+    def command_by_code(self, code, source='client'):
+        '''
+        Returns the ZCLCommandPrototype with the given command ID, sent by
+        the given side ('client' or 'server'), or None if there isn't one.
+        '''
+        return self.commands_by_code.get((code, source))
+
+    def attribute_by_code(self, code):
+        '''
+        Returns the ZCLAttribute with the given attribute ID, or None if
+        there isn't one.
+        '''
+        return self.attributes_by_code.get(code)
+
+class ZCLCommandCall(object):
+    '''
+    A call to a ZCL command, which is just its prototype and a tuple of the
+    argument values. cluster_code is normally the prototype's, but global
+    commands can be for any cluster. The ZCLCommandArg list in args is only
+    built when it's asked for.
+    '''
+    __slots__ = ('proto', 'values', 'cluster_code')
+
+    def __init__(self, proto, values, cluster_code=None):
+        self.proto = proto
+        self.values = tuple(values)
+        if cluster_code is None:
+            cluster_code = proto.cluster_code
+        self.cluster_code = cluster_code
+
+    code = property(lambda self: self.proto.code)
+    name = property(lambda self: self.proto.name)
+    codec = property(lambda self: self.proto.codec)
+
+    @property
+    def args(self):
+        return tuple([ZCLCommandArg(param.name, param.type, value)
+                for param, value in zip(self.proto.params, self.values)])
 
 class ZCLCommandPrototype:
     '''
@@ -48,60 +95,154 @@ class ZCLCommandPrototype:
         self.cluster_code = cluster_code
         self.name = cmd_xml.get('name')
         self.code = int(cmd_xml.get('code'), 0)
+        self.source = cmd_xml.get('source', 'client')
         # <pedantic>function parameters are mistakenly called
         # 'args' in the xml </pedantic>
-        self.params = [ZCLCommandParam(xml) for xml in cmd_xml.findall('arg')]
+        self.params = _intern_params([(xml.get('name'), xml.get('type'))
+            for xml in cmd_xml.findall('arg')])
+        # compiled once here so every call can encode and decode its payload
+        # without looking at the types again
+        self.codec = compile_payload([param.type for param in self.params])
     def __call__(self, *args):
         if len(args) != len(self.params):
             raise TypeError("%s() takes exactly %d arguments (%d given)\n" %
                     (_attr_from_name(self.name), len(self.params), len(args)) +
                     "\n".join(["\t\t%s (%s)" % (param.name, param.type) for
                         param in self.params]))
-        arglist = [ZCLCommandArg(param.name, param.type, val) for param, val
-                in zip(self.params, args)]
-        return ZCLCommandCall(self, arglist)
+        return ZCLCommandCall(self, args)
+
+class ZCLCommandParam(object):
+    __slots__ = ('name', 'type')
+
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+
+_interned_params = {}
+
+def _intern_params(signature):
+    '''
+    Returns a tuple of ZCLCommandParams for a list of (name, type) pairs.
+    Commands with the same signature share the same tuple.
+    '''
+    signature = tuple([(intern(name), intern(type)) for name, type in signature])
+    try:
+        return _interned_params[signature]
+    except KeyError:
+        params = _interned_params[signature] = tuple(
+                [ZCLCommandParam(name, type) for name, type in signature])
+        return params
 
-class ZCLCommandParam:
-    def __init__(self, param_xml):
-        self.name = param_xml.get('name')
-        self.type = param_xml.get('type')
+class ZCLCommandArg(object):
+    __slots__ = ('name', 'type', 'value')
 
-class ZCLCommandArg:
     def __init__(self, name, type, value):
         self.name = name
         self.type = type
         self.value = value
 
-class ZCLAttribute:
+class ZCLAttribute(object):
+    __slots__ = ('name', 'cluster_code', 'code', 'type', 'type_code', 'codec',
+            'size')
+
     def __init__(self, cluster_code, attr_xml=None):
+        '''
+        Without attr_xml, only cluster_code is set, and the rest is left for
+        the caller to fill in.
+
+        >>> ZCLAttribute(0x0006).cluster_code
+        6
+        '''
+        self.cluster_code = cluster_code
         if attr_xml is None:
             return
         self.name = attr_xml.text
-        self.cluster_code = cluster_code
         self.code = int(attr_xml.get('code'), 0)
-        self.type = attr_xml.get('type')
+        self.type = intern(attr_xml.get('type'))
         self.type_code = zcl_attribute_type_codes[self.type]
-        if self.type in ['INT16U', 'INT16S', 'ENUM16', 'BITMAP16']:
-            self.size = 2
-        elif self.type in ['INT32U', 'INT32S', 'ENUM32', 'UTC_TIME', 'BITMAP32', 'IEEE_ADDRESS']:
-            self.size = 4
-        elif self.type in ['CHAR_STRING', 'OCTET_STRING']:
-            self.size = None
-        else:
-            self.size = 1
+        self.codec = get_codec(self.type)
+        # None for variable length types like strings
+        self.size = self.codec.size
+
+class ZCLEnum(object):
+    '''
+    An enumerated type, with each possible value as a Python attribute.
+    '''
+    __slots__ = ('name', 'values')
 
-class ZCLEnum:
     def __init__(self, enum_xml):
         self.name = enum_xml.get('name')
-        for item_xml in enum_xml.findall('item'):
-            setattr(self, _attr_from_name(item_xml.get('name')),
-                int(item_xml.get('value'),0))
+        self.values = dict([(_attr_from_name(item_xml.get('name')),
+            int(item_xml.get('value'), 0))
+            for item_xml in enum_xml.findall('item')])
+
+    def __getattr__(self, name):
+        # values may not be set yet while unpickling
+        try:
+            return object.__getattribute__(self, 'values')[name]
+        except (KeyError, AttributeError):
+            raise AttributeError(name)
+
+    def __dir__(self):
+        return sorted(self.values.keys() + list(self.__slots__))
+
+# bump this whenever the model classes change, so stale caches are ignored
+CACHE_VERSION = 4
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'zigsnake')
 
 class ZCL:
-    def __init__(self, xml_files = None):
-        clusters = []
+    @classmethod
+    def load_cached(cls, xml_files, cache_dir=None):
+        '''
+        Returns the ZCL model for the given XML files, loading it from an
+        on-disk cache when one was built from files with the same contents.
+        Otherwise the files are parsed as usual and the result is cached for
+        next time.
+        '''
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        path = os.path.join(cache_dir, 'zcl-%s.pickle' % _model_key(xml_files))
+        try:
+            with open(path, 'rb') as cache_file:
+                return cPickle.load(cache_file)
+        except (IOError, OSError, EOFError, ValueError, cPickle.UnpicklingError,
+                ImportError, AttributeError):
+            # missing, corrupt, or pickled from classes since renamed, so
+            # rebuild it
+            pass
+        model = cls(xml_files)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # write to a temporary file first so a concurrent reader never
+            # sees a partial cache
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as cache_file:
+                cPickle.dump(model, cache_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            # caching is only an optimization
+            pass
+        return model
+
+    def __init__(self, xml_files = None, lazy=False):
+        '''
+        Builds the model from the given Ember XML files. With lazy=True the
+        files are only scanned, and each cluster (with its commands, ZigBee
+        attributes and extensions) or enum is built the first time it's
+        accessed, which is much quicker and lighter when a script only uses
+        a few clusters.
+        '''
+        self.clusters_by_code = {}
+        # functions building the objects that haven't been accessed yet in
+        # lazy mode, by Python attribute name, and cluster code
+        self._pending = {}
+        self._pending_codes = {}
         if not xml_files:
             return
+        if lazy:
+            self._scan(xml_files)
+            return
         for xml_file in xml_files:
             tree = xml.parse(xml_file)
             root = tree.getroot()
@@ -109,20 +250,141 @@ class ZCL:
             for global_xml in root.iter('global'):
                 setattr(self, 'global_', ZCLCluster(global_xml, has_metadata=False))
             for cluster_xml in root.iter('cluster'):
-                setattr(self,
-                        _attr_from_name(cluster_xml.find('name').text),
-                        ZCLCluster(cluster_xml))
+                cluster = ZCLCluster(cluster_xml)
+                setattr(self, _attr_from_name(cluster.name), cluster)
+                self.clusters_by_code[cluster.code] = cluster
             for extension_xml in root.iter('clusterExtension'):
-                for cluster in (getattr(self, match) for match in dir(self)):
-                    if cluster.__class__ == ZCLCluster \
-                            and cluster.code == int(extension_xml.get('code'), 0):
-                        cluster.add_commands(extension_xml)
-                        cluster.add_attributes(extension_xml)
+                cluster = self.cluster_by_code(
+                        int(extension_xml.get('code'), 0))
+                if cluster is not None:
+                    cluster.add_commands(extension_xml)
+                    cluster.add_attributes(extension_xml)
             for enum_xml in root.iter('enum'):
                 setattr(self,
                         _attr_from_name(enum_xml.get('name')),
                         ZCLEnum(enum_xml))
 
+    def _scan(self, xml_files):
+        self._build_lock = threading.Lock()
+        # as when building eagerly, extensions apply to the latest definition
+        # of their cluster in this file or earlier ones
+        extensions_by_code = {}
+        for xml_file in xml_files:
+            clusters = []
+            extensions = []
+            depth = 0
+            for event, element in xml.iterparse(xml_file, ('start', 'end')):
+                if event == 'start':
+                    if not depth:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                kept = True
+                if element.tag == 'global':
+                    self._defer('global_', lambda global_xml=element:
+                            ZCLCluster(global_xml, has_metadata=False))
+                elif element.tag == 'cluster':
+                    clusters.append(element)
+                elif element.tag == 'clusterExtension':
+                    extensions.append(element)
+                elif element.tag == 'enum':
+                    self._defer(_attr_from_name(element.get('name')),
+                            lambda enum_xml=element: ZCLEnum(enum_xml))
+                else:
+                    kept = False
+                if depth == 1:
+                    # the elements kept for building later are all that's
+                    # left of the file once it's scanned
+                    if not kept:
+                        element.clear()
+                    root.remove(element)
+            for cluster_xml in clusters:
+                code = int(cluster_xml.find('code').text, 0)
+                extensions_by_code[code] = []
+                self._defer_cluster(cluster_xml, code, extensions_by_code[code])
+            for extension_xml in extensions:
+                code = int(extension_xml.get('code'), 0)
+                if code in extensions_by_code:
+                    extensions_by_code[code].append(extension_xml)
+
+    def _defer_cluster(self, cluster_xml, code, extensions):
+        def build():
+            cluster = ZCLCluster(cluster_xml)
+            for extension_xml in extensions:
+                cluster.add_commands(extension_xml)
+                cluster.add_attributes(extension_xml)
+            self.clusters_by_code[code] = cluster
+            return cluster
+        name = _attr_from_name(cluster_xml.find('name').text)
+        self._defer(name, build)
+        self._pending_codes[code] = name
+
+    def _defer(self, name, build):
+        self._pending[name] = build
+        # a later definition replaces anything built from an earlier one
+        self.__dict__.pop(name, None)
+
+    def __getattr__(self, name):
+        # only called for Python attributes that don't exist yet
+        pending = self.__dict__.get('_pending')
+        if not pending or name not in pending:
+            raise AttributeError(name)
+        with self._build_lock:
+            if name in pending:
+                setattr(self, name, pending.pop(name)())
+        return self.__dict__[name]
+
+    def cluster_by_code(self, code):
+        '''
+        Returns the ZCLCluster with the given cluster ID, or None if there
+        isn't one. The global commands are in global_, not here.
+        '''
+        cluster = self.clusters_by_code.get(code)
+        if cluster is None and code in self._pending_codes:
+            getattr(self, self._pending_codes[code])
+            cluster = self.clusters_by_code.get(code)
+        return cluster
+
+    def cluster_codes(self):
+        '''
+        Returns the sorted IDs of every cluster in the model, including the
+        ones a lazy model hasn't built yet.
+        '''
+        return sorted(set(self.clusters_by_code) | set(self._pending_codes))
+
+    def decode_frame(self, frame):
+        '''
+        Looks up the command for a received frame (anything with
+        cluster_code, code, frame_control and payload, like an RXFrame) and
+        returns it as a ZCLCommandCall with the decoded argument values, or
+        None if the command isn't in the model.
+        '''
+        if frame.frame_control & 0x01:
+            cluster = self.cluster_by_code(frame.cluster_code)
+        else:
+            cluster = getattr(self, 'global_', None)
+        if cluster is None:
+            return None
+        source = 'server' if frame.frame_control & 0x08 else 'client'
+        command = cluster.command_by_code(frame.code, source)
+        if command is None:
+            return None
+        values, _ = command.codec.decode(frame.payload)
+        # global commands apply to whichever cluster the frame was for
+        return ZCLCommandCall(command, values, frame.cluster_code)
+
+def _model_key(xml_files):
+    '''
+    Hashes the contents of the XML files, in order, along with the cache
+    version, to name the cache for the model built from them.
+    '''
+    digest = hashlib.sha1('%d' % CACHE_VERSION)
+    for xml_file in xml_files:
+        with open(xml_file, 'rb') as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
+
 def _attr_from_name(name):
     '''
     This assumes that the name is either in CamelCase or
@@ -4,6 +4,14 @@ import zcl
 import inspect
 import time
 import sys
+import socket
+import struct
+import threading
+import collections
+from codec import get_codec, compile_payload, hex_string, UnknownTypeCodec
+from embercli import RXFrame, CLIEvent, parse_line
+from instrumentation import Instrumentation
+from samples import SampleStore, READ, REPORT
 
 def write_log(level, log_string):
     pass
@@ -40,84 +48,1094 @@ class Between(Validator):
         if received < self.low or received > self.high:
             raise AssertionError("Received %d, not between %d and %d" % (received, self.low, self.high))
 
-class ZBController:
-    def __init__(self):
-        self.conn = Telnet()
+class Future:
+    '''
+    The eventual result of an operation started on an AsyncZBController.
+    result() blocks until the operation completes and returns its value, or
+    raises the operation's error. Operations carry their own deadline, so
+    result() raises once it passes even if no timeout is given.
+    '''
+    def __init__(self, deadline=None, timeout_error=None):
+        self.deadline = deadline
+        self.timeout_error = timeout_error
+        self.on_timeout = None
+        self._value = None
+        self._exception = None
+        self._callbacks = []
+        self._event = threading.Event()
+        # guards completing against adding callbacks, so each callback runs
+        # exactly once
+        self._lock = threading.Lock()
+
+    def set_result(self, value):
+        self._value = value
+        self._complete()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._complete()
+
+    def _complete(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        '''
+        Calls callback(future) when the future completes, or right away if
+        it already has. Callbacks for responses run on the reader thread, so
+        they should return quickly.
+
+        >>> calls = []
+        >>> future = Future()
+        >>> future.add_done_callback(lambda f: calls.append('first'))
+        >>> future.set_result(1)
+        >>> future.add_done_callback(lambda f: calls.append('second'))
+        >>> calls
+        ['first', 'second']
+        '''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self._event.is_set()
+
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the future to complete, up to its deadline or the given
+        timeout in seconds, whichever comes first. Returns True if it did.
+        '''
+        limit = _deadline(timeout)
+        # waiting in short slices keeps the main thread interruptible
+        while not self._event.is_set():
+            deadlines = [d for d in [limit, self.deadline] if d is not None]
+            if not deadlines:
+                self._event.wait(1)
+            else:
+                remaining = min(deadlines) - time.time()
+                if remaining <= 0:
+                    break
+                self._event.wait(min(remaining, 1))
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            if self.on_timeout is not None:
+                self.on_timeout(self)
+            raise self.timeout_error or TimeoutError()
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+    def then(self, function):
+        '''
+        Returns a new Future that completes with function(result) once this
+        one completes. Exceptions raised by function are raised from the new
+        future's result(). If function returns another Future, the new future
+        completes with that one instead. function runs on the reader thread,
+        so it must not block.
+        '''
+        chained = Future(self.deadline, self.timeout_error)
+        chained.on_timeout = lambda _: (self.on_timeout and self.on_timeout(self))
+        def copy(source):
+            if source._exception is not None:
+                chained.set_exception(source._exception)
+            else:
+                chained.set_result(source._value)
+        def done(_):
+            if self._exception is not None:
+                chained.set_exception(self._exception)
+                return
+            try:
+                value = function(self._value)
+            except Exception as e:
+                chained.set_exception(e)
+                return
+            if isinstance(value, Future):
+                chained.deadline = value.deadline
+                chained.timeout_error = value.timeout_error
+                chained.on_timeout = value.on_timeout
+                value.add_done_callback(copy)
+            else:
+                chained.set_result(value)
+        self.add_done_callback(done)
+        return chained
+
+def gather(futures, timeout=None):
+    '''
+    Waits for all the given futures and returns their results in order. As
+    the operations are already in flight, this takes as long as the slowest
+    one rather than the sum of them.
+    '''
+    return [future.result(timeout) for future in futures]
+
+def _combine(futures, function):
+    '''
+    Returns a Future that completes with function(results) once all the
+    given futures complete, or with the first exception raised by one.
+    '''
+    deadlines = [f.deadline for f in futures if f.deadline is not None]
+    combined = Future(max(deadlines) if deadlines else None)
+    combined.on_timeout = lambda _: [f.on_timeout(f) for f in futures
+            if f.on_timeout is not None and not f.done()]
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def done(future):
+        with lock:
+            if combined.done():
+                return
+            if future._exception is not None:
+                combined.set_exception(future._exception)
+                return
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            combined.set_result(function([f._value for f in futures]))
+        except Exception as e:
+            combined.set_exception(e)
+    for future in futures:
+        future.add_done_callback(done)
+    if not futures:
+        combined.set_result(function([]))
+    return combined
+
+class AttributeRecord:
+    '''
+    One attribute's record from a Read Attributes Response. value is None
+    unless status is 0x00 (SUCCESS).
+    '''
+    def __init__(self, attribute, status, value=None):
+        self.attribute = attribute
+        self.status = status
+        self.value = value
+
+    def __repr__(self):
+        return 'AttributeRecord(%s, 0x%02X, %r)' % (self.attribute.name,
+                self.status, self.value)
+
+class PendingResponse(Future):
+    '''
+    Something a caller is waiting to receive from the gateway. The
+    FrameDispatcher resolves it from the reader thread with the first
+    matching RXFrame or CLIEvent.
+    '''
+    def __init__(self, matches, deadline=None, timeout_error=None):
+        Future.__init__(self, deadline, timeout_error)
+        self.matches = matches
+        self.source = None
+        self.sequence = None
+
+class FrameDispatcher:
+    '''
+    Routes every line read from the gateway to whoever is waiting for it.
+    Each line is parsed once by embercli.parse_line. Frame waiters are indexed
+    by command ID (None for any command) and then matched on source, cluster
+    and sequence number, so many transactions can be in flight at once. Other
+    events are indexed by kind and matched on their fields. Frames nobody was
+    waiting for are kept in a bounded history and passed to any registered
+    listeners instead of being dropped, and passed to the
+    unmatched_listeners as well. Every CLIEvent is also passed to the
+    event_listeners, before it resolves any waiter.
+
+    A frame answering one of our requests goes to the request's waiter
+    (the one expecting its sequence number) even when a looser waiter, such
+    as expect_zcl_command's, was registered first, so one transaction's
+    response can't be taken for an unsolicited command.
+    '''
+    def __init__(self, history=256):
+        self._lock = threading.Lock()
+        self._frame_waiters = {}
+        self._event_waiters = {}
+        self.listeners = []
+        self.event_listeners = []
+        self.unmatched_listeners = []
+        self.unmatched = collections.deque(maxlen=history)
+
+    def expect_frame(self, cluster_code=None, code=None, sequence=None,
+            source=None, timeout=None, timeout_error=None, accept=None):
+        '''
+        Registers interest in a ZCL frame. Any criteria given as None are
+        ignored, and accept, if given, is called with each frame that meets
+        the others to decide. Register before sending the request so the
+        response can't slip past. The waiter is dropped once the timeout
+        expires.
+
+        The CLI doesn't print who sent a frame, so source only rules out
+        frames already known to come from another node.
+        '''
+        def matches(frame):
+            return ((cluster_code is None or frame.cluster_code == cluster_code)
+                    and (sequence is None or frame.sequence == sequence)
+                    and (source is None or frame.source in [None, source])
+                    and (accept is None or accept(frame)))
+        pending = PendingResponse(matches, _deadline(timeout), timeout_error)
+        pending.source = source
+        pending.sequence = sequence
+        pending.on_timeout = self.cancel
+        with self._lock:
+            self._frame_waiters.setdefault(code, []).append(pending)
+        return pending
+
+    def expect_event(self, kind, timeout=None, timeout_error=None,
+            **fields):
+        '''
+        Registers interest in a CLIEvent of the given kind, such as a ZDO or
+        network status, whose fields equal the ones given.
+        '''
+        def matches(event):
+            for name, value in fields.items():
+                if getattr(event, name) != value:
+                    return False
+            return True
+        pending = PendingResponse(matches, _deadline(timeout), timeout_error)
+        pending.on_timeout = self.cancel
+        with self._lock:
+            self._event_waiters.setdefault(kind, []).append(pending)
+        return pending
+
+    def wants(self, event):
+        '''
+        Returns True if a waiter or listener would take the RXFrame or
+        CLIEvent if it were dispatched now.
+        '''
+        if event.kind == 'rx':
+            if self.listeners:
+                return True
+            with self._lock:
+                waiters = (self._frame_waiters.get(event.code, []) +
+                        self._frame_waiters.get(None, []))
+                return any([not pending.expired() and pending.matches(event)
+                    for pending in waiters])
+        if self.event_listeners:
+            return True
+        with self._lock:
+            return any([not pending.expired() and pending.matches(event)
+                for pending in self._event_waiters.get(event.kind, [])])
+
+    def cancel(self, pending):
+        with self._lock:
+            for waiters in (self._frame_waiters.values() +
+                    self._event_waiters.values()):
+                if pending in waiters:
+                    waiters.remove(pending)
+
+    def dispatch_line(self, line):
+        event = parse_line(line)
+        if event is None:
+            return
+        if event.kind == 'rx':
+            self.dispatch_frame(event)
+        else:
+            self.dispatch_event(event)
+
+    def dispatch_event(self, event):
+        for listener in list(self.event_listeners):
+            listener(event)
+        with self._lock:
+            waiters = self._event_waiters.get(event.kind, [])
+            waiters[:] = [pending for pending in waiters
+                    if not pending.expired()]
+            for pending in waiters:
+                if pending.matches(event):
+                    waiters.remove(pending)
+                    break
+            else:
+                return
+        pending.set_result(event)
+
+    def dispatch_frame(self, frame):
+        matched = None
+        loose = None
+        with self._lock:
+            for code in [frame.code, None]:
+                waiters = self._frame_waiters.get(code, [])
+                waiters[:] = [pending for pending in waiters
+                        if not pending.expired()]
+                for pending in waiters:
+                    if pending.matches(frame):
+                        if pending.sequence is not None:
+                            matched = (waiters, pending)
+                            break
+                        if loose is None:
+                            loose = (waiters, pending)
+                if matched is not None:
+                    break
+            matched = matched or loose
+            if matched is None:
+                self.unmatched.append(frame)
+            else:
+                waiters, matched = matched
+                waiters.remove(matched)
+        if matched is not None:
+            if frame.source is None:
+                frame.source = matched.source
+            matched.set_result(frame)
+        else:
+            for listener in list(self.unmatched_listeners):
+                listener(frame)
+        for listener in list(self.listeners):
+            listener(frame)
+
+class AttributeReport(object):
+    '''
+    One attribute's record from a Report Attributes frame. attribute is the
+    ZCLAttribute when the subscription was given ZigBee attributes, and None
+    otherwise. source is None unless known, as the CLI doesn't print it.
+    '''
+    __slots__ = ('source', 'cluster_code', 'attribute_code', 'type_code',
+            'value', 'attribute', 'received')
+
+    def __init__(self, source, cluster_code, attribute_code, type_code, value,
+            attribute=None, received=None):
+        self.source = source
+        self.cluster_code = cluster_code
+        self.attribute_code = attribute_code
+        self.type_code = type_code
+        self.value = value
+        self.attribute = attribute
+        self.received = received
+
+    def __repr__(self):
+        return 'AttributeReport(clus 0x%04X, attr 0x%04X, %r)' % (
+                self.cluster_code, self.attribute_code, self.value)
+
+class ReportSubscription:
+    '''
+    A stream of the attribute reports (Report Attributes, command 0x0A)
+    received from the gateway. Iterate over it, or call get(), to consume
+    the reports in order:
+
+    >>> with con.subscribe_reports([z.metering.current_summation_delivered]
+    ...         ) as reports: # doctest: +SKIP
+    ...     for report in reports:
+    ...         print report.value
+
+    Reports are decoded on the reader thread and wait for the consumer in a
+    buffer holding at most maxlen of them. When it's full, the overflow
+    policy decides what happens to the next report: 'drop_oldest' discards
+    the oldest buffered one, and 'block' holds up the reader thread until
+    there's room, which pushes back on the gateway's TCP connection instead
+    of losing data, but also delays every other response from that gateway.
+    overflows counts the reports that found the buffer full, and dropped
+    those that were discarded.
+
+    The CLI doesn't print who sent a frame, so the source filter only
+    excludes reports known to come from another device.
+    '''
+    def __init__(self, attributes=None, cluster_code=None, source=None,
+            maxlen=1024, overflow='drop_oldest'):
+        if overflow not in ['drop_oldest', 'block']:
+            raise ValueError('unknown overflow policy %r' % overflow)
+        self.attributes = None
+        if attributes is not None:
+            self.attributes = dict([((a.cluster_code, a.code), a)
+                for a in attributes])
+        self.cluster_code = cluster_code
+        self.source = source
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.received = 0
+        self.overflows = 0
+        self.dropped = 0
+        self.closed = False
+        self._buffer = collections.deque()
+        self._condition = threading.Condition()
+        self._dispatchers = []
+
+    def listen(self, dispatcher):
+        '''
+        Starts taking reports from a FrameDispatcher. A subscription can
+        listen to several, for instance one per gateway.
+        '''
+        dispatcher.listeners.append(self._on_frame)
+        self._dispatchers.append(dispatcher)
+
+    def _on_frame(self, frame):
+        if frame.code != 0x0A or frame.is_cluster_specific():
+            return
+        if (self.cluster_code is not None and
+                frame.cluster_code != self.cluster_code):
+            return
+        if self.source is not None and frame.source not in [None, self.source]:
+            return
+        received = time.time()
+        for attribute_code, type_code, value in _decode_report_records(
+                frame.payload):
+            attribute = None
+            if self.attributes is not None:
+                attribute = self.attributes.get((frame.cluster_code,
+                    attribute_code))
+                if attribute is None:
+                    continue
+            self._put(AttributeReport(frame.source, frame.cluster_code,
+                attribute_code, type_code, value, attribute, received))
+
+    def _put(self, report):
+        with self._condition:
+            if self.closed:
+                return
+            self.received += 1
+            if len(self._buffer) >= self.maxlen:
+                self.overflows += 1
+                if self.overflow == 'drop_oldest':
+                    self._buffer.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._buffer) >= self.maxlen and not self.closed:
+                        self._condition.wait(1)
+                    if self.closed:
+                        return
+            self._buffer.append(report)
+            self._condition.notify_all()
+
+    def get(self, timeout=None):
+        '''
+        Returns the next report, waiting up to timeout seconds for one to
+        arrive. Returns None once the subscription is closed and drained.
+        '''
+        limit = _deadline(timeout)
+        with self._condition:
+            while not self._buffer:
+                if self.closed:
+                    return None
+                if limit is None:
+                    self._condition.wait(1)
+                else:
+                    remaining = limit - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError()
+                    self._condition.wait(min(remaining, 1))
+            report = self._buffer.popleft()
+            self._condition.notify_all()
+            return report
+
+    def drain(self):
+        '''
+        Returns every buffered report without waiting, oldest first.
+        '''
+        with self._condition:
+            reports = list(self._buffer)
+            self._buffer.clear()
+            self._condition.notify_all()
+            return reports
+
+    def close(self):
+        '''
+        Stops taking reports. Those already buffered can still be read.
+        '''
+        for dispatcher in self._dispatchers:
+            if self._on_frame in dispatcher.listeners:
+                dispatcher.listeners.remove(self._on_frame)
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def __iter__(self):
+        while True:
+            report = self.get()
+            if report is None:
+                return
+            yield report
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class AttributeCache:
+    '''
+    The last known value of ZigBee attributes on remote devices, filled in
+    from Read Attributes responses, successful writes and attribute reports.
+    Entries are keyed by (device, cluster, attribute), and once there are
+    maxsize of them the least recently used one is evicted.
+
+    An entry is only used while it's younger than both the max_age the
+    caller asks for and its TTL, which is the one set for its attribute,
+    else the one set for its cluster, else the default ttl (None for no
+    limit).
+
+    >>> cache = AttributeCache(maxsize=2)
+    >>> cache.put(0x1234, 0x0006, 0x0000, 1)
+    >>> cache.get(0x1234, 0x0006, 0x0000, max_age=5)
+    1
+    >>> cache.set_ttl(0x0006, 0)
+    >>> cache.get(0x1234, 0x0006, 0x0000, max_age=5)
+    Traceback (most recent call last):
+        ...
+    KeyError: (4660, 6, 0)
+    '''
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # cluster code or (cluster code, attribute code) -> seconds
+        self.ttls = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # (source, cluster code, attribute code) -> (value, time stored)
+        self._entries = collections.OrderedDict()
+        # (cluster code, attribute code) -> sources with an entry
+        self._sources = {}
+
+    def set_ttl(self, target, ttl):
+        '''
+        Sets the TTL in seconds for a ZCLAttribute, or for every attribute in
+        a ZCLCluster or cluster code. None means no limit.
+        '''
+        if isinstance(target, zcl.ZCLAttribute):
+            key = (target.cluster_code, target.code)
+        elif isinstance(target, zcl.ZCLCluster):
+            key = target.code
+        else:
+            key = target
+        self.ttls[key] = ttl
+
+    def _ttl(self, cluster_code, attribute_code):
+        key = (cluster_code, attribute_code)
+        if key in self.ttls:
+            return self.ttls[key]
+        return self.ttls.get(cluster_code, self.ttl)
+
+    def get(self, source, cluster_code, attribute_code, max_age=None):
+        '''
+        Returns the cached value, or raises KeyError if there's none fresh
+        enough.
+        '''
+        key = (source, cluster_code, attribute_code)
+        limits = [limit for limit in [max_age,
+            self._ttl(cluster_code, attribute_code)] if limit is not None]
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # reinserting marks it as the most recently used
+                self._entries[key] = entry
+                value, stored = entry
+                if not limits or time.time() - stored <= min(limits):
+                    self.hits += 1
+                    return value
+            self.misses += 1
+        raise KeyError(key)
+
+    def put(self, source, cluster_code, attribute_code, value, stored=None):
+        key = (source, cluster_code, attribute_code)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, stored or time.time())
+            self._sources.setdefault((cluster_code, attribute_code),
+                    set()).add(source)
+            while len(self._entries) > self.maxsize:
+                self._forget(self._entries.popitem(last=False)[0])
+
+    def _forget(self, key):
+        source, cluster_code, attribute_code = key
+        sources = self._sources.get((cluster_code, attribute_code))
+        if sources is not None:
+            sources.discard(source)
+            if not sources:
+                del self._sources[(cluster_code, attribute_code)]
+
+    def invalidate(self, source, cluster_code, attribute_code):
+        '''
+        Drops an entry. A source of None drops the attribute for every
+        device.
+        '''
+        with self._lock:
+            if source is None:
+                sources = list(self._sources.get(
+                    (cluster_code, attribute_code), []))
+            else:
+                sources = [source]
+            for source in sources:
+                key = (source, cluster_code, attribute_code)
+                if self._entries.pop(key, None) is not None:
+                    self._forget(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sources.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _on_frame(self, frame):
+        # the CLI doesn't print who sent a report, so unless we know, the
+        # attribute is dropped for every device rather than updated
+        if frame.code != 0x0A or frame.is_cluster_specific():
+            return
+        for attribute_code, _, value in _decode_report_records(frame.payload):
+            if frame.source is None:
+                self.invalidate(None, frame.cluster_code, attribute_code)
+            else:
+                self.put(frame.source, frame.cluster_code, attribute_code,
+                        value)
+
+class OutboundQueue:
+    '''
+    Paces the commands written to a gateway. The Ember CLI silently drops
+    commands that arrive faster than it can handle them, so a writer thread
+    takes commands off this queue no faster than rate per second (with
+    bursts of up to burst commands), and holds them back while max_in_flight
+    of the commands sent are still waiting for their response or deadline.
+    Whatever can go out together is joined into a single socket write.
+
+    A command is a list of CLI lines that are written together, such as
+    a 'raw' and its 'send'. put() blocks while maxlen commands are waiting,
+    which slows callers down to the rate the gateway can sustain. Since the
+    responses that free in-flight slots arrive on the reader thread, don't
+    send commands from response callbacks.
+    '''
+    def __init__(self, conn, rate=None, burst=1, max_in_flight=None,
+            maxlen=256):
+        self.conn = conn
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.maxlen = maxlen
+        self.commands = 0
+        self.writes = 0
+        self.blocked = 0
+        self.closed = False
+        self._queue = collections.deque()
+        self._in_flight = []
+        self._tokens = burst
+        self._refilled = time.time()
+        self._condition = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop,
+                name='zigbee-tx')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def put(self, lines, response=None):
+        '''
+        Queues a command, waiting for room if the queue is full. response is
+        the Future for the command's response, if it counts as in flight.
+        '''
+        with self._condition:
+            if len(self._queue) >= self.maxlen:
+                self.blocked += 1
+            while len(self._queue) >= self.maxlen and not self.closed:
+                self._condition.wait(1)
+            if self.closed:
+                raise EOFError('outbound queue is closed')
+            self._queue.append((lines, response))
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        '''
+        Waits until every queued command has been written. Returns False if
+        the timeout expired first.
+        '''
+        limit = _deadline(timeout)
+        with self._condition:
+            while self._queue and not self.closed:
+                if limit is not None and time.time() >= limit:
+                    return False
+                self._condition.wait(0.05)
+        return not self._queue
+
+    def close(self):
+        '''
+        Stops taking commands. The writer still writes what it can right
+        away, and close waits up to a second for it to stop.
+        '''
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        if self._writer is not threading.current_thread():
+            self._writer.join(1)
+
+    def _notify(self, _):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _available(self):
+        '''
+        Returns how many commands may be written right now.
+        '''
+        available = len(self._queue)
+        if self.max_in_flight is not None:
+            self._in_flight = [f for f in self._in_flight
+                    if not f.done() and not f.expired()]
+            available = min(available,
+                    self.max_in_flight - len(self._in_flight))
+        if self.rate is not None:
+            now = time.time()
+            self._tokens = min(self.burst,
+                    self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            available = min(available, int(self._tokens))
+        return available
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                available = self._available()
+                while not available:
+                    if self.closed:
+                        return
+                    # responses and new commands wake us up, but token
+                    # refills and expired responses have to be polled for
+                    self._condition.wait(0.01 if self._queue else 1)
+                    available = self._available()
+                batch = [self._queue.popleft() for _ in xrange(available)]
+                if self.rate is not None:
+                    self._tokens -= len(batch)
+                for _, response in batch:
+                    if response is not None and self.max_in_flight is not None:
+                        self._in_flight.append(response)
+                        response.add_done_callback(self._notify)
+                self._condition.notify_all()
+            try:
+                self.conn.write(''.join([line + '\n'
+                    for lines, _ in batch for line in lines]))
+            except (EOFError, socket.error):
+                self.close()
+                return
+            self.commands += len(batch)
+            self.writes += 1
+
+def _completed(value):
+    '''
+    Returns a Future that already has the given result.
+    '''
+    future = Future()
+    future.set_result(value)
+    return future
+
+def _deadline(timeout):
+    if timeout is None:
+        return None
+    return time.time() + timeout
+
+class AsyncZBController:
+    '''
+    Non-blocking interface to an Ember gateway. Every operation that waits
+    for the network returns a Future right after the command is written, so
+    a single thread can keep many transactions in flight, for instance
+
+    >>> levels = gather([con.read_attribute(node, z.level_control.current_level)
+    ...         for node in nodes]) # doctest: +SKIP
+
+    A background reader thread routes the responses to their futures.
+
+    conn is the connection to the gateway, Telnet by default. Pass one of
+    the transports from the transport module to record a session, or to
+    replay one without a gateway.
+    '''
+    def __init__(self, conn=None):
+        if conn is None:
+            conn = Telnet()
+        self.conn = conn
+        self.hostname = None
         self.sequence = 0
+        self.dispatcher = FrameDispatcher()
+        # 'raw' loads a frame into the CLI's buffer and 'send' sends it, so
+        # the pair must not be interleaved with another thread's commands
+        self._tx_lock = threading.RLock()
+        self._global_frame_control = 0x00
+        self._reader = None
+        self.attribute_cache = None
+        self.outbound = None
+        self.instrumentation = None
+        # node ID -> discovery.DeviceCapabilities, for the devices whose
+        # endpoints have been discovered
+        self.capabilities = {}
 
     def open(self, hostname):
-        Telnet.open(self.conn, hostname, 4900)
+        self.hostname = hostname
+        self.conn.open(hostname, 4900)
+        # a replayed session holds lines back until they're waited for
+        attach = getattr(self.conn, 'attach', None)
+        if attach is not None:
+            attach(self.dispatcher)
+        self.start_reader()
+
+    def close(self):
+        if self.outbound is not None:
+            self.outbound.close()
+        self.conn.close()
 
-    def _network_command(self, command, args, status_prefix):
-        self.write('network %s %s' % (command, args))
-        _, match, _ = self.conn.expect(['%s (0x[0-9A-F]{2})' % status_prefix], timeout=2)
-        if match is None:
-            raise TimeoutError()
-        return int(match.group(1), 0)
+    def start_reader(self):
+        '''
+        Starts the background thread that drains the connection and hands
+        every line to the dispatcher. open() calls this for you.
+        '''
+        self._reader = threading.Thread(target=self._read_loop,
+                name='zigbee-rx')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_loop(self):
+        buffered = ''
+        while True:
+            try:
+                data = self.conn.read_some()
+            except (EOFError, socket.error):
+                break
+            if not data:
+                break
+            buffered += data
+            lines = buffered.split('\n')
+            buffered = lines.pop()
+            for line in lines:
+                self.dispatcher.dispatch_line(line.strip())
+
+    def enable_attribute_cache(self, maxsize=1024, ttl=None):
+        '''
+        Starts keeping an AttributeCache of the attribute values read from,
+        written to and reported by devices, so read_attribute can be given a
+        max_age. Returns the cache, to set TTLs on.
+        '''
+        if self.attribute_cache is None:
+            self.attribute_cache = AttributeCache(maxsize, ttl)
+            self.dispatcher.listeners.append(self.attribute_cache._on_frame)
+        return self.attribute_cache
+
+    def enable_outbound_queue(self, rate=None, burst=1, max_in_flight=None,
+            maxlen=256):
+        '''
+        Sends every command through an OutboundQueue, which limits them to
+        rate commands per second and max_in_flight awaiting their response,
+        and makes callers wait once maxlen commands are queued. Returns the
+        queue.
+        '''
+        if self.outbound is None:
+            self.outbound = OutboundQueue(self.conn, rate, burst,
+                    max_in_flight, maxlen)
+        return self.outbound
+
+    def enable_instrumentation(self, instrumentation=None):
+        '''
+        Starts timing operations and counting their outcomes, in the given
+        Instrumentation (for instance one shared by several controllers) or
+        a new one. Returns it.
+        '''
+        if self.instrumentation is None:
+            self.instrumentation = instrumentation or Instrumentation()
+            self.dispatcher.unmatched_listeners.append(
+                    self.instrumentation.unmatched)
+        return self.instrumentation
+
+    def enable_sample_store(self, store=None):
+        '''
+        Keeps every numeric attribute value read from or reported by a
+        device in a samples.SampleStore, which can be shared between
+        controllers. Returns the store.
+        '''
+        if store is None:
+            store = SampleStore()
+        def received(frame):
+            if frame.is_cluster_specific():
+                return
+            if frame.code == 0x01:
+                store.add_records(frame.source, frame.cluster_code,
+                        _decode_read_values(frame.payload), READ)
+            elif frame.code == 0x0A:
+                store.add_records(frame.source, frame.cluster_code,
+                        _decode_report_records(frame.payload), REPORT)
+        self.dispatcher.listeners.append(received)
+        return store
+
+    def _instrument(self, operation, node, cluster_code, pending,
+            status=None):
+        '''
+        Times a PendingResponse and records its outcome, if instrumentation
+        is enabled. status is a function returning the status carried by
+        the response, if any.
+        '''
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return pending
+        start = time.time()
+        def done(future):
+            elapsed = time.time() - start
+            if future._exception is not None:
+                instrumentation.record(operation, node, cluster_code, elapsed,
+                        'error')
+                return
+            code = status(future._value) if status is not None else None
+            instrumentation.record(operation, node, cluster_code, elapsed,
+                    'status' if code else 'ok', code)
+        pending.add_done_callback(done)
+        cancel = pending.on_timeout
+        def timed_out(future):
+            if not future.done():
+                # on_timeout is only called once, as it drops the waiter
+                instrumentation.record(operation, node, cluster_code,
+                        time.time() - start, 'timeout')
+            if cancel is not None:
+                cancel(future)
+        pending.on_timeout = timed_out
+        return pending
+
+    def _next_sequence(self):
+        with self._tx_lock:
+            sequence = self.sequence
+            self.sequence = (self.sequence + 1) % 0x100
+        return sequence
+
+    def _send_raw(self, destination, cluster_code, frame_control, sequence,
+            code, payload, response=None):
+        '''
+        Sends a ZCL frame to endpoint 1 of the destination, or to the
+        endpoint with the cluster once the device's capabilities have been
+        discovered. A frame the device is known not to support isn't sent,
+        and fails the response right away rather than once it times out.
+        '''
+        endpoint = 1
+        capabilities = self.capabilities.get(destination)
+        if capabilities is not None:
+            try:
+                endpoint = capabilities.check(cluster_code, frame_control,
+                        code)
+            except UnsupportedError as e:
+                if response is None:
+                    raise
+                self.dispatcher.cancel(response)
+                response.set_exception(e)
+                return
+        self._write_lines(['raw 0x%04X {%02X %02X %02X %s}' %
+                    (cluster_code, frame_control, sequence, code,
+                    hex_string(payload)),
+                    'send 0x%04X 1 %d' % (destination, endpoint)],
+                response)
+
+    def send_frame(self, destination, cluster_code, frame_control, code,
+            payload, sequence=None, response=None):
+        '''
+        Sends a ZCL frame built by the caller, for commands the model has
+        no ZCLCommand for or frames answering a device's request. The frame
+        takes the next sequence number unless one is given, as when
+        answering, and that is returned. response is the Future for the
+        frame's response, if the caller expects one.
+        '''
+        if sequence is None:
+            sequence = self._next_sequence()
+        self._send_raw(destination, cluster_code, frame_control, sequence,
+                code, payload, response)
+        return sequence
+
+    def _write_lines(self, lines, response=None):
+        '''
+        Writes CLI lines that belong together in one go, through the
+        outbound queue if there is one. response is the Future for the
+        command's response, used to limit the commands in flight.
+        '''
+        if self.outbound is not None:
+            self.outbound.put(lines, response)
+            return
+        with self._tx_lock:
+            self.conn.write(''.join([line + '\n' for line in lines]))
+
+    def _network_command(self, command, args, kind, **fields):
+        pending = self._instrument(command, None, None,
+                self.dispatcher.expect_event(kind, timeout=2, **fields),
+                _event_status)
+        self.write('network %s %s' % (command, args), pending)
+        return pending.then(lambda event: event.status)
 
     def form_network(self, channel=19, power=0, pan_id = 0xfafa):
-        status = self._network_command('form', '%d %d 0x%04x' %
-                (channel, power, pan_id), 'form')
-        if status == 0x70:
-            #already in network
-            pass
-        elif status != 0x00:
-            raise UnhandledStatusError()
+        def check(status):
+            if status == 0x70:
+                #already in network
+                pass
+            elif status != 0x00:
+                raise UnhandledStatusError()
+        return self._network_command('form', '%d %d 0x%04x' %
+                (channel, power, pan_id), 'network',
+                operation='form').then(check)
 
     def leave_network(self):
-        status = self._network_command('leave', '', 'leave')
-        if status == 0x70:
-            # already out of network
-            pass
-        elif status == 0x00:
-            out = self.conn.read_until('EMBER_NETWORK_DOWN', timeout=2)
-            if not out.endswith('EMBER_NETWORK_DOWN'):
-                raise TimeoutError()
-        else:
-            raise UnhandledStatusError()
+        network_down = self.dispatcher.expect_event('network_down', timeout=4)
+        def check(status):
+            if status == 0x70:
+                # already out of network
+                self.dispatcher.cancel(network_down)
+            elif status == 0x00:
+                return network_down
+            else:
+                self.dispatcher.cancel(network_down)
+                raise UnhandledStatusError()
+        return self._network_command('leave', '', 'network',
+                operation='leave').then(check)
 
     def enable_permit_join(self):
-        status = self._network_command('pjoin', '0xff', 'pJoin for 255 sec:')
-        if status != 0x00:
-            raise NetworkOperationError("Error enabling pjoin: 0x%x" % status)
+        def check(status):
+            if status != 0x00:
+                raise NetworkOperationError("Error enabling pjoin: 0x%x" % status)
+        return self._network_command('pjoin', '0xff', 'pjoin',
+                duration=255).then(check)
 
     def disable_permit_join(self):
-        status = self._network_command('pjoin', '0x00', 'pJoin for 0 sec:')
-        if status == 0x00:
-            print "Pjoin Disabled"
-        else:
-            print "Error disabling pjoin: 0x%x" % status
-
-    def wait_for_join(self):
-        _, match, _ = self.conn.expect(['Device Announce: (0x[0-9A-F]{4})'])
-        if match is None:
-            raise TimeoutError()
-        print 'Device %s joined' % match.group(1)
-        return int(match.group(1), 0)
-
-    def send_zcl_command(self, destination, cmd, debug=False):
-        payload = []
-        for arg in cmd.args:
-            payload += _list_from_arg(arg.type, arg.value)
+        def check(status):
+            if status == 0x00:
+                print "Pjoin Disabled"
+            else:
+                print "Error disabling pjoin: 0x%x" % status
+        return self._network_command('pjoin', '0x00', 'pjoin',
+                duration=0).then(check)
+
+    def wait_for_join(self, timeout=None):
+        # not self.wait_for_announce, which blocks on ZBController
+        return AsyncZBController.wait_for_announce(self, timeout).then(
+                lambda event: event.node_id)
+
+    def wait_for_announce(self, timeout=None):
+        '''
+        Waits for a device to announce itself, and completes with the
+        'announce' CLIEvent, which has its IEEE address too when the CLI
+        prints it.
+        '''
+        def joined(event):
+            print 'Device 0x%04X joined' % event.node_id
+            return event
+        return self.dispatcher.expect_event('announce', timeout).then(joined)
+
+    def send_zcl_command(self, destination, cmd, debug=False, timeout=10):
+        '''
+        Sends a ZCL command. The returned future completes with the first
+        frame the destination sends back with the same sequence number, which
+        is either the command's response or a Default Response.
+        '''
+        payload = _command_payload(cmd)
+        sequence = self._next_sequence()
+        # the sequence number alone could match another device's report
+        response = self.dispatcher.expect_frame(cmd.cluster_code,
+                sequence=sequence, source=destination, timeout=timeout,
+                timeout_error=AssertionError(
+                    "TIMED OUT waiting for response to " + cmd.name),
+                accept=lambda frame: _is_response(frame, cmd.code))
+        self._instrument('send_zcl_command', destination, cmd.cluster_code,
+                response, _default_response_status)
         if debug:
             sys.stdout.write('raw 0x%04X {01 %02X %02X %s}' %
-                    (cmd.cluster_code, self.sequence, cmd.code,
-                    " ".join(["%02X" % x for x in payload])))
+                    (cmd.cluster_code, sequence, cmd.code,
+                    hex_string(payload)))
+            self.write('send 0x%04X 1 1' % destination)
         else:
-            self.write('raw 0x%04X {01 %02X %02X %s}' %
-                    (cmd.cluster_code, self.sequence, cmd.code,
-                    " ".join(["%02X" % x for x in payload])))
-        self.write('send 0x%04X 1 1' % destination)
-        self.sequence = self.sequence + 1 % 0x100
-        #TODO: wait for response
+            self._send_raw(destination, cmd.cluster_code, 0x01, sequence,
+                    cmd.code, payload, response)
+        return response
 
     def send_zcl_ota_notify(self, destination, cmd):
-        payload = []
-        for arg in cmd.args:
-            payload += _list_from_arg(arg.type, arg.value)
+        payload = bytearray(_command_payload(cmd))
         self.write('zcl ota server notify 0x%04X %02X %s' %
                 (destination, 1, " ".join(["0x%04X" % x for x in payload])))
-        self.sequence = self.sequence + 1 % 0x100
+        self._next_sequence()
 
     def bind_node(self, node_id, node_ieee_address, cluster_id, timeout = 10):
         '''
@@ -125,30 +1143,164 @@ class ZBController:
         Expects node_id and cluster_id as integers, and node_ieee_address as
         a string with hex bytes separated by spaces.
         '''
-        self.write('zdo bind %d 1 1 %d {%s} {}' % (
-                node_id, cluster_id, node_ieee_address))
-        # note that we're basically waiting for any ZDO command, which is a little liberal
+        def check(event):
+            if event.status != 0x00:
+                raise AssertionError("Bind Request returned status %02X" % event.status)
+        # note that we're basically waiting for any Bind Response, which is a little liberal
         # RX: ZDO, command 0x8021, status: 0x00
-        _, match, _ = self.conn.expect(
-                ["RX: ZDO, command 0x[0-9A-Za-z]{4}, status: 0x([0-9A-Za-z]{2})"], timeout=timeout)
-        if match is None:
-            raise AssertionError("TIMED OUT waiting for bind response")
-        if match.group(1) != '00':
-            raise AssertionError("Bind Request returned status %s" % match.group(1))
+        pending = self._instrument('bind_node', node_id, cluster_id,
+                self.dispatcher.expect_event('zdo', timeout,
+                    AssertionError("TIMED OUT waiting for bind response"),
+                    command=0x8021),
+                _event_status)
+        endpoint = 1
+        capabilities = self.capabilities.get(node_id)
+        if capabilities is not None:
+            endpoint = capabilities.endpoint_for(cluster_id) or 1
+        self.write('zdo bind %d %d 1 %d {%s} {}' % (
+                node_id, endpoint, cluster_id, node_ieee_address), pending)
+        return pending.then(check)
+
+    #Active Endpoints Response: 0x3F21, status 0x00, endpoints [01 02 ]
+    def active_endpoints(self, destination, timeout=10):
+        '''
+        Asks a device for its active endpoints over ZDO, and completes with
+        the list of their numbers.
+        '''
+        pending = self._instrument('active_endpoints', destination, None,
+                self.dispatcher.expect_event('active_endpoints', timeout,
+                    AssertionError('TIMED OUT waiting for the active '
+                        'endpoints of 0x%04X' % destination),
+                    node_id=destination),
+                _event_status)
+        self.write('zdo active 0x%04X' % destination, pending)
+        return pending.then(lambda event:
+                _check_zdo_status(event, 'Active Endpoints').endpoints)
+
+    def simple_descriptor(self, destination, endpoint, timeout=10):
+        '''
+        Asks a device for the simple descriptor of one of its endpoints over
+        ZDO, and completes with the 'simple_descriptor' CLIEvent, which has
+        the endpoint's profile and device IDs and its input (server) and
+        output (client) clusters.
+        '''
+        pending = self._instrument('simple_descriptor', destination, None,
+                self.dispatcher.expect_event('simple_descriptor', timeout,
+                    AssertionError('TIMED OUT waiting for the simple '
+                        'descriptor of 0x%04X endpoint %d' % (destination,
+                            endpoint)),
+                    node_id=destination, endpoint=endpoint),
+                _event_status)
+        self.write('zdo simple 0x%04X %d' % (destination, endpoint), pending)
+        return pending.then(lambda event:
+                _check_zdo_status(event, 'Simple Descriptor'))
+
+    def _discover(self, destination, cluster_code, code, payload, operation,
+            timeout):
+        '''
+        Sends a global discovery command and completes with the payload of
+        its response, which has the next command ID.
+        '''
+        sequence = self._next_sequence()
+        # any command, so a Default Response refusing it is taken too
+        pending = self.dispatcher.expect_frame(cluster_code, None, sequence,
+                destination, timeout, AssertionError('TIMED OUT waiting for '
+                    '%s of cluster 0x%04X' % (operation, cluster_code)))
+        self._instrument(operation, destination, cluster_code, pending,
+                _default_response_status)
+        self._send_raw(destination, cluster_code, self._global_frame_control,
+                sequence, code, payload, pending)
+        def check(frame):
+            if frame.code != code + 1:
+                raise AssertionError('%s of cluster 0x%04X failed with '
+                        'status %r' % (operation, cluster_code,
+                            _default_response_status(frame)))
+            return frame.payload
+        return pending.then(check)
+
+    def _discover_pages(self, destination, cluster_code, code, codec,
+            operation, timeout, start, decode):
+        '''
+        Asks for one page of a discovery after another, from start on, and
+        completes with the items of all of them. decode(payload) returns
+        whether the device is done, the page's items, and where to ask
+        from next. The first page is sent right away, and the rest from a
+        worker thread, since sending can block until a response arrives on
+        the reader thread.
+        '''
+        first = self._discover(destination, cluster_code, code,
+                codec.encode([start, 0xFF]), operation, timeout)
+        future = Future()
+        def run():
+            items = []
+            page = first
+            try:
+                while True:
+                    done, found, start = decode(page.result())
+                    items.extend(found)
+                    if done:
+                        break
+                    page = self._discover(destination, cluster_code, code,
+                            codec.encode([start, 0xFF]), operation, timeout)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            future.set_result(items)
+        worker = threading.Thread(target=run, name='zigbee-' + operation)
+        worker.daemon = True
+        worker.start()
+        return future
 
+    def discover_attributes(self, destination, cluster_code, timeout=10,
+            start=0):
+        '''
+        Discovers the attributes a device has in a cluster, from attribute
+        ID start on, and completes with a list of (attribute ID, type code).
+        Devices send as many as fit in a frame, so this asks again from
+        where each response left off until the device says it's done.
+        '''
+        def decode(payload):
+            complete, records = _decode_discover_attributes(payload)
+            done = complete or not records or records[-1][0] == 0xFFFF
+            return done, records, records[-1][0] + 1 if records else None
+        return self._discover_pages(destination, cluster_code, 0x0C,
+                _discover_attributes_codec, 'discover_attributes', timeout,
+                start, decode)
 
-    def configure_reporting(self, destination, attribute, min_interval, max_interval, threshold):
+    def discover_commands_received(self, destination, cluster_code,
+            timeout=10, start=0):
+        '''
+        Discovers the cluster specific commands a device accepts in a
+        cluster, from command ID start on, and completes with the list of
+        their IDs, asking again as discover_attributes does.
+        '''
+        def decode(payload):
+            complete, codes = bool(payload[0]), list(payload[1:])
+            done = complete or not codes or codes[-1] == 0xFF
+            return done, codes, codes[-1] + 1 if codes else None
+        return self._discover_pages(destination, cluster_code, 0x11,
+                _discover_commands_codec, 'discover_commands_received',
+                timeout, start, decode)
+
+    def configure_reporting(self, destination, attribute, min_interval,
+            max_interval, threshold, timeout=10):
         '''
         Configures the device to report the given attribute to the controller.
         '''
+        record = _reporting_record_codec.encode([0x00, attribute.code,
+                attribute.type_code, min_interval, max_interval])
+        # only analog types carry a reportable change
         if attribute.type in ['INT8U', 'INT16U', 'INT32U', 'INT8S', 'INT16S', 'INT32S']:
-            threshold_value_list = _list_from_arg(attribute.type, threshold)
-        else:
-            threshold_value_list = [0]
-        self.write('zcl global send-me-a-report %d %d %d %d %d {%s}' % (
-            attribute.cluster_code, attribute.code, attribute.type_code,
-            min_interval, max_interval, _hex_string_from_list(threshold_value_list)))
-        self.write('send 0x%04X 1 1' % destination)
+            record += get_codec(attribute.type).encode(threshold)
+        sequence = self._next_sequence()
+        pending = self.dispatcher.expect_frame(attribute.cluster_code, 0x07,
+                sequence, destination, timeout, AssertionError(
+                    'TIMED OUT configuring reporting for %s' % attribute.name))
+        self._instrument('configure_reporting', destination,
+                attribute.cluster_code, pending, _first_status)
+        self._send_raw(destination, attribute.cluster_code,
+                self._global_frame_control, sequence, 0x06, record, pending)
+        return pending.then(_check_configure_reporting_response)
 
     def write_attribute(self, destination, attribute, value, timeout = 10):
         '''
@@ -156,79 +1308,531 @@ class ZBController:
         ZCLAttribute.
         '''
 
-        payload = _list_from_arg(attribute.type, value, strip_string_length=True)
+        payload = get_codec(attribute.type).encode(value)
         write_log(0, "Writing Attribute %s to %s" % (attribute.name,
-                " ".join(['%02X' % x for x in payload])))
-        self.write('zcl global write %d %d %d {%s}' %
-                (attribute.cluster_code, attribute.code, attribute.type_code,
-                " ".join(['%02X' % x for x in payload])))
-        self.write('send 0x%04X 1 1' % destination)
+                hex_string(payload)))
+        sequence = self._next_sequence()
         #RX len 4, ep 01, clus 0x0020 (Unknown clus. [0x0020]) FC 18 seq EC cmd 04 payload[00 ]
-        _, match, _ = self.conn.expect(['RX len [0-9]+, ep [0-9A-Z]+, ' +
-            'clus 0x%04X \([a-zA-Z0-9\.\[\]\(\) ]+\) .* cmd 04 payload\[([0-9A-Z ]*)\]' % attribute.cluster_code],
-            timeout=timeout)
-        #TODO: actually do something with the response
+        pending = self.dispatcher.expect_frame(attribute.cluster_code, 0x04,
+                sequence, destination, timeout, AssertionError(
+                    'TIMED OUT writing %s' % attribute.name))
+        self._instrument('write_attribute', destination,
+                attribute.cluster_code, pending, _first_status)
+        self._send_raw(destination, attribute.cluster_code,
+                self._global_frame_control, sequence, 0x02,
+                _attribute_record_codec.encode([attribute.code,
+                    attribute.type_code]) + payload, pending)
+        def written(frame):
+            if self.attribute_cache is not None:
+                # a lone SUCCESS status means every record was written
+                if list(frame.payload) == [0x00]:
+                    self.attribute_cache.put(destination,
+                            attribute.cluster_code, attribute.code, value)
+                else:
+                    self.attribute_cache.invalidate(destination,
+                            attribute.cluster_code, attribute.code)
+            status = _write_records([(attribute, value)],
+                    frame)[attribute].status
+            if status != 0:
+                raise AssertionError('Attribute Write failed with status '
+                        '0x%02X' % status)
+            return frame
+        return pending.then(written)
+
+    def write_attributes(self, destination, values, timeout=10,
+            undivided=False, response=True):
+        '''
+        Writes several attributes with one Write Attributes frame per cluster.
+        values maps each ZCLAttribute to its new value, or is a list of
+        (ZCLAttribute, value) pairs to keep the records in order. Completes
+        with a dictionary mapping each ZCLAttribute to an AttributeRecord of
+        its status and the value written.
+
+        With undivided set, Write Attributes Undivided is sent, and the
+        device writes none of a cluster's attributes unless it can write
+        them all. If it can't, every record has a failure status. With
+        response cleared, Write Attributes No Response is sent, and the
+        future completes with None as soon as the frames are handed to the
+        gateway.
+        '''
+        if isinstance(values, dict):
+            values = values.items()
+        by_cluster = collections.OrderedDict()
+        for attribute, value in values:
+            by_cluster.setdefault(attribute.cluster_code, []).append(
+                    (attribute, value))
+        if not response:
+            code = 0x05
+        elif undivided:
+            code = 0x03
+        else:
+            code = 0x02
+        futures = []
+        for cluster_code, writes in by_cluster.items():
+            payload = ''.join([_attribute_record_codec.encode([attribute.code,
+                attribute.type_code]) + get_codec(attribute.type).encode(value)
+                for attribute, value in writes])
+            sequence = self._next_sequence()
+            if not response:
+                self._send_raw(destination, cluster_code,
+                        self._global_frame_control, sequence, code, payload)
+                # whether the device took the values is anyone's guess
+                if self.attribute_cache is not None:
+                    for attribute, _ in writes:
+                        self.attribute_cache.invalidate(destination,
+                                cluster_code, attribute.code)
+                continue
+            pending = self.dispatcher.expect_frame(cluster_code, 0x04,
+                    sequence, destination, timeout, AssertionError(
+                        'TIMED OUT writing attributes %s' % ", ".join(
+                            [attribute.name for attribute, _ in writes])))
+            self._instrument('write_attributes', destination, cluster_code,
+                    pending, _first_status)
+            self._send_raw(destination, cluster_code,
+                    self._global_frame_control, sequence, code, payload,
+                    pending)
+            futures.append(pending.then(
+                lambda frame, writes=writes: self._cache_records(destination,
+                    _write_records(writes, frame, undivided))))
+        if not response:
+            return _completed(None)
+        def merge(results):
+            records = {}
+            for result in results:
+                records.update(result)
+            return records
+        return _combine(futures, merge)
 
-    def write_local_attribute(self, attribute, value):
+    def write_local_attribute(self, attribute, value, settle_delay=0):
         '''
-        Writes an attribute that's local to the controller.
+        Writes an attribute that's local to the controller. The CLI handles
+        lines in order, so later commands already see the new value. Give a
+        settle_delay in seconds if the application needs time to react.
         '''
-        payload = _list_from_arg(attribute.type, value)
-        payload_string = " ".join(['%02X' % x for x in payload])
+        payload_string = hex_string(get_codec(attribute.type).encode(value))
         self.write('write 1 %d %d 1 %d {%s}' % (
             attribute.cluster_code, attribute.code, attribute.type_code,
             payload_string))
-        time.sleep(1)
+        if settle_delay:
+            time.sleep(settle_delay)
 
     def make_server(self):
+        self._global_frame_control = 0x08
         self.write('zcl global direction 1')
 
     def make_client(self):
+        self._global_frame_control = 0x00
         self.write('zcl global direction 0')
 
+    def subscribe_reports(self, attributes=None, cluster_code=None,
+            source=None, maxlen=1024, overflow='drop_oldest'):
+        '''
+        Returns a ReportSubscription for the attribute reports received from
+        now on, limited to the given ZigBee attributes, cluster or source
+        when those are given. Close it when you're done with it.
+        '''
+        subscription = ReportSubscription(attributes, cluster_code, source,
+                maxlen, overflow)
+        subscription.listen(self.dispatcher)
+        return subscription
+
 #T000BD5C5:RX len 11, ep 01, clus 0x000A (Time) FC 18 seq 20 cmd 01 payload[00 00 00 E2 00 00 00 00 ]
 #READ_ATTR_RESP: (Time)
 #- attr:0000, status:00
 #type:E2, val:00000000
-    def read_attribute(self, destination, attribute, timeout=10):
-        self.write('zcl global read %d %d' %
-                (attribute.cluster_code, attribute.code))
-        self.write('send 0x%04X 1 1' % destination)
-        _, match, _ = self.conn.expect(['RX len [0-9]+, ep [0-9A-Z]+, ' +
-            'clus 0x%04X \([a-zA-Z0-9\.\[\]\(\) ]+\) .* cmd 01 payload\[([0-9A-Z ]*)\]' % attribute.cluster_code],
-            timeout=timeout)
-        if match is None:
-            raise AssertionError('TIMED OUT reading attribute %s' % attribute.name)
-        payload = [int(x, 16) for x in match.group(1).split()]
-        attribute_id = _pop_argument('INT16U', payload)
-        status = _pop_argument('INT8U', payload)
-        if status != 0:
-            raise AssertionError('Attribute Read failed with status 0x%02X' % status)
-        attribute_type_code = _pop_argument('INT8U', payload)
-        attribute_type = zcl.get_type_string(attribute_type_code)
-        return _pop_argument(attribute_type, payload)
+    def read_attribute(self, destination, attribute, timeout=10,
+            max_age=None):
+        '''
+        Reads an attribute from a device. If the attribute cache is enabled
+        and holds a value younger than max_age seconds, that is returned
+        without going over the air.
+        '''
+        if max_age is not None and self.attribute_cache is not None:
+            try:
+                return _completed(self.attribute_cache.get(destination,
+                    attribute.cluster_code, attribute.code, max_age))
+            except KeyError:
+                pass
+        sequence = self._next_sequence()
+        pending = self.dispatcher.expect_frame(attribute.cluster_code, 0x01,
+                sequence, destination, timeout,
+                AssertionError('TIMED OUT reading attribute %s' % attribute.name))
+        self._instrument('read_attribute', destination,
+                attribute.cluster_code, pending, _read_status)
+        self._send_raw(destination, attribute.cluster_code,
+                self._global_frame_control, sequence, 0x00,
+                _attribute_id_codec.encode(attribute.code), pending)
+        def decode(frame):
+            value = _decode_read_response(attribute, frame)
+            if self.attribute_cache is not None:
+                self.attribute_cache.put(destination, attribute.cluster_code,
+                        attribute.code, value)
+            return value
+        return pending.then(decode)
+
+    def read_attributes(self, destination, attributes, timeout=10,
+            max_age=None):
+        '''
+        Reads several attributes with one Read Attributes frame per cluster
+        and completes with a dictionary mapping each ZCLAttribute to its
+        AttributeRecord. Attributes missing from the response (for instance
+        because it didn't fit in one frame) are left out. As for
+        read_attribute, cached values younger than max_age aren't read again.
+        '''
+        cached = {}
+        by_cluster = collections.OrderedDict()
+        for attribute in attributes:
+            if max_age is not None and self.attribute_cache is not None:
+                try:
+                    cached[attribute] = AttributeRecord(attribute, 0x00,
+                        self.attribute_cache.get(destination,
+                            attribute.cluster_code, attribute.code, max_age))
+                    continue
+                except KeyError:
+                    pass
+            by_cluster.setdefault(attribute.cluster_code, []).append(attribute)
+        futures = []
+        for cluster_code, cluster_attributes in by_cluster.items():
+            sequence = self._next_sequence()
+            pending = self.dispatcher.expect_frame(cluster_code, 0x01,
+                    sequence, destination, timeout, AssertionError(
+                        'TIMED OUT reading attributes %s' % ", ".join(
+                            [a.name for a in cluster_attributes])))
+            self._instrument('read_attributes', destination, cluster_code,
+                    pending, _read_status)
+            payload = ''.join([_attribute_id_codec.encode(attribute.code)
+                for attribute in cluster_attributes])
+            self._send_raw(destination, cluster_code,
+                    self._global_frame_control, sequence, 0x00, payload,
+                    pending)
+            futures.append(pending.then(
+                lambda frame, requested=cluster_attributes:
+                    self._cache_records(destination,
+                        _attribute_records(requested, frame))))
+        def merge(results):
+            records = dict(cached)
+            for result in results:
+                records.update(result)
+            return records
+        return _combine(futures, merge)
+
+    def _cache_records(self, destination, records):
+        if self.attribute_cache is not None:
+            for attribute, record in records.items():
+                if record.status == 0x00:
+                    self.attribute_cache.put(destination,
+                            attribute.cluster_code, attribute.code,
+                            record.value)
+                else:
+                    self.attribute_cache.invalidate(destination,
+                            attribute.cluster_code, attribute.code)
+        return records
 
     #T183FCD64:RX len 5, ep 01, clus 0x0020 (Unknown clus. [0x0020]) FC 18 seq D3 cmd 0B payload[03 00 ]
-    def expect_zcl_command(self, command, timeout=10):
+    def expect_zcl_command(self, command, timeout=10, source=None):
         '''
         Waits for an incomming message and validates it against the given
         cluster ID, command ID, and arguments. Any arguments given as None
-        are ignored. Raises an AssertionError on mis-match or timeout.
+        are ignored. Raises an AssertionError on mis-match or timeout. A
+        frame known to come from another node than source is never taken.
         '''
-        # read and discard any data already queued up in the buffer
-        self.conn.read_eager()
         # we're pretty loose about what we accept as the incoming command. This is
         # mostly to more easily handle DefaultResponses, which are displayed
-        # with their cluster ID as whatever cluster they're responding to
-        _, match, _ = self.conn.expect(['RX .* cmd %02X payload\[([0-9A-Z ]*)\]'
-            % command.code], timeout=timeout)
-        if match is None:
-            raise AssertionError("TIMED OUT waiting for " + command.name)
-        payload = [int(x, 16) for x in match.group(1).split()]
-        _validate_payload(command.args, payload)
+        # with their cluster ID as whatever cluster they're responding to.
+        # Only frames that arrive after this call are considered.
+        pending = self.dispatcher.expect_frame(code=command.code,
+                source=source, timeout=timeout,
+                timeout_error=AssertionError("TIMED OUT waiting for " + command.name))
+        self._instrument('expect_zcl_command', source, command.cluster_code,
+                pending)
+        return pending.then(
+                lambda frame: _validate_payload(command.args, frame.payload,
+                    getattr(command, 'codec', None)))
+
+    def write(self, msg, response=None):
+        self._write_lines([msg], response)
 
-    def write(self, msg):
-        self.conn.write(msg + '\n')
+class ZBController(AsyncZBController):
+    '''
+    Blocking interface to an Ember gateway. Each method starts the operation
+    on AsyncZBController and waits for its result, raising on failure or
+    timeout. send_zcl_command doesn't wait, and returns the Future for the
+    response instead.
+    '''
+    def form_network(self, *args, **kwargs):
+        AsyncZBController.form_network(self, *args, **kwargs).result()
+
+    def leave_network(self):
+        AsyncZBController.leave_network(self).result()
+
+    def enable_permit_join(self):
+        AsyncZBController.enable_permit_join(self).result()
+
+    def disable_permit_join(self):
+        AsyncZBController.disable_permit_join(self).result()
+
+    def wait_for_join(self, timeout=None):
+        return AsyncZBController.wait_for_join(self, timeout).result()
+
+    def wait_for_announce(self, timeout=None):
+        return AsyncZBController.wait_for_announce(self, timeout).result()
+
+    def active_endpoints(self, *args, **kwargs):
+        return AsyncZBController.active_endpoints(self, *args,
+                **kwargs).result()
+
+    def simple_descriptor(self, *args, **kwargs):
+        return AsyncZBController.simple_descriptor(self, *args,
+                **kwargs).result()
+
+    def discover_attributes(self, *args, **kwargs):
+        return AsyncZBController.discover_attributes(self, *args,
+                **kwargs).result()
+
+    def discover_commands_received(self, *args, **kwargs):
+        return AsyncZBController.discover_commands_received(self, *args,
+                **kwargs).result()
+
+    def bind_node(self, *args, **kwargs):
+        AsyncZBController.bind_node(self, *args, **kwargs).result()
+
+    def configure_reporting(self, *args, **kwargs):
+        AsyncZBController.configure_reporting(self, *args, **kwargs).result()
+
+    def write_attribute(self, *args, **kwargs):
+        return AsyncZBController.write_attribute(self, *args,
+                **kwargs).result()
+
+    def read_attribute(self, *args, **kwargs):
+        return AsyncZBController.read_attribute(self, *args, **kwargs).result()
+
+    def read_attributes(self, *args, **kwargs):
+        return AsyncZBController.read_attributes(self, *args, **kwargs).result()
+
+    def write_attributes(self, *args, **kwargs):
+        return AsyncZBController.write_attributes(self, *args,
+                **kwargs).result()
+
+    def expect_zcl_command(self, *args, **kwargs):
+        AsyncZBController.expect_zcl_command(self, *args, **kwargs).result()
+
+_attribute_id_codec = get_codec('ATTRIBUTE_ID')
+# an attribute ID, then a type code or status, which most records start with
+_attribute_record_codec = compile_payload(['ATTRIBUTE_ID', 'INT8U'])
+_write_status_codec = compile_payload(['INT8U', 'ATTRIBUTE_ID'])
+_reporting_record_codec = compile_payload(['INT8U', 'ATTRIBUTE_ID', 'INT8U',
+    'INT16U', 'INT16U'])
+_discover_attributes_codec = compile_payload(['ATTRIBUTE_ID', 'INT8U'])
+_discover_commands_codec = compile_payload(['INT8U', 'INT8U'])
+
+def _command_payload(cmd):
+    '''
+    Encodes the arguments of a ZCLCommandCall, using the codec compiled for
+    its prototype when there is one.
+    '''
+    payload_codec = getattr(cmd, 'codec', None)
+    if payload_codec is None:
+        payload_codec = compile_payload([arg.type for arg in cmd.args])
+        return payload_codec.encode([arg.value for arg in cmd.args])
+    return payload_codec.encode(cmd.values)
+
+def _decode_attribute_records(payload, statuses=True):
+    '''
+    Decodes the records of a Read Attributes Response into a list of
+    (attribute ID, status, type code, value), with None for the type and
+    value of failed records, which carry neither. With statuses False, the
+    records are those of a Report Attributes frame, which have no status,
+    and every status is SUCCESS. Decoding stops at a record with an unknown
+    type or one cut short, since the rest can't be located.
+
+    >>> _decode_attribute_records(bytearray([0x00, 0x00, 0x00, 0x20, 0x7F,
+    ...         0x10, 0x00, 0x86]))
+    [(0, 0, 32, 127), (16, 134, None, None)]
+    >>> _decode_attribute_records(bytearray([0x00, 0x00, 0x20, 0x7F]), False)
+    [(0, 0, 32, 127)]
+    '''
+    records = []
+    offset = 0
+    try:
+        while offset < len(payload):
+            (attribute_id, type_code), offset = _attribute_record_codec.decode(
+                    payload, offset)
+            status = 0x00
+            if statuses:
+                status = type_code
+                if status != 0x00:
+                    records.append((attribute_id, status, None, None))
+                    continue
+                type_code = payload[offset]
+                offset += 1
+            codec = get_codec(zcl.get_type_string(type_code))
+            if isinstance(codec, UnknownTypeCodec):
+                break
+            value, offset = codec.decode(payload, offset)
+            records.append((attribute_id, status, type_code, value))
+    except (KeyError, IndexError, struct.error):
+        pass
+    return records
+
+def _decode_read_records(payload):
+    '''
+    Decodes the records of a Read Attributes Response into a dictionary
+    mapping attribute ID to (status, value). value is None for failed
+    records.
+
+    >>> records = _decode_read_records(bytearray([0x00, 0x00, 0x00, 0x20, 0x7F,
+    ...         0x10, 0x00, 0x86]))
+    >>> records[0x0000], records[0x0010]
+    ((0, 127), (134, None))
+    >>> sorted(_decode_read_records(bytearray([0x00, 0x00, 0x00, 0x20, 0x7F,
+    ...         0x01, 0x00, 0x00, 0x4C, 0x01, 0x02, 0x00, 0x00, 0x20, 0x05])))
+    [0]
+    '''
+    return dict([(attribute_id, (status, value)) for attribute_id, status, _,
+        value in _decode_attribute_records(payload)])
+
+def _decode_report_records(payload):
+    '''
+    Decodes the records of a Report Attributes frame into a list of
+    (attribute ID, type code, value).
+
+    >>> _decode_report_records(bytearray([0x00, 0x00, 0x29, 0x34, 0x08,
+    ...         0x01, 0x00, 0x20, 0x05, 0x02, 0x00, 0xFF]))
+    [(0, 41, 2100), (1, 32, 5)]
+    '''
+    return [(attribute_id, type_code, value) for attribute_id, _, type_code,
+            value in _decode_attribute_records(payload, False)]
+
+def _write_statuses(payload):
+    '''
+    Decodes a Write Attributes Response into a dictionary mapping the ID of
+    each attribute that wasn't written to its status. A lone SUCCESS status
+    means every attribute was written, and gives an empty dictionary.
+
+    >>> _write_statuses(bytearray([0x00]))
+    {}
+    >>> _write_statuses(bytearray([0x86, 0x10, 0x00, 0x8D, 0x11, 0x00]))
+    {16: 134, 17: 141}
+    '''
+    statuses = {}
+    offset = 0
+    while offset + 3 <= len(payload):
+        (status, attribute_id), offset = _write_status_codec.decode(payload,
+                offset)
+        statuses[attribute_id] = status
+    return statuses
+
+def _write_records(writes, frame, undivided=False):
+    statuses = _write_statuses(frame.payload)
+    # some devices answer with a lone status for all the records
+    default = frame.payload[0] if len(frame.payload) == 1 else 0x00
+    if undivided and statuses:
+        # nothing was written, so the records that could have been share
+        # the first failure's status
+        default = frame.payload[0]
+    return dict([(attribute, AttributeRecord(attribute,
+        statuses.get(attribute.code, default), value))
+        for attribute, value in writes])
+
+def _decode_read_values(payload):
+    '''
+    Decodes the successful records of a Read Attributes Response into a list
+    of (attribute ID, type code, value), as _decode_report_records does for
+    reports.
+
+    >>> _decode_read_values(bytearray([0x00, 0x00, 0x00, 0x20, 0x7F,
+    ...         0x10, 0x00, 0x86]))
+    [(0, 32, 127)]
+    '''
+    return [(attribute_id, type_code, value) for attribute_id, status,
+            type_code, value in _decode_attribute_records(payload)
+            if status == 0x00]
+
+def _decode_discover_attributes(payload):
+    '''
+    Decodes a Discover Attributes Response into whether discovery is
+    complete, and a list of (attribute ID, type code).
+
+    >>> _decode_discover_attributes(bytearray([0x00, 0x00, 0x00, 0x20,
+    ...         0x04, 0x00, 0x42]))
+    (False, [(0, 32), (4, 66)])
+    '''
+    records = []
+    offset = 1
+    while offset + 3 <= len(payload):
+        # laid out like the start of a write record
+        (attribute_id, type_code), offset = _attribute_record_codec.decode(
+                payload, offset)
+        records.append((attribute_id, type_code))
+    return bool(payload[0]), records
+
+def _attribute_records(attributes, frame):
+    records = _decode_read_records(frame.payload)
+    return dict([(attribute, AttributeRecord(attribute, *records[attribute.code]))
+            for attribute in attributes if attribute.code in records])
+
+def _decode_read_response(attribute, frame):
+    records = _decode_read_records(frame.payload)
+    if attribute.code not in records:
+        raise AssertionError('Attribute %s missing from Read Attributes Response'
+                % attribute.name)
+    status, value = records[attribute.code]
+    if status != 0:
+        raise AssertionError('Attribute Read failed with status 0x%02X' % status)
+    return value
+
+def _read_status(frame):
+    for status, _ in _decode_read_records(frame.payload).values():
+        if status:
+            return status
+    return 0x00
+
+def _is_response(frame, code):
+    '''
+    Returns True if a frame could answer the client command with the given
+    ID: a cluster specific command from the server, or a Default Response
+    for that command.
+
+    >>> from embercli import RXFrame
+    >>> _is_response(RXFrame(1, 0x0006, 0x18, 0x14, 0x0B,
+    ...         bytearray([0x01, 0x00])), 0x01)
+    True
+    >>> _is_response(RXFrame(1, 0x0006, 0x18, 0x14, 0x0A,
+    ...         bytearray([0x00, 0x00, 0x10, 0x01])), 0x01)
+    False
+    '''
+    if not frame.is_from_server():
+        return False
+    if frame.is_cluster_specific():
+        return True
+    return (frame.code == 0x0B and len(frame.payload) >= 1 and
+            frame.payload[0] == code)
+
+def _first_status(frame):
+    return frame.payload[0] if frame.payload else None
+
+def _default_response_status(frame):
+    if (frame.code == 0x0B and not frame.is_cluster_specific() and
+            len(frame.payload) >= 2):
+        return frame.payload[1]
+    return None
+
+def _event_status(event):
+    return event.status
+
+def _check_zdo_status(event, request):
+    if event.status != 0x00:
+        raise AssertionError('%s Request returned status 0x%02X' % (request,
+            event.status))
+    return event
+
+def _check_configure_reporting_response(frame):
+    # a single status byte means every record succeeded, otherwise there's a
+    # status, direction and attribute ID for each failed record
+    status = frame.payload[0]
+    if status != 0:
+        raise AssertionError('Configure Reporting failed with status 0x%02X'
+                % status)
 
 class TimeoutError(StandardError):
     pass
@@ -239,8 +1843,11 @@ class UnhandledStatusError(StandardError):
 class NetworkOperationError(StandardError):
     pass
 
-def _hex_string_from_list(values):
-    return " ".join(['%02X' % v for v in values])
+class UnsupportedError(StandardError):
+    '''
+    Raised for a frame the device's discovered capabilities say it doesn't
+    support, instead of sending it.
+    '''
 
 def _list_from_arg(type, value, strip_string_length=False):
     '''
@@ -256,73 +1863,36 @@ def _list_from_arg(type, value, strip_string_length=False):
     [4, 54, 55, 56, 57]
     >>> _list_from_arg('OCTET_STRING', [6, 7, 8, 9])
     [4, 6, 7, 8, 9]
+    >>> _list_from_arg('INT8S', -2)
+    [254]
     '''
-    if type in ['ENUM8', 'INT8U', 'Status']:
-        if value < 0 or value > 0xff:
-            raise ValueError
-        return [value]
-    if type == 'INT8S':
-        if value < -128 or value > 127:
-            raise ValueError
-        return [value]
-    if type in ['INT16U', 'ENUM16', 'BITMAP16']:
-        if value < 0 or value > 0xffff:
-            raise ValueError
-        return [value & 0xff, value >> 8]
-    if type in ['INT32U', 'UTC_TIME', 'IEEE_ADDRESS', 'BITMAP32']:
-        if value < 0 or value > 0xffffffff:
-            raise ValueError
-        return [value & 0xff,
-                (value >> 8) & 0xff,
-                (value >> 16) & 0xff,
-                value >> 24]
-    if type == 'INT32S':
-        #TODO: add min/max value checking
-        if value < 0:
-            value = ~(abs(value) - 1)
-        return [value & 0xff,
-                (value >> 8) & 0xff,
-                (value >> 16) & 0xff,
-                (value >> 24) & 0xff]
-
-    if type == 'CHAR_STRING':
-        # expects a string as a value
-        if strip_string_length:
-            payload = []
-        else:
-            payload = [len(value)]
-        for char in value:
-            payload.append(ord(char))
-        return payload
-    if type == 'OCTET_STRING':
-        # expects a list of bytes as a value
-        if strip_string_length:
-            payload = []
-        else:
-            payload = [len(value)]
-        for byte in value:
-            payload += _list_from_arg('INT8U', byte)
-        return payload
-    print "WARNING: unrecognized type %s. Assuming INT8U" % type
-    return _list_from_arg('INT8U', value)
+    type_codec = get_codec(type)
+    payload = list(bytearray(type_codec.encode(value)))
+    if strip_string_length and type_codec.size is None:
+        return payload[type_codec.length.size:]
+    return payload
 
-def _validate_payload(arglist, payload):
+def _validate_payload(arglist, payload, payload_codec=None):
     '''
     Takes a list of ZCLCommandArgs and compares a received payload
-    against the expected values
+    against the expected values. The payload is decoded with payload_codec,
+    or with a codec compiled from the argument types if none is given.
 
+    >>> from zcl import ZCLCommandArg
     >>> arglist = [ZCLCommandArg('arg1', 'INT8U', 10),
     ...        ZCLCommandArg('arg2', 'INT16U', 32),
     ...        ZCLCommandArg('arg3', 'INT8U', None)]
-    >>> _validate_payload(arglist, [0x0A, 0x20, 0x00, 0x30])
-    True
-    >>> _validate_payload(arglist, [0x0B, 0x20, 0x00, 0x42])
-    Wrong value for arg1: Expected 10, got 11
-    False
+    >>> _validate_payload(arglist, bytearray([0x0A, 0x20, 0x00, 0x30]))
+    >>> _validate_payload(arglist, bytearray([0x0B, 0x20, 0x00, 0x42]))
+    Traceback (most recent call last):
+        ...
+    AssertionError: Wrong value for arg1: Expected 10, Received 11
     '''
+    if payload_codec is None:
+        payload_codec = compile_payload([arg.type for arg in arglist])
+    values, _ = payload_codec.decode(payload)
     try:
-        for arg in arglist:
-            received = _pop_argument(arg.type, payload)
+        for arg, received in zip(arglist, values):
             if arg.value is None:
                 # don't validate if expected value is None
                 continue
@@ -340,7 +1910,8 @@ def _pop_argument(type, payload):
     '''
     Takes a type string and a paylaod (list of 1-byte values) and
     pops off the correct number of bytes from the front of the payload,
-    formatting the result and returning it.
+    formatting the result and returning it. Prefer decoding with a codec and
+    an offset, which doesn't need to copy the payload.
 
     >>> test_list = [1, 0x92, 0x10, 4, 3, 2, 1, 3, 0x32, 0x33, 0x34,
     ...        3, 42, 43, 44]
@@ -355,44 +1926,9 @@ def _pop_argument(type, payload):
     >>> _pop_argument('OCTET_STRING', test_list)
     [42, 43, 44]
     '''
-    if type in ['ENUM8', 'INT8U', 'INT8S']:
-        return payload.pop(0)
-    if type in ['INT16U', 'ENUM16', 'BITMAP16']:
-        lsb = payload.pop(0)
-        msb = payload.pop(0)
-        return (msb << 8) | lsb
-    if type in ['INT32U', 'UTC_TIME', 'IEEE_ADDRESS', 'BITMAP32']:
-        byte0 = payload.pop(0)
-        byte1 = payload.pop(0)
-        byte2 = payload.pop(0)
-        byte3 = payload.pop(0)
-        return (byte3 << 24) | (byte2 << 16) | (byte1 << 8) | byte0
-    if type == 'INT32S':
-        byte0 = payload.pop(0)
-        byte1 = payload.pop(0)
-        byte2 = payload.pop(0)
-        byte3 = payload.pop(0)
-        value = (byte3 << 24) | (byte2 << 16) | (byte1 << 8) | byte0
-        if value & 0x80000000:
-            return -((~value + 1) & 0xFFFFFFFF)
-        else:
-            return value
-    if type == 'CHAR_STRING':
-        string = ''
-        string_len = payload.pop(0)
-        while(string_len):
-            string += chr(payload.pop(0))
-            string_len -= 1
-        return string
-    if type == 'OCTET_STRING':
-        string = []
-        string_len = payload.pop(0)
-        while(string_len):
-            string.append(payload.pop(0))
-            string_len -= 1
-        return string
-    print "WARNING: unrecognized type %s. Assuming INT8U" % type
-    return _pop_argument('INT8U', payload)
+    value, consumed = get_codec(type).decode(bytearray(payload))
+    del payload[:consumed]
+    return value
 
 if __name__ == '__main__':
     import doctest